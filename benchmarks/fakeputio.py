@@ -0,0 +1,361 @@
+"""Local HTTP server emulating the parts of the put.io API we use
+
+This is used by the benchmarks so that the download engine and the
+synchronizer can be measured without a put.io account or network.  It
+serves:
+
+* ``GET /v2/files/list`` and ``POST /v2/files/list/continue``
+* ``GET /v2/files/<id>``
+* ``GET /v2/files/<id>/download`` (optionally redirecting to ``/data/<id>``)
+  with support for ``Range`` requests
+* ``POST /v2/files/delete``
+* ``GET /v2/transfers/list``
+* ``POST /v2/zips/create`` and ``GET /v2/zips/<id>`` (the zip is ready at once)
+
+File contents are generated from a repeating pattern so that files of any
+size can be served without storing them, unless content is provided.  Per-connection bandwidth caps,
+added latency and injected failures can be configured, and every request
+is counted by endpoint.
+
+"""
+import io
+import json
+import random
+import re
+import threading
+import time
+import zipfile
+
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+except ImportError:  # pragma: no cover
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+    class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+try:
+    from urllib.parse import urlparse, parse_qs
+except ImportError:  # pragma: no cover
+    from urlparse import urlparse, parse_qs
+
+PATTERN = bytes(bytearray(range(256))) * 256
+_DOUBLE_PATTERN = PATTERN * 2
+SEND_CHUNK_SIZE = 64 * 1024
+DIRECTORY = "application/x-directory"
+
+
+def expected_content(file_id, offset, length):
+    """Return the bytes served for ``file_id`` starting at ``offset``"""
+    out = []
+    while length > 0:
+        start = (offset + file_id) % len(PATTERN)
+        n = min(length, len(PATTERN))
+        out.append(_DOUBLE_PATTERN[start:start + n])
+        offset += n
+        length -= n
+    return b"".join(out)
+
+
+class FakePutio(object):
+    """Fake put.io API server running on a background thread"""
+
+    def __init__(self, host="127.0.0.1", port=0, bandwidth=None, latency=0.0, failure_rate=0.0,
+                 redirect=True, page_size=1000, seed=0, api_failure_rate=0.0):
+        self.bandwidth = bandwidth  # bytes per second per connection, None for unlimited
+        self.latency = latency  # seconds added before every response
+        self.failure_rate = failure_rate  # probability a download request fails part way through
+        self.api_failure_rate = api_failure_rate  # probability an API call fails with a 503 or 429
+        self.redirect = redirect
+        self.page_size = page_size
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._next_id = 1
+        self.files = {}  # id -> dict as returned by the API
+        self.contents = {}  # id -> bytes served instead of the generated pattern
+        self.zips = {}  # zip id -> archive bytes
+        self.children = {0: []}
+        self.transfers = []
+        self.deleted = set()
+        self.call_counts = {}
+        self.bytes_served = 0
+        self._cursors = {}
+        self._httpd = ThreadingHTTPServer((host, port), _make_handler(self))
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="FakePutio")
+        self._thread.setDaemon(True)
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    @property
+    def api_url(self):
+        return self.url + "/v2"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def reset_counters(self):
+        with self._lock:
+            self.call_counts = {}
+            self.bytes_served = 0
+
+    def _count(self, endpoint, nbytes=0):
+        with self._lock:
+            self.call_counts[endpoint] = self.call_counts.get(endpoint, 0) + 1
+            self.bytes_served += nbytes
+
+    def should_fail(self):
+        with self._lock:
+            return self._random.random() < self.failure_rate
+
+    def api_failure(self):
+        """Return the status an API call should fail with, or None"""
+        with self._lock:
+            if self._random.random() >= self.api_failure_rate:
+                return None
+            return self._random.choice((429, 503))
+
+    def _add(self, name, size, parent_id, content_type):
+        with self._lock:
+            file_id = self._next_id
+            self._next_id += 1
+            self.files[file_id] = {
+                "id": file_id,
+                "name": name,
+                "size": size,
+                "parent_id": parent_id,
+                "content_type": content_type,
+                "crc32": None,
+                "created_at": "2015-10-13T05:20:22",
+            }
+            self.children.setdefault(parent_id, []).append(file_id)
+            if content_type == DIRECTORY:
+                self.children.setdefault(file_id, [])
+        return file_id
+
+    def add_file(self, name, size=None, parent_id=0, content=None):
+        """Add a file serving ``content`` if provided, otherwise a generated pattern of ``size`` bytes"""
+        file_id = self._add(name, len(content) if content is not None else size, parent_id,
+                            "application/octet-stream")
+        if content is not None:
+            self.contents[file_id] = content
+        return file_id
+
+    def content(self, file_id, offset, length):
+        """Return the bytes served for ``file_id`` starting at ``offset``"""
+        content = self.contents.get(file_id)
+        if content is not None:
+            return content[offset:offset + length]
+        return expected_content(file_id, offset, length)
+
+    def add_directory(self, name, parent_id=0):
+        return self._add(name, 0, parent_id, DIRECTORY)
+
+    def add_transfer(self, name, file_id, status="COMPLETED", size=0):
+        transfer = {
+            "id": len(self.transfers) + 1, "name": name, "file_id": file_id, "status": status,
+            "size": size, "downloaded": size, "estimated_time": None, "error_message": None,
+            "finished_at": "2015-10-13T05:20:24", "down_speed": 0, "percent_done": 100,
+        }
+        self.transfers.append(transfer)
+        return transfer
+
+    def build_tree(self, directories, files_per_directory, file_size, depth=1):
+        """Create ``directories`` trees of ``depth`` levels each holding ``files_per_directory`` files"""
+        file_ids = []
+        for d in range(directories):
+            parent_id = 0
+            for level in range(depth):
+                parent_id = self.add_directory("dir-{}-{}".format(d, level), parent_id)
+            for f in range(files_per_directory):
+                file_ids.append(self.add_file("file-{}-{}.bin".format(d, f), file_size, parent_id))
+        return file_ids
+
+    def create_zip(self, file_ids):
+        """Build a zip of the provided files, as put.io does for /zips/create"""
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as archive:
+            for file_id in file_ids:
+                info = self.files[file_id]
+                archive.writestr(info["name"], self.content(file_id, 0, info["size"]))
+        with self._lock:
+            zip_id = len(self.zips) + 1
+            self.zips[zip_id] = buf.getvalue()
+        return zip_id
+
+    def list_page(self, parent_id, cursor=None):
+        ids = [i for i in self.children.get(parent_id, []) if i not in self.deleted]
+        start = self._cursors.get(cursor, 0) if cursor else 0
+        page = ids[start:start + self.page_size]
+        next_cursor = None
+        if start + self.page_size < len(ids):
+            next_cursor = "c{}-{}".format(parent_id, start + self.page_size)
+            self._cursors[next_cursor] = start + self.page_size
+        parent = self.files.get(parent_id, {"id": 0, "name": "root", "content_type": DIRECTORY})
+        return {"files": [self.files[i] for i in page], "parent": parent, "cursor": next_cursor, "status": "OK"}
+
+
+def _make_handler(fake):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send_json(self, endpoint, payload, status=200):
+            body = json.dumps(payload).encode("utf-8")
+            fake._count(endpoint)
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_api_failure(self):
+            """Fail the API call if it was picked to fail; returns True if it was"""
+            status = fake.api_failure()
+            if status is None:
+                return False
+            body = json.dumps({"error_type": "Unavailable", "status": "ERROR"}).encode("utf-8")
+            fake._count("failed/{}".format(status))
+            self.send_response(status)
+            if status == 429:
+                self.send_header("Retry-After", "0.1")
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return True
+
+        def _read_form(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length).decode("utf-8") if length else ""
+            return dict((k, v[0]) for k, v in parse_qs(body).items())
+
+        def _serve_content(self, file_id):
+            info = fake.files.get(file_id)
+            if info is None or file_id in fake.deleted:
+                return self._send_json("download", {"error_type": "NotFound"}, 404)
+            size = info["size"]
+            start, end = 0, size - 1
+            status = 200
+            m = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range") or "")
+            if m:
+                start = int(m.group(1))
+                end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+                status = 206
+            length = max(0, end - start + 1)
+            fake._count("download")
+
+            fail_at = None
+            if fake.should_fail():
+                if length == 0 or fake._random.random() < 0.5:
+                    self.send_response(503)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                fail_at = fake._random.randint(0, length - 1)  # drop the connection part way
+
+            self.send_response(status)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(length))
+            if status == 206:
+                self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, size))
+            self.end_headers()
+
+            sent = 0
+            began = time.time()
+            while sent < length:
+                n = min(SEND_CHUNK_SIZE, length - sent)
+                if fail_at is not None and sent + n > fail_at:
+                    self.wfile.write(fake.content(file_id, start + sent, fail_at - sent))
+                    self.close_connection = True
+                    return
+                self.wfile.write(fake.content(file_id, start + sent, n))
+                sent += n
+                with fake._lock:
+                    fake.bytes_served += n
+                if fake.bandwidth:
+                    ahead = sent / float(fake.bandwidth) - (time.time() - began)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+        def do_GET(self):
+            if fake.latency:
+                time.sleep(fake.latency)
+            url = urlparse(self.path)
+            query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+            path = url.path
+            if path.startswith("/v2/") and not path.endswith("/download") and self._send_api_failure():
+                return
+            if path == "/v2/files/list":
+                return self._send_json("files/list", fake.list_page(int(query.get("parent_id", 0))))
+            if path == "/v2/transfers/list":
+                return self._send_json("transfers/list", {"transfers": fake.transfers, "status": "OK"})
+            if path == "/v2/events/list":
+                return self._send_json("events/list", {"events": [], "status": "OK"})
+            m = re.match(r"^/v2/files/(\d+)/download$", path)
+            if m:
+                if fake.redirect:
+                    fake._count("download-redirect")
+                    self.send_response(302)
+                    self.send_header("Location", "/data/{}".format(m.group(1)))
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                return self._serve_content(int(m.group(1)))
+            m = re.match(r"^/data/(\d+)$", path)
+            if m:
+                return self._serve_content(int(m.group(1)))
+            m = re.match(r"^/v2/zips/(\d+)$", path)
+            if m and int(m.group(1)) in fake.zips:
+                zip_id = int(m.group(1))
+                return self._send_json("zips/get", {"url": "{}/zipdata/{}".format(fake.url, zip_id),
+                                                    "size": len(fake.zips[zip_id]), "missing_files": [],
+                                                    "status": "OK"})
+            m = re.match(r"^/zipdata/(\d+)$", path)
+            if m and int(m.group(1)) in fake.zips:
+                data = fake.zips[int(m.group(1))]
+                fake._count("zipdata", len(data))
+                self.send_response(200)
+                self.send_header("Content-Type", "application/zip")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                return
+            m = re.match(r"^/v2/files/(\d+)$", path)
+            if m and int(m.group(1)) in fake.files:
+                return self._send_json("files/get", {"file": fake.files[int(m.group(1))], "status": "OK"})
+            return self._send_json("unknown", {"error_type": "NotFound"}, 404)
+
+        def do_POST(self):
+            if fake.latency:
+                time.sleep(fake.latency)
+            form = self._read_form()
+            path = urlparse(self.path).path
+            if self._send_api_failure():
+                return
+            if path == "/v2/files/list/continue":
+                cursor = form.get("cursor", "")
+                parent_id = int(cursor[1:].split("-")[0]) if cursor else 0
+                return self._send_json("files/list/continue", fake.list_page(parent_id, cursor))
+            if path == "/v2/zips/create":
+                zip_id = fake.create_zip([int(i) for i in form.get("file_ids", "").split(",") if i])
+                return self._send_json("zips/create", {"zip_id": zip_id, "status": "OK"})
+            if path == "/v2/files/delete":
+                ids = form.get("file_ids") or form.get("file_id") or ""
+                fake.deleted.update(int(i) for i in ids.split(",") if i)
+                return self._send_json("files/delete", {"status": "OK"})
+            return self._send_json("unknown", {"error_type": "NotFound"}, 404)
+
+    return Handler
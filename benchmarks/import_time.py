@@ -0,0 +1,68 @@
+"""Guard against regressions in the time taken to import putiosync
+
+Imports ``putiosync.frontend`` in a fresh interpreter (several times,
+keeping the fastest run) and reports the time taken as JSON.  Optional
+subsystems must not be imported until they are enabled, so the script
+fails if any of them were loaded, or if importing took longer than
+``--max-ms``::
+
+    $ python benchmarks/import_time.py --max-ms 500
+
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# modules that should only be imported when the related feature is enabled
+OPTIONAL_MODULES = ("flask", "flask_restless", "werkzeug", "watchdog", "progressbar", "pid",
+                    "aiohttp", "putiosync.webif.webif", "putiosync.watcher", "putiosync.aio_engine")
+
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import putiosync.frontend
+elapsed = time.perf_counter() - start
+print(json.dumps({"seconds": elapsed, "modules": sorted(sys.modules)}))
+"""
+
+
+def measure(runs):
+    best = None
+    modules = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, "-c", _PROBE], cwd=ROOT)
+        result = json.loads(output.decode("utf-8"))
+        if best is None or result["seconds"] < best:
+            best = result["seconds"]
+        modules = result["modules"]
+    return {
+        "import_ms": round(best * 1000, 1),
+        "modules_loaded": len(modules),
+        "optional_modules_loaded": [m for m in OPTIONAL_MODULES if m in modules],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-ms", type=float, default=None,
+                        help="Fail if importing takes longer than this many milliseconds")
+    args = parser.parse_args()
+
+    result = measure(args.runs)
+    print(json.dumps(result, indent=2))
+    if result["optional_modules_loaded"]:
+        print("Optional modules imported eagerly: {}".format(", ".join(result["optional_modules_loaded"])))
+        return 1
+    if args.max_ms is not None and result["import_ms"] > args.max_ms:
+        print("Import took {}ms (limit {}ms)".format(result["import_ms"], args.max_ms))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,68 @@
+"""Measure the memory used by a large download queue
+
+Queues a number of downloads the same way the synchronizer does (with the
+synchronizer's callbacks attached) and reports the memory used per queued
+entry as JSON::
+
+    $ python benchmarks/queue_memory.py --entries 150000
+
+"""
+import argparse
+import json
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from putiosync.download_manager import Download, DownloadManager  # noqa: E402
+
+
+class _FakeFile(object):
+    def __init__(self, d):
+        self.__dict__.update(d)
+
+
+def _noop(download):
+    pass
+
+
+def measure(entries):
+    manager = DownloadManager(token="benchmark")
+    files = [_FakeFile({"id": i, "name": "file-%08d.srt" % i, "size": 4096 + i,
+                        "content_type": "text/plain"})
+             for i in range(entries)]
+    destination = "/downloads/Some Show/Season 01"
+
+    name_bytes = sum(sys.getsizeof(f.name) for f in files)
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    for putio_file in files:
+        download = Download.from_putio_file(putio_file, destination, delete_after_download=True)
+        download.add_start_callback(_noop)
+        download.add_progress_callback(_noop)
+        download.add_completion_callback(_noop)
+        manager.add_download(download)
+    del files  # only the queue should keep anything alive
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # names are allocated before tracing starts and kept alive by the queue, so add them in
+    queue_bytes = after - before + name_bytes
+    return {
+        "entries": entries,
+        "queue_bytes": queue_bytes,
+        "bytes_per_entry": queue_bytes / float(entries),
+        "peak_bytes": peak - before,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=100000)
+    args = parser.parse_args()
+    print(json.dumps(measure(args.entries), indent=2))
+
+
+if __name__ == "__main__":
+    main()
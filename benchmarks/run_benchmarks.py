@@ -0,0 +1,290 @@
+"""Offline benchmarks for the download engine and synchronizer
+
+Runs each benchmark case against a local :mod:`fakeputio` server and
+reports throughput, CPU time per GB, peak RSS and API calls as JSON so that
+results can be compared across releases::
+
+    $ python benchmarks/run_benchmarks.py --quick --output results.json
+    $ python benchmarks/run_benchmarks.py --sizes 64M,1G --workers 1,4,8 \\
+          --segments 16M,200M --bandwidth 20M --latency 0.02
+
+Every case runs in its own process so that peak RSS and CPU time are
+measured for that case alone.  Four suites are available:
+
+multipart
+    ``multipart_downloader.download`` (or the process engine) for each
+    combination of engine, file size, worker count and segment size.
+manager
+    ``DownloadManager`` downloading a batch of files end to end.
+scan
+    ``PutioSynchronizer`` walking a remote tree, reporting API calls.
+asyncio
+    ``AsyncSyncEngine`` crawling and downloading the manager batches end to
+    end on one event loop (requires aiohttp).
+
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+
+from fakeputio import FakePutio  # noqa: E402
+
+GB = 1024 ** 3
+
+
+def parse_size(value):
+    """Parse sizes such as '512K', '64M' or '1G' into bytes"""
+    value = value.strip().upper()
+    multipliers = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    if value[-1:] in multipliers:
+        return int(float(value[:-1]) * multipliers[value[-1]])
+    return int(value)
+
+
+def _parse_list(value, parse=int):
+    return [parse(v) for v in value.split(",") if v]
+
+
+# -- cases (run in a child process) -------------------------------------------
+
+def _usage():
+    import resource
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)  # worker processes, once reaped
+    return (usage.ru_utime + usage.ru_stime + children.ru_utime + children.ru_stime,
+            max(usage.ru_maxrss, children.ru_maxrss))
+
+
+def _case_multipart(case, workdir):
+    from putiosync import multipart_downloader
+    path = os.path.join(workdir, "download.bin")
+    if case.get("engine") == "processes":
+        from putiosync.process_downloader import ProcessDownloadEngine
+        open(path, "wb").close()
+        engine = ProcessDownloadEngine(num_processes=case["workers"], segment_size_bytes=case["segment_size"])
+        start = time.time()
+        success = engine.download(case["url"], case["size"], path)
+        elapsed = time.time() - start
+        engine.shutdown(wait=True)
+        return {"success": success, "seconds": elapsed, "bytes": case["size"]}
+    with open(path, "wb") as f:
+        def transfer_callback(offset, chunk):
+            f.seek(offset)
+            f.write(chunk)
+        start = time.time()
+        success = multipart_downloader.download(
+            case["url"], case["size"], transfer_callback,
+            num_workers=case["workers"], segment_size_bytes=case["segment_size"])
+        elapsed = time.time() - start
+    return {"success": success, "seconds": elapsed, "bytes": case["size"]}
+
+
+def _case_manager(case, workdir):
+    import putiopy
+    from putiosync.download_manager import Download, DownloadManager
+    putiopy.BASE_URL = case["api_url"]
+    manager = DownloadManager(token="benchmark")
+    completed = []
+    manager.add_download_completion_callback(completed.append)
+    for file_id in case["file_ids"]:
+        manager.add_download(Download(file_id, "file-{}.bin".format(file_id), case["size"], workdir))
+    start = time.time()
+    manager.start()
+    while not manager.is_empty():
+        time.sleep(0.01)
+    elapsed = time.time() - start
+    return {"success": len(completed) == len(case["file_ids"]), "seconds": elapsed,
+            "bytes": case["size"] * len(completed), "files": len(completed)}
+
+
+def _case_scan(case, workdir):
+    os.environ["PUTIO_SYNC_SETTINGS_DIR"] = os.path.join(workdir, "settings")
+    import putiopy
+    from putiosync.api_client import PutioClient
+    from putiosync.core import DatabaseManager, PutioSynchronizer
+    from putiosync.download_manager import DownloadManager
+    putiopy.BASE_URL = case["api_url"]
+    client = PutioClient("benchmark", retry_backoff=0.1)
+    manager = DownloadManager(token="benchmark")  # not started; we only measure queueing
+    synchronizer = PutioSynchronizer(os.path.join(workdir, "downloads"), client, DatabaseManager(), manager,
+                                     keep_files=True, disable_progress=True)
+    start = time.time()
+    success = synchronizer._perform_single_check()
+    elapsed = time.time() - start
+    return {"success": success, "seconds": elapsed, "files": len(manager.get_downloads())}
+
+
+def _case_asyncio(case, workdir):
+    os.environ["PUTIO_SYNC_SETTINGS_DIR"] = os.path.join(workdir, "settings")
+    import putiopy
+    from putiosync.aio_engine import AsyncSyncEngine
+    from putiosync.core import DatabaseManager
+    putiopy.BASE_URL = case["api_url"]
+    engine = AsyncSyncEngine("benchmark", workdir, DatabaseManager(), keep_files=True)
+    start = time.time()
+    success = engine.sync_once()
+    elapsed = time.time() - start
+    return {"success": success and engine.session_files_completed == case["count"], "seconds": elapsed,
+            "bytes": engine.session_downloaded_bytes, "files": engine.session_files_completed}
+
+
+CASES = {
+    "multipart": _case_multipart,
+    "manager": _case_manager,
+    "scan": _case_scan,
+    "asyncio": _case_asyncio,
+}
+
+
+def run_case(case):
+    import logging
+    logging.getLogger("putiosync").setLevel(logging.CRITICAL)
+    workdir = tempfile.mkdtemp(prefix="putiosync-bench-")
+    try:
+        cpu_before, _ = _usage()
+        result = CASES[case["suite"]](case, workdir)
+        cpu_after, peak_rss_kb = _usage()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    result["cpu_seconds"] = cpu_after - cpu_before
+    result["peak_rss_kb"] = peak_rss_kb
+    return result
+
+
+# -- driver ---------------------------------------------------------------------
+
+def _spawn(case):
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--run-case", json.dumps(case)])
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+
+def _summarize(params, result, fake):
+    if result.get("bytes") and result["seconds"] > 0:
+        result["throughput_mbps"] = result["bytes"] * 8 / result["seconds"] / 1e6
+        result["cpu_seconds_per_gb"] = result["cpu_seconds"] / (result["bytes"] / float(GB))
+    result["api_calls"] = dict(fake.call_counts)
+    result["api_calls_total"] = sum(fake.call_counts.values())
+    params.update(result)
+    return params
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--suites", default="multipart,manager,scan")
+    parser.add_argument("--sizes", default="16M,256M", help="File sizes for the multipart suite")
+    parser.add_argument("--workers", default="1,4,8", help="Worker counts for the multipart suite")
+    parser.add_argument("--segments", default="8M,64M,200M", help="Segment sizes for the multipart suite")
+    parser.add_argument("--engines", default="threads,processes", help="Engines for the multipart suite")
+    parser.add_argument("--manager-files", default="1000x64K,20x16M",
+                        help="Batches for the manager suite as COUNTxSIZE")
+    parser.add_argument("--scan-trees", default="10x100,100x100",
+                        help="Trees for the scan suite as DIRECTORIESxFILES_PER_DIRECTORY")
+    parser.add_argument("--bandwidth", default=None, help="Per connection bandwidth cap, e.g. 20M")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds of latency added to each request")
+    parser.add_argument("--failure-rate", type=float, default=0.0,
+                        help="Probability that a download request fails or is cut short")
+    parser.add_argument("--api-failure-rate", type=float, default=0.0,
+                        help="Probability of each API call failing with a 503 or 429")
+    parser.add_argument("--no-redirect", action="store_true", help="Serve downloads without a redirect")
+    parser.add_argument("--quick", action="store_true", help="Run a small matrix (for smoke testing)")
+    parser.add_argument("--output", default=None, help="Write results to this file instead of stdout")
+    parser.add_argument("--run-case", default=None, help=argparse.SUPPRESS)
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    if args.run_case is not None:
+        print(json.dumps(run_case(json.loads(args.run_case))))
+        return 0
+
+    if args.quick:
+        args.sizes, args.workers, args.segments = "4M", "1,4", "1M"
+        args.manager_files, args.scan_trees = "50x16K", "5x20"
+
+    import putiosync
+    fake = FakePutio(bandwidth=parse_size(args.bandwidth) if args.bandwidth else None,
+                     latency=args.latency, failure_rate=args.failure_rate,
+                     redirect=not args.no_redirect, api_failure_rate=args.api_failure_rate).start()
+    suites = args.suites.split(",")
+    results = []
+    try:
+        if "multipart" in suites:
+            for size in _parse_list(args.sizes, parse_size):
+                file_id = fake.add_file("multipart-{}.bin".format(size), size)
+                for engine in args.engines.split(","):
+                    for workers in _parse_list(args.workers):
+                        for segment_size in _parse_list(args.segments, parse_size):
+                            params = {"suite": "multipart", "engine": engine, "size": size, "workers": workers,
+                                      "segment_size": segment_size}
+                            fake.reset_counters()
+                            case = dict(params, url="{}/files/{}/download".format(fake.api_url, file_id))
+                            results.append(_summarize(params, _spawn(case), fake))
+
+        if "manager" in suites:
+            for batch in args.manager_files.split(","):
+                count, size = batch.split("x")
+                count, size = int(count), parse_size(size)
+                file_ids = [fake.add_file("batch-{}.bin".format(i), size) for i in range(count)]
+                params = {"suite": "manager", "count": count, "size": size}
+                fake.reset_counters()
+                case = dict(params, api_url=fake.api_url, file_ids=file_ids)
+                results.append(_summarize(params, _spawn(case), fake))
+
+        if "asyncio" in suites:
+            for batch in args.manager_files.split(","):
+                count, size = batch.split("x")
+                count, size = int(count), parse_size(size)
+                batch_fake = FakePutio(bandwidth=fake.bandwidth, latency=args.latency,
+                                       failure_rate=args.failure_rate, redirect=not args.no_redirect,
+                                       api_failure_rate=args.api_failure_rate).start()
+                for i in range(count):
+                    batch_fake.add_file("batch-{}.bin".format(i), size)
+                params = {"suite": "asyncio", "count": count, "size": size}
+                case = dict(params, api_url=batch_fake.api_url)
+                results.append(_summarize(params, _spawn(case), batch_fake))
+                batch_fake.stop()
+
+        if "scan" in suites:
+            for tree in args.scan_trees.split(","):
+                directories, files = [int(v) for v in tree.split("x")]
+                scan_fake = FakePutio(latency=args.latency, api_failure_rate=args.api_failure_rate).start()
+                scan_fake.build_tree(directories, files, 1024)
+                params = {"suite": "scan", "directories": directories, "files_per_directory": files}
+                case = dict(params, api_url=scan_fake.api_url)
+                results.append(_summarize(params, _spawn(case), scan_fake))
+                scan_fake.stop()
+    finally:
+        fake.stop()
+
+    report = {
+        "putiosync_version": putiosync.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "server": {"bandwidth": args.bandwidth, "latency": args.latency,
+                   "failure_rate": args.failure_rate, "redirect": not args.no_redirect},
+        "results": results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,256 @@
+"""Load test the web interface and the Transmission RPC endpoint
+
+Starts the web interface in a separate process against a fake put.io server
+(see :mod:`fakeputio`), a synthetic download history and a synthetic
+download queue, then drives ``/download_queue``, ``/history/page/<n>`` and
+``/transmission/rpc`` from many concurrent clients.  Latency percentiles
+and throughput per route are reported as JSON::
+
+    $ python benchmarks/webif_load.py --history-rows 2000000 --clients 16
+    $ python benchmarks/webif_load.py --web-server waitress --web-threads 16
+
+Building a large history takes a while; ``--settings-dir`` keeps the
+database around so that later runs can reuse it.
+
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+sys.path.insert(0, HERE)
+
+# torrent-get fields requested by Sonarr/Radarr when polling
+TORRENT_FIELDS = ["id", "hashString", "name", "downloadDir", "status", "totalSize", "leftUntilDone",
+                  "isFinished", "eta", "errorString", "uploadedEver", "downloadedEver", "seedRatioLimit",
+                  "seedRatioMode", "seedIdleLimit", "seedIdleMode", "fileCount"]
+
+
+# -- server process ---------------------------------------------------------------
+
+def _populate_history(database_file, rows):
+    connection = sqlite3.connect(database_file)
+    (existing,) = connection.execute("SELECT count(*) FROM download_history").fetchone()
+    if existing < rows:
+        connection.executemany(
+            "INSERT INTO download_history (file_id, size, name) VALUES (?, ?, ?)",
+            ((i, random.randint(1, 4 * 1024 ** 3), "History/file-{}.mkv".format(i))
+             for i in range(existing + 1, rows + 1)))
+        connection.commit()
+    connection.close()
+
+
+def serve(args):
+    import putiopy
+    from fakeputio import FakePutio
+    from putiosync.core import DatabaseManager, DATABASE_FILE, PutioSynchronizer
+    from putiosync.download_manager import Download, DownloadManager
+    from putiosync.webif.webif import WebInterface
+
+    fake = FakePutio().start()
+    for i in range(args.transfers):
+        file_id = fake.add_file("transfer-{}.mkv".format(i), 1024 ** 3)
+        fake.add_transfer("transfer-{}.mkv".format(i), file_id, size=1024 ** 3,
+                          status="COMPLETED" if i % 4 else "DOWNLOADING")
+    putiopy.BASE_URL = fake.api_url
+
+    db_manager = DatabaseManager()
+    db_manager.get_db_session()
+    _populate_history(DATABASE_FILE, args.history_rows)
+
+    # the download manager is not started so the queue stays put
+    download_manager = DownloadManager(token="benchmark")
+    for i in range(args.queued):
+        download_manager.add_download(Download(10 ** 9 + i, "queued-{}.mkv".format(i), 1024 ** 3,
+                                               os.path.join(args.settings_dir, "downloads")))
+    putio_client = putiopy.Client("benchmark")
+    synchronizer = PutioSynchronizer(os.path.join(args.settings_dir, "downloads"), putio_client, db_manager,
+                                     download_manager, keep_files=True, disable_progress=True)
+    download_manager.get_stats().load_history_totals(db_manager.get_db_session())
+    web_interface = WebInterface(db_manager, download_manager, putio_client, synchronizer,
+                                 host="127.0.0.1", port=args.port, server=args.web_server,
+                                 threads=args.web_threads)
+    web_interface.run()
+
+
+# -- load generator -----------------------------------------------------------------
+
+class Route(object):
+    def __init__(self, name, weight, request):
+        self.name = name
+        self.weight = weight
+        self.request = request  # request(session, base_url) -> response
+
+
+def _rpc(method, arguments):
+    def request(session, base_url):
+        response = session.post(base_url + "/transmission/rpc",
+                                data=json.dumps({"method": method, "arguments": arguments}))
+        if response.status_code == 409:  # (re)negotiate the session id
+            session.headers["X-Transmission-Session-Id"] = response.headers["X-Transmission-Session-Id"]
+            response = session.post(base_url + "/transmission/rpc",
+                                    data=json.dumps({"method": method, "arguments": arguments}))
+        return response
+    return request
+
+
+def build_routes(history_pages):
+    return [
+        Route("download_queue", 4, lambda session, base_url: session.get(base_url + "/download_queue")),
+        Route("history", 1, lambda session, base_url: session.get(
+            "{}/history/page/{}".format(base_url, random.randint(1, history_pages)))),
+        Route("rpc torrent-get", 4, _rpc("torrent-get", {"fields": TORRENT_FIELDS})),
+        Route("rpc session-stats", 1, _rpc("session-stats", {})),
+    ]
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_load(base_url, routes, clients, duration):
+    import requests
+    latencies = dict((route.name, []) for route in routes)
+    errors = dict((route.name, 0) for route in routes)
+    lock = threading.Lock()
+    weighted = [route for route in routes for _ in range(route.weight)]
+    deadline = time.time() + duration
+
+    def client():
+        session = requests.Session()
+        while time.time() < deadline:
+            route = random.choice(weighted)
+            start = time.time()
+            try:
+                ok = route.request(session, base_url).status_code == 200
+            except requests.RequestException:
+                ok = False
+            elapsed = time.time() - start
+            with lock:
+                if ok:
+                    latencies[route.name].append(elapsed)
+                else:
+                    errors[route.name] += 1
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    results = {}
+    for route in routes:
+        values = sorted(latencies[route.name])
+        results[route.name] = {
+            "requests": len(values),
+            "errors": errors[route.name],
+            "requests_per_second": len(values) / float(duration),
+            "p50_ms": _ms(_percentile(values, 0.50)),
+            "p90_ms": _ms(_percentile(values, 0.90)),
+            "p99_ms": _ms(_percentile(values, 0.99)),
+            "max_ms": _ms(values[-1] if values else None),
+        }
+    return results
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _wait_for_server(port, process, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("web interface exited with status {}".format(process.returncode))
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except socket.error:
+            time.sleep(0.2)
+    raise RuntimeError("web interface did not start within {}s".format(timeout))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--web-server", default="flask", choices=["flask", "waitress"])
+    parser.add_argument("--web-threads", type=int, default=8)
+    parser.add_argument("--history-rows", type=int, default=1000000)
+    parser.add_argument("--queued", type=int, default=500, help="Number of downloads in the queue")
+    parser.add_argument("--transfers", type=int, default=500, help="Number of transfers on put.io")
+    parser.add_argument("--clients", type=int, default=8, help="Number of concurrent clients")
+    parser.add_argument("--duration", type=float, default=20.0, help="Seconds to apply load for")
+    parser.add_argument("--startup-timeout", type=float, default=600.0)
+    parser.add_argument("--settings-dir", default=None, help="Keep the synthetic database in this directory")
+    parser.add_argument("--output", default=None, help="Write results to this file instead of stdout")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, default=None, help=argparse.SUPPRESS)
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    if args.serve:
+        serve(args)
+        return 0
+
+    settings_dir = args.settings_dir or tempfile.mkdtemp(prefix="putiosync-webif-")
+    port = _free_port()
+    env = dict(os.environ, PUTIO_SYNC_SETTINGS_DIR=settings_dir)
+    command = [sys.executable, os.path.abspath(__file__), "--serve", "--port", str(port),
+               "--settings-dir", settings_dir, "--web-server", args.web_server,
+               "--web-threads", str(args.web_threads), "--history-rows", str(args.history_rows),
+               "--queued", str(args.queued), "--transfers", str(args.transfers)]
+    process = subprocess.Popen(command, env=env)
+    try:
+        _wait_for_server(port, process, args.startup_timeout)
+        history_pages = max(1, args.history_rows // 100)
+        results = run_load("http://127.0.0.1:{}".format(port), build_routes(history_pages),
+                           args.clients, args.duration)
+    finally:
+        process.terminate()
+        process.wait()
+        if args.settings_dir is None:
+            shutil.rmtree(settings_dir, ignore_errors=True)
+
+    report = {
+        "web_server": args.web_server,
+        "web_threads": args.web_threads,
+        "history_rows": args.history_rows,
+        "queued": args.queued,
+        "transfers": args.transfers,
+        "clients": args.clients,
+        "duration": args.duration,
+        "routes": results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
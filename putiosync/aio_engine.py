@@ -0,0 +1,482 @@
+"""Single event loop engine for crawling put.io and downloading files
+
+The default engine uses a thread for the synchronizer, the download manager,
+each segment of the active download and the deletion queue.  This engine
+does all of that on one asyncio event loop instead: the remote tree is
+listed with many requests in flight, files are downloaded as concurrent
+``Range`` requests whose data is written straight to the ``.part`` file and
+remote deletions are handed to the persistent :class:`DeletionQueue` (or,
+without one, sent in batches).  Concurrency is bounded explicitly by
+the number of listings, downloads and connections allowed at once rather
+than by the number of threads.
+
+It requires aiohttp (``pip install aiohttp``), which is imported lazily by
+the frontend when ``--engine asyncio`` is selected.  Staging, bundling,
+deduplication, archive extraction, the web interface and the torrent
+watcher are only available with the threaded engine.
+
+"""
+import asyncio
+import concurrent.futures
+import datetime
+import logging
+import os
+import random
+import time
+import aiohttp
+import putiopy
+from sqlalchemy import exists
+from putiosync import tracing
+from putiosync.api_client import (MAX_RETRIES, MAX_RETRY_DELAY, RETRIED_POSTS, RETRY_BACKOFF, count_call,
+                                  get_retry_after, get_endpoint)
+from putiosync.checkpoint import RangeCheckpoint
+from putiosync.dbmodel import DownloadRecord
+
+logger = logging.getLogger("putiosync")
+
+DIRECTORY_CONTENT_TYPE = "application/x-directory"
+LIST_PAGE_SIZE = 1000
+DELETE_BATCH_SIZE = 100
+DELETE_FLUSH_SECONDS = 2.0
+READ_CHUNK_SIZE = 1024 * 1024
+RETRY_BACKOFF_SECONDS = 1.0
+
+
+class AsyncAPIError(Exception):
+    """Raised when the put.io API returns an error"""
+
+    def __init__(self, status, error_type, error_message=None):
+        Exception.__init__(self, "{} {}: {}".format(status, error_type, error_message))
+        self.status = status
+        self.error_type = error_type
+
+
+class AsyncPutioClient(object):
+    """Minimal put.io API client for use on an event loop
+
+    At most ``max_api_calls`` API requests are in flight at once.  Failed
+    requests are retried and counted as with :class:`PutioClient`.
+
+    """
+
+    def __init__(self, session, token, max_api_calls=8, max_retries=MAX_RETRIES):
+        self._session = session
+        self._token = token
+        self._api_calls = asyncio.Semaphore(max_api_calls)
+        self._max_retries = max_retries
+        self._paused_until = 0.0  # set when put.io rate limits us
+
+    async def request(self, path, method="GET", params=None, data=None):
+        params = dict(params or {}, oauth_token=self._token)
+        endpoint = get_endpoint(path)
+        retry = method == "GET" or endpoint in RETRIED_POSTS
+        attempt = 0
+        while True:
+            retry_after = None
+            async with self._api_calls:
+                delay = self._paused_until - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                count_call(endpoint)
+                try:
+                    async with self._session.request(method, putiopy.BASE_URL + path, params=params,
+                                                     data=data) as response:
+                        try:
+                            payload = await response.json(content_type=None)
+                        except ValueError:
+                            payload = {}
+                        error = None
+                        if response.status >= 400:
+                            error = AsyncAPIError(response.status, payload.get("error_type", "UnknownError"),
+                                                  payload.get("error_message"))
+                        if response.status == 429 or response.status >= 500:
+                            retry_after = get_retry_after(response)
+                        elif error is not None:
+                            raise error
+                        else:
+                            return payload
+                except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                    error = ex
+            if not retry or attempt >= self._max_retries:
+                raise error
+            attempt += 1
+            if retry_after is None:
+                retry_after = RETRY_BACKOFF * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+            delay = min(retry_after, MAX_RETRY_DELAY)
+            if isinstance(error, AsyncAPIError) and error.status == 429:
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            logger.warning("put.io %s %s failed (%s); retry %d of %d in %.1fs",
+                           method, endpoint, error, attempt, self._max_retries, delay)
+            await asyncio.sleep(delay)
+
+    async def list_files(self, parent_id):
+        """Return every file in the directory with the provided id, following cursors"""
+        payload = await self.request("/files/list", params={"parent_id": parent_id, "per_page": LIST_PAGE_SIZE})
+        files = payload["files"]
+        while payload.get("cursor"):
+            payload = await self.request("/files/list/continue", method="POST",
+                                         data={"cursor": payload["cursor"], "per_page": LIST_PAGE_SIZE})
+            files.extend(payload["files"])
+        return files
+
+    async def delete_files(self, file_ids):
+        await self.request("/files/delete", method="POST",
+                           data={"file_ids": ",".join(str(file_id) for file_id in file_ids)})
+
+
+class AsyncSyncEngine(object):
+    """Crawl put.io and download new files using a single event loop
+
+    ``max_listings`` bounds the directory listings in flight while crawling,
+    ``max_downloads`` the number of files downloaded at once and
+    ``max_connections`` the number of data connections across all of them.
+    Each file is split into segments of ``segment_size_bytes`` of which up to
+    ``segments_per_file`` are fetched at once.
+
+    ``post_process_command`` is formatted with the path of each completed
+    download and run in a shell, as with the threaded engine.  Downloads are
+    throttled by ``rate_limiter`` (a :class:`TokenBucket`) if provided, and
+    remote deletions are persisted to ``deletion_queue`` if provided.
+
+    """
+
+    def __init__(self, token, download_directory, db_manager, keep_files=False, poll_frequency=60,
+                 download_filter=None, force_keep=None, max_listings=8, max_downloads=4, max_connections=16,
+                 segments_per_file=4, segment_size_bytes=64 * 1024 * 1024, max_attempts=3,
+                 post_process_command=None, rate_limiter=None, deletion_queue=None):
+        self._token = token
+        self._download_directory = download_directory
+        self._db_manager = db_manager
+        self._keep_files = keep_files
+        self._poll_frequency = poll_frequency
+        self.download_filter = download_filter
+        self.force_keep = force_keep
+        self._max_listings = max_listings
+        self._max_downloads = max_downloads
+        self._max_connections = max_connections
+        self._segments_per_file = segments_per_file
+        self._segment_size_bytes = segment_size_bytes
+        self._max_attempts = max_attempts
+        self._post_process_command = post_process_command
+        self._rate_limiter = rate_limiter
+        self._deletion_queue = deletion_queue
+
+        self._client = None
+        self._session = None
+        self._queue = None
+        self._connections = None
+        self._queued_file_ids = set()
+        self._db_executor = None
+        self._check_errors = 0  # directories skipped by the current check
+        self._pending_deletions = []
+        self._deletions_flushed = None
+
+        self.session_files_completed = 0
+        self.session_files_failed = 0
+        self.session_downloaded_bytes = 0
+
+    # -- entry points ---------------------------------------------------------
+
+    def sync_once(self):
+        """Check put.io once and download everything found
+
+        Returns True if the check of the remote files completed without errors.
+
+        """
+        return asyncio.run(self._run(once=True))
+
+    def run_forever(self):
+        """Run the engine until killed"""
+        logger.warn("Starting main application (asyncio engine)")
+        asyncio.run(self._run(once=False))
+
+    async def _run(self, once):
+        connector = aiohttp.TCPConnector(limit=self._max_connections + self._max_listings)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            self._session = session
+            self._client = AsyncPutioClient(session, self._token, max_api_calls=self._max_listings)
+            self._queue = asyncio.Queue()
+            self._connections = asyncio.Semaphore(self._max_connections)
+            self._deletions_flushed = asyncio.Event()
+            # database queries and commits block, so they run on one thread (with its own session)
+            self._db_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                                                                      thread_name_prefix="AsyncSyncEngine DB")
+            workers = [asyncio.ensure_future(self._download_worker()) for _ in range(self._max_downloads)]
+            deleter = asyncio.ensure_future(self._deletion_worker())
+            try:
+                if once:
+                    success = await self._perform_single_check()
+                    await self._queue.join()
+                    await self._flush_deletions()
+                    if self._deletion_queue is not None:
+                        await self._run_db(self._deletion_queue.drain)
+                    return success
+                while True:
+                    last_check = time.time()
+                    await self._perform_single_check()
+                    await asyncio.sleep(max(0, self._poll_frequency - (time.time() - last_check)))
+            finally:
+                for task in workers + [deleter]:
+                    task.cancel()
+                await asyncio.gather(*workers + [deleter], return_exceptions=True)
+                await self._run_db(self._db_manager.remove_db_session)
+                self._db_executor.shutdown()
+
+    # -- crawling -------------------------------------------------------------
+
+    def _should_delete(self, full_path):
+        return not self._keep_files and (self.force_keep is None or self.force_keep.match(full_path) is None)
+
+    async def _run_db(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(self._db_executor, func, *args)
+
+    def _get_downloaded_file_ids(self, file_ids):
+        downloaded = set()
+        session = self._db_manager.get_db_session()
+        for i in range(0, len(file_ids), 500):  # stay well below sqlite's bound parameter limit
+            chunk = file_ids[i:i + 500]
+            downloaded.update(file_id for (file_id,) in
+                              session.query(DownloadRecord.file_id).filter(DownloadRecord.file_id.in_(chunk)))
+        return downloaded
+
+    async def _list(self, file_id):
+        with tracing.span("list", file_id=file_id) as span:
+            children = await self._client.list_files(file_id)
+            span.set(children=len(children))
+        return children
+
+    async def _perform_single_check(self):
+        """Crawl the remote tree and queue new files; returns False if any part of the check failed"""
+        self._check_errors = 0
+        try:
+            await self._crawl_children(await self._list(0), "", None)
+        except Exception as ex:
+            logger.error("Unexpected error while performing check/download: {}".format(ex))
+            return False
+        return self._check_errors == 0
+
+    async def _crawl_children(self, children, relpath, root_id):
+        files = [child for child in children if child["content_type"] != DIRECTORY_CONTENT_TYPE]
+        downloaded_file_ids = await self._run_db(self._get_downloaded_file_ids, [child["id"] for child in files])
+        for child in files:
+            self._consider_file(child, relpath, child["id"] if root_id is None else root_id,
+                                child["id"] in downloaded_file_ids)
+        await asyncio.gather(*[self._crawl_directory(child, relpath, child["id"] if root_id is None else root_id)
+                               for child in children if child["content_type"] == DIRECTORY_CONTENT_TYPE])
+
+    async def _crawl_directory(self, directory, relpath, root_id):
+        full_path = (os.path.sep + os.path.join(relpath, directory["name"])).replace("\\", "/")
+        if self.download_filter is not None and not self.download_filter.could_match_below(full_path):
+            logger.debug("Skipping '{0}' because nothing in it can match the provided filter".format(full_path))
+            return
+        try:
+            children = await self._list(directory["id"])
+        except Exception as ex:
+            # the directory is skipped until the next check rather than abandoning the whole check
+            self._check_errors += 1
+            logger.error("Error while listing '{}' (skipped until the next check): {}".format(full_path, ex))
+            return
+        if not children:
+            # this is a directory with no children, it must be destroyed
+            if self.force_keep is None or self.force_keep.match(full_path) is None:
+                self._delete_remote(directory["id"], directory["name"])
+            return
+        await self._crawl_children(children, os.path.join(relpath, directory["name"]), root_id)
+
+    def _consider_file(self, putio_file, relpath, root_id, in_history):
+        full_path = (os.path.sep + os.path.join(relpath, putio_file["name"])).replace("\\", "/")
+        if self.download_filter is not None and not self.download_filter.matches(full_path):
+            logger.debug("Skipping '{0}' because it does not match the provided filter".format(full_path))
+            return
+        if putio_file["id"] in self._queued_file_ids:
+            logger.debug("Already queued: '{}'".format(putio_file["name"]))
+            return
+        dest = os.path.join(self._download_directory, relpath)
+        delete_after_download = self._should_delete(full_path)
+        if in_history or os.path.exists(os.path.join(dest, putio_file["name"])):
+            logger.debug("Already downloaded: '{}'".format(putio_file["name"]))
+            if delete_after_download:
+                self._delete_remote(putio_file["id"], putio_file["name"])
+            return
+        logger.debug("Adding download to queue: '{0}'".format(full_path))
+        self._queued_file_ids.add(putio_file["id"])
+        self._queue.put_nowait((putio_file["id"], putio_file["name"], putio_file["size"], dest,
+                                delete_after_download, putio_file.get("crc32"), root_id))
+
+    # -- downloading ----------------------------------------------------------
+
+    async def _download_worker(self):
+        while True:
+            item = await self._queue.get()
+            try:
+                await self._download(*item)
+            except Exception:
+                logger.exception("Unexpected error downloading %s", item[1])
+            finally:
+                self._queued_file_ids.discard(item[0])
+                self._queue.task_done()
+
+    async def _download(self, file_id, name, size, dest, delete_after_download, crc32, root_id):
+        if not os.path.exists(dest):
+            os.makedirs(dest)
+        destination_path = os.path.join(dest, name)
+        part_path = destination_path + ".part"
+        logger.info("Starting download {}".format(name))
+        for attempt in range(1, self._max_attempts + 1):
+            with tracing.span("download", file_id=file_id, size=size, attempt=attempt) as span:
+                try:
+                    await self._fetch(file_id, size, part_path)
+                    break
+                except (aiohttp.ClientError, asyncio.TimeoutError, IOError) as ex:
+                    span.set(ok=False)
+                    logger.warning("Download of %s failed (attempt %d of %d): %s", name, attempt,
+                                   self._max_attempts, ex)
+            await asyncio.sleep(RETRY_BACKOFF_SECONDS * attempt)
+        else:
+            self.session_files_failed += 1
+            logger.error("Giving up on %s", name)
+            return
+
+        os.rename(part_path, destination_path)
+        self.session_files_completed += 1
+        self.session_downloaded_bytes += size
+        await self._run_db(self._record_downloaded, file_id, name, size, crc32, destination_path)
+        logger.info("Download finished: {}".format(name))
+        if delete_after_download:
+            self._delete_remote(file_id, name)
+        if self._post_process_command is not None:
+            cmd = self._post_process_command.format(destination_path)
+            logger.info("Postprocess: {0}".format(cmd))
+            with tracing.span("postprocess", file_id=file_id):
+                process = await asyncio.create_subprocess_shell(cmd)
+                await process.wait()
+
+    async def _fetch(self, file_id, size, part_path):
+        url = putiopy.BASE_URL + "/files/{}/download".format(file_id)
+        checkpoint = RangeCheckpoint(part_path, size)
+        if checkpoint.load():
+            logger.info("Resuming %s with %d of %d bytes already downloaded", part_path, checkpoint.get_completed(),
+                        size)
+        fd = os.open(part_path, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            segments = []
+            for offset, length in checkpoint.get_missing():
+                end = offset + length
+                while offset < end:
+                    segments.append((offset, min(offset + self._segment_size_bytes, end) - 1))
+                    offset = segments[-1][1] + 1
+            if not checkpoint.get_ranges() and len(segments) <= 1:
+                await self._fetch_segment(url, fd, None, checkpoint)
+            else:
+                pending = iter(segments)
+
+                async def fetch_pending():
+                    for segment in pending:
+                        await self._fetch_segment(url, fd, segment, checkpoint)
+
+                tasks = [asyncio.ensure_future(fetch_pending())
+                         for _ in range(min(self._segments_per_file, len(segments)))]
+                try:
+                    await asyncio.gather(*tasks)
+                finally:
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+        except BaseException:
+            # failed, or cancelled on shutdown: keep what was written for the next attempt
+            try:
+                checkpoint.save(fd)
+            except (IOError, OSError) as e:
+                logger.error("Unable to checkpoint %s: %s", part_path, e)
+            raise
+        finally:
+            os.close(fd)
+        checkpoint.discard()
+
+    async def _fetch_segment(self, url, fd, segment, checkpoint):
+        """Stream a byte range (or the whole file) into ``fd`` at its offset"""
+        headers = {}
+        offset = 0
+        if segment is not None:
+            offset, end = segment
+            headers["Range"] = "bytes={}-{}".format(offset, end)
+        async with self._connections:
+            async with self._session.get(url, params={"oauth_token": self._token}, headers=headers) as response:
+                response.raise_for_status()
+                if segment is not None and response.status != 206:
+                    raise IOError("Server ignored range request for {}".format(url))
+                async for chunk in response.content.iter_chunked(READ_CHUNK_SIZE):
+                    # written inline: page cache writes are short and keep this a single thread
+                    written = 0
+                    while written < len(chunk):
+                        written += os.pwrite(fd, chunk[written:], offset + written)
+                    checkpoint.add(offset, len(chunk))
+                    offset += len(chunk)
+                    if self._rate_limiter is not None:
+                        delay = self._rate_limiter.reserve(len(chunk))
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+                    if checkpoint.is_due():
+                        # fsync off the event loop, saving only ranges written before it
+                        await asyncio.get_event_loop().run_in_executor(None, checkpoint.save, fd,
+                                                                       checkpoint.get_ranges())
+        if segment is not None and offset != segment[1] + 1:
+            raise IOError("Segment {}-{} of {} ended early".format(segment[0], segment[1], url))
+
+    def _record_downloaded(self, file_id, name, size, crc32, path):
+        with tracing.span("record", file_id=file_id):
+            session = self._db_manager.get_db_session()
+            if session.query(exists().where(DownloadRecord.file_id == file_id)).scalar():
+                logger.warn("File with id %r already marked as downloaded!", file_id)
+                return
+            session.add(DownloadRecord(file_id=file_id, size=size, timestamp=datetime.datetime.now(),
+                                       name=name, crc32=crc32, path=path, deduplicated=False))
+            session.commit()
+
+    # -- remote deletion ------------------------------------------------------
+
+    def _delete_remote(self, file_id, name):
+        """Remove the file with the provided id from put.io
+
+        When a deletion queue is available, the deletion is persisted to it
+        (on the database thread) and performed in the background; otherwise
+        it is sent along with others in a batch.
+
+        """
+        if self._deletion_queue is not None:
+            self._db_executor.submit(self._queue_deletion, file_id, name)
+            return
+        self._pending_deletions.append(file_id)
+        if len(self._pending_deletions) >= DELETE_BATCH_SIZE:
+            self._deletions_flushed.set()
+
+    def _queue_deletion(self, file_id, name):
+        # runs on the database thread
+        with tracing.span("delete", file_id=file_id, queued=True):
+            try:
+                self._deletion_queue.add(file_id, name)
+            except Exception as ex:
+                logger.error("Error queueing deletion of %s; it will be retried on the next check: %s", name, ex)
+
+    async def _deletion_worker(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._deletions_flushed.wait(), DELETE_FLUSH_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._deletions_flushed.clear()
+            await self._flush_deletions()
+
+    async def _flush_deletions(self):
+        while self._pending_deletions:
+            batch = self._pending_deletions[:DELETE_BATCH_SIZE]
+            del self._pending_deletions[:DELETE_BATCH_SIZE]
+            with tracing.span("delete", count=len(batch)):
+                try:
+                    await self._client.delete_files(batch)
+                except (AsyncAPIError, aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                    logger.error("Error deleting %d file(s); they will be retried on the next check: %s",
+                                 len(batch), ex)
+                    return
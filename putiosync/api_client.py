@@ -0,0 +1,198 @@
+"""put.io API client shared by every part of putio-sync
+
+:class:`PutioClient` is a ``putiopy.Client`` whose requests go through a
+pooled session with a timeout on every call.  Calls failing with a
+connection error, timeout, server error or rate limit (429) are retried
+with exponential backoff; a rate limit pauses every call made through the
+client until put.io's ``Retry-After`` has passed.  Only idempotent calls
+are retried: every ``GET`` and the ``POST`` endpoints listed in
+``RETRIED_POSTS`` (uploads and new transfers are left to their callers).
+
+Identical ``GET`` requests made concurrently (e.g. the same directory
+listed by the synchronizer and the transmission RPC server) are sent
+once, with every caller receiving its own copy of the response (unless
+it is the first page of a listing continued with a cursor).  Calls are
+counted by endpoint across all clients; see :func:`get_call_counts`.
+
+Use :func:`get_client` to share one client (and its connection pool) per
+token.
+
+"""
+import collections
+import copy
+import logging
+import random
+import re
+import threading
+import time
+import putiopy
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger("putiosync")
+
+REQUEST_TIMEOUT = 30  # seconds, for connecting and between bytes received
+MAX_RETRIES = 4
+RETRY_BACKOFF = 1.0  # seconds before the first retry, doubling for each one after
+MAX_RETRY_DELAY = 60
+POOL_SIZE = 16
+RETRIED_POSTS = ("/files/list/continue", "/files/delete", "/files/search/continue", "/zips/create")
+
+_call_counts = collections.Counter()
+_call_counts_lock = threading.Lock()
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(token):
+    """Return the :class:`PutioClient` shared by everything using ``token``"""
+    with _clients_lock:
+        try:
+            return _clients[token]
+        except KeyError:
+            client = _clients[token] = PutioClient(token)
+            return client
+
+
+def get_endpoint(path):
+    """Return the endpoint of a request path for counting, e.g. ``/files/{id}/download``"""
+    path = re.sub(r"^https?://[^/]+", "", path).split("?", 1)[0]
+    if path.startswith("/v2/"):
+        path = path[3:]
+    return re.sub(r"/\d+(?=/|$)", "/{id}", path)
+
+
+def get_call_counts():
+    """Return the number of requests (including retries) sent to each endpoint"""
+    with _call_counts_lock:
+        return dict(_call_counts)
+
+
+def count_call(endpoint):
+    """Count a request sent to ``endpoint``"""
+    with _call_counts_lock:
+        _call_counts[endpoint] += 1
+
+
+def get_retry_after(response):
+    """Return the seconds to wait from a response's ``Retry-After`` header, or None"""
+    try:
+        return max(0.0, float(response.headers.get("Retry-After")))
+    except (TypeError, ValueError):
+        return None
+
+
+class _PendingCall(object):
+    """A request whose response is shared by every concurrent caller"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class PutioClient(putiopy.Client):
+    """``putiopy.Client`` with pooling, timeouts, retries and rate limit handling
+
+    ``max_calls_per_second`` optionally throttles the calls made through
+    this client (a :class:`TokenBucket` of calls) to stay clear of put.io's
+    rate limits in the first place.
+
+    """
+
+    def __init__(self, access_token, timeout=REQUEST_TIMEOUT, max_retries=MAX_RETRIES, retry_backoff=RETRY_BACKOFF,
+                 pool_size=POOL_SIZE, max_calls_per_second=None):
+        putiopy.Client.__init__(self, access_token, timeout=timeout)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._max_retries = max_retries
+        self._retry_backoff = retry_backoff
+        self._throttle = None
+        if max_calls_per_second:
+            from putiosync.bandwidth import TokenBucket
+            self._throttle = TokenBucket(max_calls_per_second)
+        self._lock = threading.Lock()
+        self._pending = {}  # (path, params) -> _PendingCall
+        self._paused_until = 0.0  # set when put.io rate limits us
+
+    def request(self, path, method="GET", params=None, data=None, files=None, headers=None, raw=False,
+                allow_redirects=True, stream=False, timeout=None):
+        kwargs = dict(params=params, data=data, files=files, headers=headers, allow_redirects=allow_redirects,
+                      stream=stream, timeout=timeout)
+        retry = files is None and (method == "GET" or (method == "POST" and get_endpoint(path) in RETRIED_POSTS))
+        if method != "GET" or raw or stream or files is not None or headers:
+            return self._request(path, method, raw, retry, kwargs)
+
+        key = (path, tuple(sorted((str(k), str(v)) for k, v in (params or {}).items())))
+        with self._lock:
+            pending = self._pending.get(key)
+            leader = pending is None
+            if leader:
+                pending = self._pending[key] = _PendingCall()
+        if not leader:
+            pending.done.wait()
+            if pending.error is not None:
+                raise pending.error
+            if not pending.result.get("cursor"):
+                return copy.deepcopy(pending.result)  # putiopy extends the listings it receives
+            # the rest of a paginated listing is fetched with the cursor, which may only be usable once
+            return self._request(path, method, raw, retry, kwargs)
+        try:
+            pending.result = self._request(path, method, raw, retry, kwargs)
+            return copy.deepcopy(pending.result)
+        except Exception as e:
+            pending.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._pending[key]
+            pending.done.set()
+
+    def _wait_to_send(self):
+        with self._lock:
+            delay = self._paused_until - time.monotonic()
+        if self._throttle is not None:
+            delay = max(delay, self._throttle.reserve(1))
+        if delay > 0:
+            time.sleep(delay)
+
+    def _send(self, path, method, timeout=None, **kwargs):
+        headers = dict(kwargs.pop("headers") or {})
+        headers["Authorization"] = "token %s" % self.access_token
+        url = path if path.startswith(("http://", "https://")) else putiopy.BASE_URL + path
+        return self.session.request(method, url, headers=headers, timeout=timeout or self.timeout, **kwargs)
+
+    def _request(self, path, method, raw, retry, kwargs):
+        endpoint = get_endpoint(path)
+        attempt = 0
+        while True:
+            self._wait_to_send()
+            count_call(endpoint)
+            retry_after = None
+            try:
+                response = self._send(path, method, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if not retry or attempt >= self._max_retries:
+                    raise
+                reason = e
+            else:
+                if response.status_code != 429 and response.status_code < 500:
+                    return response if raw else putiopy._process_response(response)
+                if not retry or attempt >= self._max_retries:
+                    return response if raw else putiopy._process_response(response)  # raises the API error
+                reason = "HTTP {}".format(response.status_code)
+                retry_after = get_retry_after(response)
+                response.close()
+                if response.status_code == 429:
+                    retry_after = retry_after if retry_after is not None else self._retry_backoff * 2 ** attempt
+                    with self._lock:
+                        self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            attempt += 1
+            delay = retry_after
+            if delay is None:
+                delay = self._retry_backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+            delay = min(delay, MAX_RETRY_DELAY)
+            logger.warning("put.io %s %s failed (%s); retry %d of %d in %.1fs",
+                           method, endpoint, reason, attempt, self._max_retries, delay)
+            time.sleep(delay)
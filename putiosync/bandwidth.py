@@ -0,0 +1,47 @@
+"""Global bandwidth limiting
+
+A single :class:`TokenBucket` is shared by everything that downloads data
+so that the limit applies to the process as a whole, however many
+downloads, segments and profiles are active.
+
+"""
+import threading
+import time
+
+
+class TokenBucket(object):
+    """Limit throughput to ``rate`` bytes per second across threads
+
+    Up to ``burst`` bytes (one second's worth by default) may be taken at
+    once after a quiet period.
+
+    """
+
+    def __init__(self, rate, burst=None):
+        self._rate = float(rate)
+        self._burst = float(burst if burst is not None else rate)
+        self._tokens = self._burst
+        self._time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def get_rate(self):
+        return self._rate
+
+    def reserve(self, nbytes):
+        """Take ``nbytes`` from the bucket, returning how long to wait before using them
+
+        This does not block, so it may also be used from an event loop.
+
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._time) * self._rate)
+            self._time = now
+            self._tokens -= nbytes
+            return max(0.0, -self._tokens / self._rate)
+
+    def consume(self, nbytes):
+        """Take ``nbytes`` from the bucket, sleeping until they are available"""
+        delay = self.reserve(nbytes)
+        if delay > 0:
+            time.sleep(delay)
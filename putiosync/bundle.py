@@ -0,0 +1,138 @@
+"""Download many small files as a single zip created by put.io
+
+Each download has a fixed cost (API requests, connection setup, database
+updates) that dominates for small files such as subtitles or artwork.
+Small files from a directory are instead downloaded together: put.io is
+asked to create a zip of them, which is extracted as it is downloaded.
+
+"""
+import datetime
+import logging
+import os
+import shutil
+import time
+import putiopy
+import requests
+from putiosync import tracing
+from putiosync.api_client import get_client
+from putiosync.download_manager import Download, ACTIVE, DONE, FAILED
+from putiosync.extract import StreamingZipExtractor, ExtractionError
+
+logger = logging.getLogger("putiosync")
+
+ZIP_POLL_INTERVAL = 2
+ZIP_READY_TIMEOUT = 600
+REQUEST_TIMEOUT = 30
+CHUNK_SIZE = 1024 * 1024
+
+
+class BundleError(Exception):
+    """put.io was unable to provide the bundle"""
+
+
+class BundleDownload(Download):
+    """Download of several files from one directory through a put.io zip
+
+    ``members`` are the downloads for the individual files; they are not
+    queued themselves.  Each one is finished (firing its completion
+    callbacks) once its file has been extracted into place.  Bundles are not
+    persisted by the download journal; members that were not downloaded
+    before a restart are bundled again by the next check.
+
+    """
+    __slots__ = ("_members",)
+
+    journaled = False
+
+    def __init__(self, members, destination_path, root_id=None):
+        Download.__init__(self, -members[0].get_file_id(),
+                          "{} small files in {}".format(len(members), os.path.basename(destination_path) or "/"),
+                          sum(member.get_size() for member in members),
+                          destination_path, root_id=root_id, profile=members[0].get_profile(),
+                          parent_ids=members[0].get_parent_ids())
+        self._members = members
+
+    def get_file_ids(self):
+        return [member.get_file_id() for member in self._members]
+
+    def get_members(self):
+        return list(self._members)
+
+    def get_part_path(self, staging_directory=None):
+        # the archive is extracted as it is received; this is where it is extracted to
+        return os.path.join(self.get_destination_directory(), ".putiosync-bundle-{}".format(-self._file_id))
+
+    def _request_zip(self, token):
+        client = get_client(token)
+        zip_id = client.request("/zips/create", method="POST",
+                                data={"file_ids": ",".join(str(file_id) for file_id in self.get_file_ids())})["zip_id"]
+
+        deadline = time.time() + ZIP_READY_TIMEOUT
+        while time.time() < deadline:
+            info = client.request("/zips/{}".format(zip_id))
+            info = info.get("zip", info)
+            if info.get("url"):
+                if info.get("missing_files"):
+                    logger.warning("put.io left %d file(s) out of %s", len(info["missing_files"]), self._name)
+                return info["url"]
+            time.sleep(ZIP_POLL_INTERVAL)
+        raise BundleError("zip {} was not ready after {}s".format(zip_id, ZIP_READY_TIMEOUT))
+
+    def _download_zip(self, url, extraction_directory, rate_limiter=None):
+        """Download and extract the zip, returning extracted files by name"""
+        extractor = StreamingZipExtractor(extraction_directory)
+        response = requests.get(url, stream=True, timeout=REQUEST_TIMEOUT)
+        try:
+            response.raise_for_status()
+            for chunk in response.iter_content(CHUNK_SIZE):
+                if rate_limiter is not None:
+                    rate_limiter.consume(len(chunk))
+                extractor.feed(chunk)
+                self._downloaded += len(chunk)
+                self._fire_progress_callbacks()
+        finally:
+            response.close()
+        extractor.close()
+        return dict((os.path.basename(path), path) for path in extractor.get_extracted_paths()
+                    if os.path.isfile(path))
+
+    def perform_download(self, token, staging_directory=None, preallocate=False, extract_archives=False,
+                         engine=None, stop_event=None, connections=4, rate_limiter=None):
+        """Download the bundle, finishing each member that was extracted; returns True on success
+
+        Bundles are small and are not checkpointed, so ``stop_event`` is not
+        checked; an interrupted bundle is requested again on the next check.
+
+        """
+        self._attempts += 1
+        self._start_datetime = datetime.datetime.now()
+        self._set_state(ACTIVE)
+        self._fire_start_callbacks()
+        extraction_directory = self.get_part_path()
+        with tracing.span("bundle", files=len(self._members), size=self._size) as span:
+            try:
+                extracted = self._download_zip(self._request_zip(token), extraction_directory, rate_limiter)
+                finished = []
+                for member in self._members:
+                    path = extracted.get(member.get_filename())
+                    if path is not None:
+                        os.replace(path, member.get_destination_path())
+                        finished.append(member)
+            except (requests.RequestException, putiopy.APIError, ValueError, KeyError, BundleError,
+                    ExtractionError, IOError, OSError) as e:
+                logger.error("Unable to download %s: %s", self._name, e)
+                self._set_state(FAILED)
+                return False
+            finally:
+                shutil.rmtree(extraction_directory, ignore_errors=True)
+            span.set(finished=len(finished))
+
+        for member in finished:
+            member.set_listener(self._listener)
+            member.finish()
+        if len(finished) < len(self._members):
+            logger.warning("%d file(s) of %s were not in the zip; they will be retried by the next check",
+                           len(self._members) - len(finished), self._name)
+        self._finish_datetime = datetime.datetime.now()
+        self._set_state(DONE)
+        return True
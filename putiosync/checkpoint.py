@@ -0,0 +1,135 @@
+"""Checkpoints of the byte ranges written to ``.part`` files
+
+Segments of a download are written in parallel, so a partially downloaded
+file is not simply a prefix of the real one.  A :class:`RangeCheckpoint`
+tracks which ranges of the ``.part`` file have been written and saves them
+to a ``.ranges`` file next to it.  The data is fsynced before the ranges
+are saved, so a saved checkpoint never claims bytes that could be lost.
+A download that is interrupted (by a shutdown, crash or failed segment)
+then only fetches the missing ranges when it is attempted again.
+
+"""
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger("putiosync")
+
+CHECKPOINT_SUFFIX = ".ranges"
+CHECKPOINT_INTERVAL_SECONDS = 5.0
+
+
+class RangeCheckpoint(object):
+    """Track the ranges written to the ``.part`` file at ``part_path``"""
+
+    def __init__(self, part_path, size, interval=CHECKPOINT_INTERVAL_SECONDS):
+        self._part_path = part_path
+        self._path = part_path + CHECKPOINT_SUFFIX
+        self._size = size
+        self._interval = interval
+        self._starts = []  # sorted, non-overlapping [start, end) ranges
+        self._ends = []
+        self._last_save = time.time()
+
+    def get_path(self):
+        return self._path
+
+    def load(self):
+        """Load the ranges saved by an earlier attempt; returns the number of bytes already written
+
+        Saved ranges are ignored (and removed) if they are for a file of a
+        different size or extend past the end of the ``.part`` file.
+
+        """
+        self._starts, self._ends = [], []
+        try:
+            with open(self._path) as f:
+                saved = json.load(f)
+            ranges = saved["ranges"]
+            if (saved["size"] != self._size or not os.path.exists(self._part_path) or
+                    os.path.getsize(self._part_path) < max([end for _start, end in ranges] or [0])):
+                raise ValueError("checkpoint does not match {}".format(self._part_path))
+            for start, end in ranges:
+                self.add(start, end - start)
+        except (IOError, OSError):
+            pass  # nothing saved
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning("Ignoring checkpoint %s: %s", self._path, e)
+            self._starts, self._ends = [], []
+            self.discard()
+        return self.get_completed()
+
+    def add(self, offset, length):
+        """Record that ``length`` bytes were written at ``offset``"""
+        if length <= 0:
+            return
+        start, end = offset, offset + length
+        # merge with every range that overlaps or touches this one
+        first = bisect.bisect_left(self._ends, start)
+        last = bisect.bisect_right(self._starts, end)
+        if first < last:
+            start = min(start, self._starts[first])
+            end = max(end, self._ends[last - 1])
+        self._starts[first:last] = [start]
+        self._ends[first:last] = [end]
+
+    def get_completed(self):
+        """Return the number of bytes written"""
+        return sum(end - start for start, end in zip(self._starts, self._ends))
+
+    def get_ranges(self):
+        """Return the written ranges as ``(offset, length)`` tuples"""
+        return [(start, end - start) for start, end in zip(self._starts, self._ends)]
+
+    def get_missing(self):
+        """Return the ranges still to be written as ``(offset, length)`` tuples"""
+        missing = []
+        pos = 0
+        for start, end in zip(self._starts, self._ends):
+            if start > pos:
+                missing.append((pos, start - pos))
+            pos = max(pos, end)
+        if pos < self._size:
+            missing.append((pos, self._size - pos))
+        return missing
+
+    def save(self, fd, ranges=None):
+        """Flush the data written through file descriptor ``fd`` to disk and save the ranges
+
+        ``ranges`` may be a snapshot from :meth:`get_ranges` for saving from
+        another thread while more ranges are being added.
+
+        """
+        if ranges is None:
+            ranges = self.get_ranges()
+        self._last_save = time.time()
+        os.fsync(fd)
+        tmp_path = "{}.{}.tmp".format(self._path, threading.current_thread().ident)
+        with open(tmp_path, "w") as f:
+            json.dump({"size": self._size, "ranges": [(offset, offset + length) for offset, length in ranges]}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._path)
+
+    def is_due(self):
+        """Return True if the checkpoint interval has passed, restarting the interval"""
+        now = time.time()
+        if now - self._last_save < self._interval:
+            return False
+        self._last_save = now
+        return True
+
+    def maybe_save(self, fd):
+        """Save the ranges if the last save was at least the checkpoint interval ago"""
+        if self.is_due():
+            self.save(fd)
+
+    def discard(self):
+        """Remove any saved ranges (e.g. once the download is complete)"""
+        try:
+            os.remove(self._path)
+        except OSError:
+            pass
@@ -6,11 +6,12 @@
 import json
 import datetime
 import logging
+import threading
 import traceback
-import progressbar
-from putiosync.dbmodel import DBModelBase, DownloadRecord
+from putiosync import dedup, tracing
+from putiosync.dbmodel import DBModelBase, DownloadRecord, upgrade_schema
+from putiosync.bundle import BundleDownload
 from putiosync.download_manager import Download
-import webbrowser
 import time
 import os
 import sys
@@ -21,6 +22,9 @@ from os import environ
 
 logger = logging.getLogger("putiosync")
 
+BUNDLE_MAX_FILES = 500  # files per put.io zip
+RESTORED_MAX_ATTEMPTS = 5  # restored downloads may be for files that no longer exist
+
 
 CLIENT_ID = 1067
 if environ.get('PUTIO_SYNC_SETTINGS_DIR') is not None:
@@ -35,23 +39,44 @@ CHECK_PERIOD_SECONDS = 10
 
 
 class DatabaseManager(object):
+    """Provide sessions for the database in the settings directory
+
+    Connecting and creating any missing tables is deferred until a session
+    is first requested so that it does not hold up startup.
+
+    """
 
     def __init__(self):
         self._db_engine = None
         self._scoped_session = None
-        self._ensure_database_exists()
+        self._init_lock = threading.Lock()
 
     def _ensure_database_exists(self):
         if not os.path.exists(SETTINGS_DIR):
             os.makedirs(SETTINGS_DIR)
         self._db_engine = create_engine("sqlite:///{}".format(DATABASE_FILE))
         self._db_engine.connect()
-        self._scoped_session = scoped_session(sessionmaker(self._db_engine))
         DBModelBase.metadata.create_all(self._db_engine)
+        upgrade_schema(self._db_engine)
+        self._scoped_session = scoped_session(sessionmaker(self._db_engine))
 
     def get_db_session(self):
+        if self._scoped_session is None:
+            with self._init_lock:
+                if self._scoped_session is None:
+                    self._ensure_database_exists()
         return self._scoped_session()
 
+    def get_scoped_session(self):
+        """Return the thread-local session registry (for frameworks that manage sessions)"""
+        self.get_db_session()
+        return self._scoped_session
+
+    def remove_db_session(self):
+        """Close the calling thread's session, if it has one"""
+        if self._scoped_session is not None:
+            self._scoped_session.remove()
+
 
 class TokenManager(object):
     """Object responsible for providing access to API token"""
@@ -82,6 +107,7 @@ class TokenManager(object):
         """
         apptoken_url = "https://app.put.io/authenticate?client_id={}&response_type=oob".format(CLIENT_ID)
         print("Opening {}".format(apptoken_url))
+        import webbrowser
         webbrowser.open(apptoken_url)
         if sys.version[0]=="2":
             input_sock=raw_input
@@ -92,24 +118,55 @@ class TokenManager(object):
 
 
 class PutioSynchronizer(object):
-    """Object encapsulating core synchronization logic and state"""
+    """Object encapsulating core synchronization logic and state
+
+    When several synchronizers share a download manager, each is given the
+    :class:`Profile` it synchronizes; its downloads are tagged with it and
+    only the profile's remote root folder is synchronized.
+
+    """
 
     def __init__(self, download_directory, putio_client, db_manager, download_manager, keep_files=False, poll_frequency=60,
-                 download_filter=None, force_keep=None, disable_progress=False):
+                 download_filter=None, force_keep=None, disable_progress=False, deletion_queue=None, dedupe=None,
+                 bundle_min_files=None, bundle_max_file_size=1024 * 1024, profile=None):
+        self._profile = profile
+        self._profile_name = profile.name if profile is not None else None
+        self._remote_root = profile.remote_root if profile is not None else 0
         self._putio_client = putio_client
         self._download_directory = download_directory
         self._db_manager = db_manager
         self._poll_frequency = poll_frequency
         self._keep_files = keep_files
         self._download_manager = download_manager
-        # This regex is already compiled
+        self._deletion_queue = deletion_queue
+        # None, dedup.REFLINK or dedup.HARDLINK (which falls back from a reflink to a hard link)
+        self._dedupe = dedupe
+        # directories with at least this many small files have them downloaded as one zip
+        self._bundle_min_files = bundle_min_files
+        self._bundle_max_file_size = bundle_max_file_size
+        # PathFilter deciding which files are downloaded and which directories are listed
         self.download_filter = download_filter
         self.force_keep = force_keep
         self.disable_progress = disable_progress
+        self._progress_bar = None
+        self._remote_relpaths = {}  # remote directory id -> path relative to root
+        self._check_errors = 0  # files and directories skipped by the current check
+        self._restored_file_ids = set()  # restored downloads not yet seen by a full check
+        self._seen_file_ids = None  # files found by the current check while there are restored downloads
+        # bound once and shared by every download
+        self._start_callback = self._on_download_started
+        self._progress_callback = self._on_download_progress
+        self._completion_callback = self._on_download_completed
 
     def get_download_directory(self):
         return self._download_directory
 
+    def get_profile(self):
+        return self._profile
+
+    def get_download_manager(self):
+        return self._download_manager
+
     def _is_directory(self, putio_file):
         return (putio_file.content_type == 'application/x-directory')
 
@@ -117,123 +174,346 @@ class PutioSynchronizer(object):
         filename = putio_file.name
         logger.warn("File name check: %r", filename)
 
-        if os.path.exists(os.path.join(dest, filename)):
-            return True  # TODO: check size and/or crc32 checksum?
-        matching_rec_exists = self._db_manager.get_db_session().query(exists().where(DownloadRecord.file_id == putio_file.id)).scalar()
+        with tracing.span("exists_check", file_id=putio_file.id):
+            if os.path.exists(os.path.join(dest, filename)):
+                return True  # TODO: check size and/or crc32 checksum?
+        with tracing.span("history_check", file_id=putio_file.id):
+            matching_rec_exists = self._db_manager.get_db_session().query(exists().where(DownloadRecord.file_id == putio_file.id)).scalar()
         return matching_rec_exists
 
-    def is_already_downloaded(self, putio_file):
-        return self._already_downloaded(putio_file, self._download_directory)
+    def is_already_downloaded(self, transfer, downloaded_file_ids=None):
+        """Return True if the output of the provided transfer has been downloaded
 
-    def _record_downloaded(self, putio_file):
-        filename = putio_file.name
-        matching_rec_exists = self._db_manager.get_db_session().query(exists().where(DownloadRecord.file_id == putio_file.id)).scalar()
-        if not matching_rec_exists:
-            download_record = DownloadRecord(
-                file_id=putio_file.id,
-                size=putio_file.size,
-                timestamp=datetime.datetime.now(),
-                name=filename)
-            self._db_manager.get_db_session().add(download_record)
-            self._db_manager.get_db_session().commit()
-        else:
-            logger.warn("File with id %r already marked as downloaded!", putio_file.id)
+        ``downloaded_file_ids`` may be provided (see :meth:`get_downloaded_file_ids`)
+        when checking many transfers to avoid a database query for each.
+
+        """
+        if os.path.exists(os.path.join(self._download_directory, transfer.name)):
+            return True
+        if downloaded_file_ids is None:
+            downloaded_file_ids = self.get_downloaded_file_ids([transfer.file_id])
+        return transfer.file_id in downloaded_file_ids
+
+    def get_downloaded_file_ids(self, file_ids):
+        """Return the subset of the provided put.io file ids found in the download history"""
+        file_ids = [file_id for file_id in file_ids if file_id is not None]
+        downloaded = set()
+        session = self._db_manager.get_db_session()
+        for i in range(0, len(file_ids), 500):  # stay well below sqlite's bound parameter limit
+            chunk = file_ids[i:i + 500]
+            downloaded.update(file_id for (file_id,) in
+                              session.query(DownloadRecord.file_id).filter(DownloadRecord.file_id.in_(chunk)))
+        return downloaded
+
+    def _record_downloaded(self, download):
+        file_id = download.get_file_id()
+        with tracing.span("record", file_id=file_id):
+            matching_rec_exists = self._db_manager.get_db_session().query(exists().where(DownloadRecord.file_id == file_id)).scalar()
+            if not matching_rec_exists:
+                download_record = DownloadRecord(
+                    file_id=file_id,
+                    size=download.get_size(),
+                    timestamp=datetime.datetime.now(),
+                    name=download.get_name(),
+                    crc32=download.get_crc32(),
+                    path=download.get_destination_path(),
+                    deduplicated=download.is_deduplicated())
+                self._db_manager.get_db_session().add(download_record)
+                self._db_manager.get_db_session().commit()
+            else:
+                logger.warn("File with id %r already marked as downloaded!", file_id)
+
+    def _delete_remote(self, file_id, name):
+        """Remove the file with the provided id from put.io
+
+        When a deletion queue is available, the deletion is handed off to it and
+        performed in the background; otherwise the file is deleted right away.
+
+        """
+        with tracing.span("delete", file_id=file_id, queued=self._deletion_queue is not None):
+            if self._deletion_queue is not None:
+                self._deletion_queue.add(file_id, name, profile=self._profile_name)
+            else:
+                self._putio_client.File.delete_multi([file_id])
+
+    def _on_download_started(self, download):
+        logger.info("Starting download {}".format(download.get_name()))
+        if not self.disable_progress:
+            import progressbar  # only needed when progress is shown
+            widgets = [
+                progressbar.Percentage(), ' ',
+                progressbar.Bar(), ' ',
+                progressbar.ETA(), ' ',
+                progressbar.FileTransferSpeed()]
+            self._progress_bar = progressbar.ProgressBar(widgets=widgets, maxval=download.get_size())
+            self._progress_bar.start()
+
+    def _on_download_progress(self, download):
+        try:
+            self._progress_bar.update(download.get_downloaded())
+        except AssertionError:
+            pass  # ignore, has happened
+
+    def _on_download_completed(self, download):
+        # and write a record of the download to the database
+        self._record_downloaded(download)
+        logger.info("Download finished: {}".format(download.get_name()))
+        if download.get_delete_after_download():
+            try:
+                self._delete_remote(download.get_file_id(), download.get_name())
+            except:
+                logger.error("Error deleting file {}. Assuming all is well but may require manual cleanup".format(download.get_name()))
+                traceback.print_exc()
+
+    def _link_local_copy(self, download):
+        """Complete the download by linking an identical local file, if there is one"""
+        if self._dedupe is None or download.get_crc32() is None:
+            return False
+        with tracing.span("dedupe", file_id=download.get_file_id()) as span:
+            for path in dedup.find_local_copies(self._db_manager.get_db_session(), download.get_size(),
+                                                download.get_crc32()):
+                method = dedup.link_file(path, download.get_destination_path(),
+                                         allow_hardlink=(self._dedupe == dedup.HARDLINK))
+                if method is not None:
+                    span.set(method=method)
+                    logger.info("Linked %s from identical local copy %s (%s)", download.get_name(), path, method)
+                    download.set_deduplicated(True)
+                    self._download_manager.add_completed_download(download)
+                    return True
+        return False
+
+    def _build_download(self, putio_file, dest, delete_after_download, root_id, parent_ids=None):
+        download = Download.from_putio_file(putio_file, dest, delete_after_download=delete_after_download,
+                                            root_id=root_id, profile=self._profile, parent_ids=parent_ids)
+        download.add_start_callback(self._start_callback)
+        if self.disable_progress is False:
+            download.add_progress_callback(self._progress_callback)
+        download.add_completion_callback(self._completion_callback)
+        return download
+
+    def _should_delete(self, full_path):
+        return not self._keep_files and (self.force_keep is None or self.force_keep.match(full_path) is None)
+
+    def _queue_bundles(self, children, relpath, root_id, parent_ids=None):
+        """Queue small files among ``children`` to be downloaded together
+
+        Returns the children that still need to be queued individually.
 
-    def _do_queue_download(self, putio_file, dest, delete_after_download=False):
+        """
+        target_dir = os.path.join(self._download_directory, relpath)
+        candidates = []
+        for child in children:
+            if self._is_directory(child) or child.size > self._bundle_max_file_size:
+                continue
+            full_path = (os.path.sep + os.path.join(relpath, child.name)).replace("\\", "/")
+            if self.download_filter is not None and not self.download_filter.matches(full_path):
+                continue
+            if self._download_manager.is_queued(child.id) or os.path.exists(os.path.join(target_dir, child.name)):
+                continue  # left to the usual checks
+            candidates.append((child, full_path))
+        if len(candidates) >= self._bundle_min_files:
+            downloaded_file_ids = self.get_downloaded_file_ids([child.id for child, _ in candidates])
+            candidates = [(child, full_path) for child, full_path in candidates
+                          if child.id not in downloaded_file_ids]
+        if len(candidates) < self._bundle_min_files:
+            return children
+
+        if not os.path.exists(target_dir):
+            os.makedirs(target_dir)
+        bundled_file_ids = set()
+        for i in range(0, len(candidates), BUNDLE_MAX_FILES):
+            members = [self._build_download(child, target_dir, self._should_delete(full_path), root_id, parent_ids)
+                       for child, full_path in candidates[i:i + BUNDLE_MAX_FILES]]
+            bundle = BundleDownload(members, target_dir, root_id=root_id)
+            if self._download_manager.add_download(bundle):
+                logger.debug("Adding bundle to queue: %s", bundle.get_name())
+                bundled_file_ids.update(bundle.get_file_ids())
+        return [child for child in children if child.id not in bundled_file_ids]
+
+    def _do_queue_download(self, putio_file, dest, delete_after_download=False, root_id=None, parent_ids=None,
+                           max_attempts=None):
         if dest.endswith("..."):
             dest = dest[:-3]
 
-        if not self._already_downloaded(putio_file, dest):
+        if self._download_manager.is_queued(putio_file.id):
+            logger.debug("Already queued: '{}'".format(putio_file.name))
+        elif not self._already_downloaded(putio_file, dest):
             if not os.path.exists(dest):
                 os.makedirs(dest)
 
-            download = Download(putio_file, dest)
-            total = putio_file.size
-            if not self.disable_progress:
-                widgets = [
-                    progressbar.Percentage(), ' ',
-                    progressbar.Bar(), ' ',
-                    progressbar.ETA(), ' ',
-                    progressbar.FileTransferSpeed()]
-                pbar = progressbar.ProgressBar(widgets=widgets, maxval=total)
-
-            def start_callback(_download):
-                logger.info("Starting download {}".format(putio_file.name))
-                if not self.disable_progress:
-                    pbar.start()
-
-            def progress_callback(_download):
-                try:
-                    pbar.update(download.get_downloaded())
-                except AssertionError:
-                    pass  # ignore, has happened
-
-            def completion_callback(_download):
-                # and write a record of the download to the database
-                self._record_downloaded(putio_file)
-                logger.info("Download finished: {}".format(putio_file.name))
-                if delete_after_download:
-                    try:
-                        putio_file.delete()
-                    except:
-                        logger.error("Error deleting file {}. Assuming all is well but may require manual cleanup".format(putio_file.name))
-                        traceback.print_exc()
-
-            download.add_start_callback(start_callback)
-            if self.disable_progress is False:
-                download.add_progress_callback(progress_callback)
-            download.add_completion_callback(completion_callback)
-            self._download_manager.add_download(download)
+            download = self._build_download(putio_file, dest, delete_after_download, root_id, parent_ids)
+            download.set_max_attempts(max_attempts)
+            if not self._link_local_copy(download):
+                self._download_manager.add_download(download)
         else:
             logger.debug("Already downloaded: '{}'".format(putio_file.name))
             if delete_after_download:
                 try:
-                    putio_file.delete()
+                    self._delete_remote(putio_file.id, putio_file.name)
                 except:
                     logger.error("Error deleting file... assuming all is well but may require manual cleanup")
                     traceback.print_exc()
 
-
-
-    def _queue_download(self, putio_file, relpath="", level=0):
-        # add this file (or files in this directory) to the queue
+    def _queue_download(self, putio_file, relpath="", level=0, root_id=None, parent_ids=()):
+        # add this file (or files in this directory) to the queue; parent_ids are the
+        # ids of the directories it is in (below the remote root), outermost first
+        if root_id is None:
+            root_id = putio_file.id
 
         full_path = os.path.sep + os.path.join(relpath, putio_file.name)
         full_path = full_path.replace("\\", "/")
         if not self._is_directory(putio_file):
-            if self.download_filter is not None and self.download_filter.match(full_path) is None:
+            if self.download_filter is not None and not self.download_filter.matches(full_path):
                 logger.debug("Skipping '{0}' because it does not match the provided filter".format(full_path))
             else:
+                seen_file_ids = self._seen_file_ids
+                if seen_file_ids is not None:
+                    seen_file_ids.add(putio_file.id)
                 logger.debug("Adding download to queue: '{0}'".format(full_path))
                 target_dir = os.path.join(self._download_directory, relpath)
-                delete_file = not self._keep_files and (self.force_keep is None or  self.force_keep.match(full_path) is None)
-                self._do_queue_download(putio_file, target_dir, delete_after_download=delete_file)
+                self._do_queue_download(putio_file, target_dir, delete_after_download=self._should_delete(full_path),
+                                        root_id=root_id, parent_ids=parent_ids)
+        elif self.download_filter is not None and not self.download_filter.could_match_below(full_path):
+            logger.debug("Skipping '{0}' because nothing in it can match the provided filter".format(full_path))
         else:
-            children = putio_file.dir()
+            with tracing.span("list", file_id=putio_file.id) as span:
+                children = putio_file.dir()
+                span.set(children=len(children))
             if not children:
                 # this is a directory with no children, it must be destroyed
                 if self.force_keep is None or self.force_keep.match(full_path) is None:
-                    putio_file.delete()
+                    self._delete_remote(putio_file.id, putio_file.name)
             else:
+                child_parent_ids = parent_ids + (putio_file.id,)  # shared by every download in this directory
+                if self._bundle_min_files is not None:
+                    children = self._queue_bundles(children, os.path.join(relpath, putio_file.name), root_id,
+                                                   child_parent_ids)
                 for child in children:
-                    self._queue_download(child, os.path.join(relpath, putio_file.name), level + 1)
+                    try:
+                        self._queue_download(child, os.path.join(relpath, putio_file.name), level + 1, root_id,
+                                             child_parent_ids)
+                    except Exception as ex:
+                        self._on_check_error(child, ex)
+
+    def _remote_relpath(self, parent_id):
+        """Return the path of the remote directory with the provided id, relative to the root"""
+        if parent_id in (0, self._remote_root):
+            return ""
+        try:
+            return self._remote_relpaths[parent_id]
+        except KeyError:
+            parent = self._putio_client.File.get(parent_id)
+            relpath = os.path.join(self._remote_relpath(parent.parent_id), parent.name)
+            self._remote_relpaths[parent_id] = relpath
+            return relpath
+
+    def queue_remote_file(self, file_id):
+        """Queue the file (or everything within the directory) with the provided id
+
+        This is used to queue the output of a completed transfer without
+        walking the rest of the remote tree.
+
+        """
+        putio_file = self._putio_client.File.get(file_id)
+        self._queue_download(putio_file, self._remote_relpath(putio_file.parent_id))
+
+    def restore_queue(self):
+        """Re-queue downloads that were persisted before the last shutdown
+
+        This does not require any calls to the put.io API, so downloads can
+        resume before the first full check of the remote files completes.
+        Downloads already in the download history are dropped; those for
+        files that the first full check does not find are dropped then (see
+        :meth:`_evict_missing_restored`).  Until then a restored download is
+        only attempted ``RESTORED_MAX_ATTEMPTS`` times.
+
+        """
+        records = self._download_manager.get_persisted_downloads(self._profile_name)
+        if records:
+            logger.info("Restoring %d queued download(s)", len(records))
+        downloaded_file_ids = self.get_downloaded_file_ids([record.file_id for record in records])
+        for record in records:
+            if record.file_id in downloaded_file_ids:
+                continue
+            putio_file = self._putio_client.File({
+                "id": record.file_id,
+                "name": record.name,
+                "size": record.size,
+                "content_type": "application/octet-stream",
+            })
+            self._do_queue_download(putio_file, record.destination,
+                                    delete_after_download=record.delete_after_download,
+                                    root_id=record.root_id, max_attempts=RESTORED_MAX_ATTEMPTS)
+        restored = set(record.file_id for record in records if self._download_manager.is_queued(record.file_id))
+        # the rest were downloaded (or found locally) before the last shutdown
+        self._download_manager.forget_persisted_downloads(
+            [record.file_id for record in records if record.file_id not in restored])
+        self._restored_file_ids.update(restored)
+
+    def _evict_missing_restored(self, seen_file_ids):
+        """Drop restored downloads of files that a full check did not find on put.io"""
+        missing = self._restored_file_ids - seen_file_ids
+        self._restored_file_ids = set()
+        if not missing:
+            return
+        logger.info("Dropping %d restored download(s) no longer found on put.io", len(missing))
+        for file_id in missing:
+            self._download_manager.cancel_download(file_id)
+        self._download_manager.forget_persisted_downloads(missing)
+
+    def _on_check_error(self, putio_file, ex):
+        # one failed listing (or file) is skipped until the next check rather than abandoning the whole check
+        self._check_errors += 1
+        logger.error("Error while checking '{}' (skipped until the next check): {}".format(putio_file.name, ex))
 
     def _perform_single_check(self):
+        """Check for updated files to download; returns False if any part of the check failed"""
+        self._check_errors = 0
+        # remote directories may have been renamed or moved since the last check
+        self._remote_relpaths = {}
+        self._seen_file_ids = set() if self._restored_file_ids else None
         try:
             # Perform a single check for updated files to download
-            for putio_file in self._putio_client.File.list():
-                self._queue_download(putio_file)
+            with tracing.span("list", file_id=self._remote_root) as span:
+                putio_files = self._putio_client.File.list(parent_id=self._remote_root)
+                span.set(children=len(putio_files))
         except Exception as ex:
-            logger.error("Unexpected error while performing check/download: {}".format(ex))
-            logger.error("File checked: {}".format(putio_file.name))
+            logger.error("Unexpected error while listing files to check: {}".format(ex))
+            return False
+        for putio_file in putio_files:
+            try:
+                self._queue_download(putio_file)
+            except Exception as ex:
+                self._on_check_error(putio_file, ex)
+        seen_file_ids, self._seen_file_ids = self._seen_file_ids, None
+        if seen_file_ids is not None and self._check_errors == 0:
+            self._evict_missing_restored(seen_file_ids)
+        return self._check_errors == 0
 
     def _wait_until_downloads_complete(self):
-        while not self._download_manager.is_empty():
+        # only this profile's downloads; others sharing the download manager may have a long backlog
+        while self._download_manager.has_pending_downloads(self._profile):
             time.sleep(0.5)
 
+    def sync_once(self):
+        """Perform a single check and wait for everything it queued to be downloaded
+
+        Completion callbacks (including post-processing) and due remote
+        deletions have finished when this returns.  Returns True if the
+        check of the remote files completed without errors.
+
+        """
+        self.restore_queue()
+        success = self._perform_single_check()
+        self._wait_until_downloads_complete()
+        if self._deletion_queue is not None:
+            self._deletion_queue.drain()
+        return success
+
     def run_forever(self):
         """Run the synchronizer until killed"""
         logger.warn("Starting main application")
+        self.restore_queue()
         while True:
             self._perform_single_check()
             last_check = datetime.datetime.now()
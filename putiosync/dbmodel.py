@@ -1,4 +1,4 @@
-from sqlalchemy import Integer, Column, String, DateTime
+from sqlalchemy import Integer, Column, String, DateTime, Boolean, Index, inspect
 from sqlalchemy.ext.declarative import declarative_base
 
 DBModelBase = declarative_base()
@@ -11,3 +11,58 @@ class DownloadRecord(DBModelBase):
     size = Column(Integer)
     timestamp = DateTime()
     name = Column(String)
+    crc32 = Column(String)  # as reported by put.io
+    path = Column(String)  # where the file was saved locally
+    deduplicated = Column(Boolean, default=False)  # linked to an existing local copy instead of downloaded
+    __table_args__ = (Index("ix_download_history_size_crc32", "size", "crc32"),)
+
+
+class PendingDeletion(DBModelBase):
+    __tablename__ = 'pending_deletions'
+    file_id = Column(Integer, primary_key=True)
+    name = Column(String)
+    attempts = Column(Integer, default=0)
+    next_attempt = Column(DateTime)
+    profile = Column(String)
+
+
+class QueuedDownloadRecord(DBModelBase):
+    __tablename__ = 'download_queue'
+    file_id = Column(Integer, primary_key=True)
+    name = Column(String)
+    size = Column(Integer)
+    destination = Column(String)
+    delete_after_download = Column(Boolean, default=False)
+    root_id = Column(Integer)
+    profile = Column(String)
+    state = Column(String)
+    position = Column(Integer, index=True)
+    updated = Column(DateTime)
+
+
+class ProcessedTorrentFile(DBModelBase):
+    __tablename__ = 'processed_torrent_files'
+    path = Column(String, primary_key=True)
+    size = Column(Integer)
+    mtime = Column(Integer)
+    timestamp = Column(DateTime)
+
+
+def upgrade_schema(engine):
+    """Add columns and indexes introduced after the database was created
+
+    ``create_all`` creates missing tables but leaves existing ones alone, so
+    databases created by older versions are brought up to date here.
+
+    """
+    inspector = inspect(engine)
+    for table in DBModelBase.metadata.sorted_tables:
+        existing_columns = set(column["name"] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing_columns:
+                engine.execute("ALTER TABLE {} ADD COLUMN {} {}".format(
+                    table.name, column.name, column.type.compile(engine.dialect)))
+        existing_indexes = set(index["name"] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(engine)
@@ -0,0 +1,68 @@
+"""Reuse local copies of files instead of downloading them again
+
+The same content may show up on put.io under a new file id (e.g. a torrent
+that was added again).  Files are identified by their size and the CRC32
+put.io reports for them, and a local copy is linked into place instead of
+transferring the bytes.
+
+"""
+import errno
+import logging
+import os
+from sqlalchemy import desc
+from putiosync.dbmodel import DownloadRecord
+
+logger = logging.getLogger("putiosync")
+
+REFLINK = "reflink"  # copy-on-write clone; the copies are independent
+HARDLINK = "hardlink"  # same file under two names; changes to one affect the other
+
+FICLONE = 0x40049409  # linux/fs.h
+
+
+def find_local_copies(session, size, crc32, limit=5):
+    """Return paths of previously downloaded files with the provided size and CRC32 that still exist"""
+    records = (session.query(DownloadRecord.path)
+               .filter(DownloadRecord.size == size,
+                       DownloadRecord.crc32 == crc32,
+                       DownloadRecord.path.isnot(None))
+               .order_by(desc(DownloadRecord.id))
+               .limit(limit))
+    return [path for (path,) in records if os.path.isfile(path) and os.path.getsize(path) == size]
+
+
+def _reflink(source, destination):
+    try:
+        import fcntl
+    except ImportError:  # not available on Windows
+        raise OSError(errno.EOPNOTSUPP, "reflinks are not supported on this platform")
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def link_file(source, destination, allow_hardlink=False):
+    """Make the content of ``source`` available at ``destination`` without copying it
+
+    A reflink is tried first; if that is not supported and ``allow_hardlink``
+    is True, a hard link is made instead.  Returns the method used
+    (:data:`REFLINK` or :data:`HARDLINK`), or None if neither was possible.
+
+    """
+    temporary_path = destination + ".part"
+    if not os.path.exists(os.path.dirname(destination)):
+        os.makedirs(os.path.dirname(destination))
+    methods = [(REFLINK, _reflink)]
+    if allow_hardlink:
+        methods.append((HARDLINK, os.link))
+    for method, link in methods:
+        try:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            link(source, temporary_path)
+            os.replace(temporary_path, destination)
+            return method
+        except (IOError, OSError) as e:
+            logger.debug("Unable to %s %s to %s: %s", method, source, destination, e)
+    if os.path.exists(temporary_path):
+        os.remove(temporary_path)
+    return None
@@ -0,0 +1,136 @@
+"""Background queue for removing files from put.io
+
+Deleting a file on put.io is an API round-trip that we used to do inline,
+both after every completed download and while walking the remote tree.
+Instead, file ids are recorded in the database and a background thread
+removes them in batches using a single ``/files/delete`` call per batch.
+As pending deletions live in the database, anything that was not removed
+before a crash or restart is picked up again on the next start.
+
+"""
+import datetime
+import logging
+import threading
+import time
+from sqlalchemy.exc import IntegrityError
+from putiosync.dbmodel import PendingDeletion
+
+logger = logging.getLogger("putiosync")
+
+
+class DeletionQueue(threading.Thread):
+    """Component responsible for batching and retrying remote deletions"""
+
+    def __init__(self, putio_client, db_manager, batch_size=100, flush_interval=2.0,
+                 retry_backoff=30, max_retry_backoff=60 * 60):
+        threading.Thread.__init__(self, name="DeletionQueue")
+        self.setDaemon(True)
+        self._putio_client = putio_client
+        self._db_manager = db_manager
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._retry_backoff = retry_backoff
+        self._max_retry_backoff = max_retry_backoff
+        self._clients = {}  # profile name -> client for its account
+        self._wakeup = threading.Event()
+        self._has_exit = False
+
+    def add_client(self, profile_name, putio_client):
+        """Use the provided client for deleting files queued for the named profile"""
+        self._clients[profile_name] = putio_client
+
+    def add(self, file_id, name=None, profile=None):
+        """Queue the put.io file with the provided id for deletion
+
+        The request is persisted before returning so that it survives a
+        restart, but no API call is made on the caller's thread.  The file
+        is deleted from the account of the named ``profile`` (see
+        :meth:`add_client`).  A file that is already queued keeps its place
+        in the retry backoff, so rescans don't retry failed deletions early.
+
+        """
+        session = self._db_manager.get_db_session()
+        if session.query(PendingDeletion.file_id).filter(PendingDeletion.file_id == file_id).first() is not None:
+            return
+        session.add(PendingDeletion(file_id=file_id, name=name, attempts=0,
+                                    next_attempt=datetime.datetime.now(), profile=profile))
+        try:
+            session.commit()
+        except IntegrityError:
+            session.rollback()  # queued by another thread in the meantime
+            return
+        self._wakeup.set()
+
+    def pending_count(self):
+        """Return the number of deletions that have not yet been performed"""
+        return self._db_manager.get_db_session().query(PendingDeletion).count()
+
+    def is_empty(self):
+        """Return True if there are no deletions waiting to be performed"""
+        return self.pending_count() == 0
+
+    def drain(self, timeout=60):
+        """Wait until every deletion that is currently due has been attempted
+
+        Deletions waiting to be retried later remain queued.  Returns True if
+        nothing is left to be deleted.
+
+        """
+        session = self._db_manager.get_db_session()
+        deadline = time.time() + timeout
+        self._wakeup.set()
+        while time.time() < deadline:
+            session.expire_all()
+            due = (session.query(PendingDeletion)
+                   .filter(PendingDeletion.next_attempt <= datetime.datetime.now())
+                   .count())
+            if due == 0:
+                break
+            time.sleep(0.1)
+        return self.pending_count() == 0
+
+    def stop(self):
+        self._has_exit = True
+        self._wakeup.set()
+
+    def _next_batch(self, session):
+        batch = (session.query(PendingDeletion)
+                 .filter(PendingDeletion.next_attempt <= datetime.datetime.now())
+                 .order_by(PendingDeletion.next_attempt)
+                 .limit(self._batch_size)
+                 .all())
+        # each batch is deleted from a single account
+        return [pending for pending in batch if pending.profile == batch[0].profile]
+
+    def _process_batch(self, session, batch):
+        file_ids = [pending.file_id for pending in batch]
+        putio_client = self._clients.get(batch[0].profile, self._putio_client)
+        try:
+            putio_client.File.delete_multi(file_ids, skip_nonexistents=True)
+        except Exception as ex:
+            logger.error("Error deleting %d file(s) from put.io, will retry: %s", len(file_ids), ex)
+            now = datetime.datetime.now()
+            for pending in batch:
+                pending.attempts = (pending.attempts or 0) + 1
+                backoff = min(self._retry_backoff * 2 ** (pending.attempts - 1), self._max_retry_backoff)
+                pending.next_attempt = now + datetime.timedelta(seconds=backoff)
+            session.commit()
+            return False
+        else:
+            logger.info("Deleted %d file(s) from put.io", len(file_ids))
+            for pending in batch:
+                session.delete(pending)
+            session.commit()
+            return True
+
+    def run(self):
+        """Main loop for the deletion queue"""
+        session = self._db_manager.get_db_session()
+        while not self._has_exit:
+            # give other deletions a chance to accumulate before sending a batch
+            self._wakeup.wait(self._flush_interval)
+            self._wakeup.clear()
+            while not self._has_exit:
+                batch = self._next_batch(session)
+                if not batch or not self._process_batch(session, batch):
+                    break
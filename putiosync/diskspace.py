@@ -0,0 +1,118 @@
+"""Track free disk space and space reserved for downloads in progress
+
+Free space reported by the filesystem does not account for downloads that
+have been started but not yet written in full (or moves out of a staging
+directory that have not yet finished).  Space is reserved for those here so
+that a download is only started when it can actually be completed.
+
+"""
+import errno
+import logging
+import os
+import shutil
+import threading
+
+logger = logging.getLogger("putiosync")
+
+
+def get_existing_ancestor(path):
+    """Return ``path`` or its nearest ancestor that exists"""
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+def get_device(path):
+    """Return the device of the filesystem ``path`` is (or would be) on"""
+    return os.stat(get_existing_ancestor(path)).st_dev
+
+
+def get_allocated_size(path):
+    """Return the number of bytes allocated on disk for the file at ``path`` (0 if missing)"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return 0
+    blocks = getattr(st, "st_blocks", None)
+    return st.st_size if blocks is None else min(st.st_size, blocks * 512)
+
+
+def preallocate(f, size):
+    """Allocate ``size`` bytes on disk for the open file ``f``
+
+    This reduces fragmentation when segments are written out of order and
+    fails early if the space is not available.  Returns False if the
+    platform or filesystem does not support preallocation; errors such as
+    ENOSPC are raised.
+
+    """
+    if size <= 0 or not hasattr(os, "posix_fallocate"):
+        return False
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except OSError as e:
+        if e.errno in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+            return False
+        raise
+    return True
+
+
+class DiskSpaceManager(object):
+    """Reserve space on filesystems for downloads that are in progress
+
+    Reservations are keyed by an owner (the put.io file id) and the device
+    of the filesystem the space is reserved on.  ``min_free_bytes`` is kept
+    free on every filesystem in addition to any reservations.
+
+    """
+
+    def __init__(self, min_free_bytes=0):
+        self._min_free_bytes = min_free_bytes
+        self._lock = threading.Lock()
+        self._reservations = {}  # (owner, device) -> bytes
+
+    def _reserved(self, device):
+        return sum(size for (_, reserved_device), size in self._reservations.items() if reserved_device == device)
+
+    def get_available(self, path):
+        """Return the bytes that may still be reserved on the filesystem of ``path``"""
+        device = get_device(path)
+        with self._lock:
+            return self._get_available(path, device)
+
+    def _get_available(self, path, device):
+        free = shutil.disk_usage(get_existing_ancestor(path)).free
+        return free - self._min_free_bytes - self._reserved(device)
+
+    def try_reserve(self, owner, requests):
+        """Reserve space for ``owner`` if all of it is available
+
+        ``requests`` is a list of ``(path, size)``.  Either all of the space
+        is reserved and True is returned, or nothing is reserved and False
+        is returned.
+
+        """
+        needed = {}
+        for path, size in requests:
+            device = get_device(path)
+            needed[device] = (path, needed.get(device, (path, 0))[1] + max(size, 0))
+        with self._lock:
+            for device, (path, size) in needed.items():
+                if size > self._get_available(path, device):
+                    return False
+            for device, (path, size) in needed.items():
+                key = (owner, device)
+                self._reservations[key] = self._reservations.get(key, 0) + size
+        return True
+
+    def release(self, owner, path=None):
+        """Release the space reserved by ``owner`` (only on the filesystem of ``path`` if provided)"""
+        device = get_device(path) if path is not None else None
+        with self._lock:
+            for key in list(self._reservations):
+                if key[0] == owner and (device is None or key[1] == device):
+                    del self._reservations[key]
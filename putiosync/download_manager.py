@@ -1,55 +1,247 @@
 from collections import deque
+import itertools
+import logging
 import threading
 import time
 import datetime
 import putiopy
 import os
-from putiosync import multipart_downloader
+from sqlalchemy import bindparam, func
+from putiosync import diskspace, extract, multipart_downloader, tracing
+from putiosync.checkpoint import RangeCheckpoint
+from putiosync.dbmodel import QueuedDownloadRecord
+from putiosync.mover import FileMover
+from putiosync.stats import StatsRegistry
 
+logger = logging.getLogger("putiosync")
 
-class Download(object):
-    """Object containing information about a download to be performed"""
+# States a download moves through; these are also what gets persisted
+QUEUED = "queued"
+ACTIVE = "active"
+VERIFYING = "verifying"
+MOVING = "moving"  # complete in the staging directory, waiting to be moved to its destination
+DONE = "done"
+FAILED = "failed"
+
+# how far into the queue to look for a download that fits when the first does not
+ADMISSION_SCAN_LIMIT = 1000
+ADMISSION_RETRY_SECONDS = 5
 
-    def __init__(self, putio_file, destination_path):
-        self._putio_file = putio_file
+
+class Download(object):
+    """Object containing information about a download to be performed
+
+    Large numbers of these may be queued at once (e.g. when first syncing an
+    account), so only the fields required to perform and report on the
+    download are kept.  Callbacks are stored as a flat ``[kind, callback, ...]``
+    list that is only allocated when a callback is first added.
+
+    """
+    __slots__ = (
+        "_file_id",
+        "_name",
+        "_size",
+        "_destination_directory",
+        "_delete_after_download",
+        "_root_id",
+        "_parent_ids",
+        "_crc32",
+        "_deduplicated",
+        "_profile",
+        "_file_class",
+        "_callbacks",
+        "_listener",
+        "_state",
+        "_attempts",
+        "_max_attempts",
+        "_downloaded",
+        "_start_datetime",
+        "_finish_datetime",
+    )
+
+    journaled = True  # whether the download journal persists this download
+
+    def __init__(self, file_id, name, size, destination_path, delete_after_download=False, file_class=None,
+                 root_id=None, crc32=None, profile=None, parent_ids=None):
+        self._file_id = file_id
+        self._name = name
+        self._size = size
         self._destination_directory = destination_path
-        self._progress_callbacks = set()
-        self._start_callbacks = set()
-        self._completion_callbacks = set()
+        self._delete_after_download = delete_after_download
+        self._root_id = root_id
+        self._parent_ids = parent_ids  # tuple shared with the other downloads from the same directory
+        self._crc32 = crc32
+        self._deduplicated = False
+        self._profile = profile
+        self._file_class = file_class
+        self._callbacks = None
+        self._listener = None
+        self._state = QUEUED
+        self._attempts = 0
+        self._max_attempts = None
         self._downloaded = 0
         self._start_datetime = None
         self._finish_datetime = None
 
+    @classmethod
+    def from_putio_file(cls, putio_file, destination_path, delete_after_download=False, root_id=None,
+                        profile=None, parent_ids=None):
+        """Create a download for the provided putio file without keeping a reference to it"""
+        return cls(putio_file.id, putio_file.name, putio_file.size, destination_path,
+                   delete_after_download=delete_after_download,
+                   file_class=type(putio_file),
+                   root_id=root_id,
+                   crc32=getattr(putio_file, "crc32", None),
+                   profile=profile,
+                   parent_ids=parent_ids)
+
+    def _fire_callbacks(self, kind):
+        callbacks = self._callbacks
+        if callbacks is not None:
+            for i in range(0, len(callbacks), 2):
+                if callbacks[i] == kind:
+                    callbacks[i + 1](self)
+        if self._listener is not None:
+            self._listener(kind, self)
+
     def _fire_progress_callbacks(self):
-        for cb in list(self._progress_callbacks):
-            cb(self)
+        self._fire_callbacks("progress")
 
     def _fire_start_callbacks(self):
-        for cb in list(self._start_callbacks):
-            cb(self)
+        self._fire_callbacks("start")
 
     def _fire_completion_callbacks(self):
-        for cb in list(self._completion_callbacks):
-            cb(self)
+        self._fire_callbacks("completion")
+
+    def _set_state(self, state):
+        self._state = state
+        self._fire_callbacks("state")
+
+    def _add_callback(self, kind, callback):
+        if self._callbacks is None:
+            self._callbacks = []
+        self._callbacks.extend((kind, callback))
+
+    def set_listener(self, listener):
+        """Set a single listener to be notified of every event on this download
+
+        This is used by the download manager so that it does not need to add
+        a set of callbacks to every queued download.  The listener will be
+        called as follows::
+
+            listener(kind, download)
+
+        Where kind is one of "start", "progress", "completion" or "state".
+
+        """
+        self._listener = listener
+
+    def reset(self):
+        """Reset any progress so that the download may be retried"""
+        self._state = QUEUED
+        self._downloaded = 0
+        self._start_datetime = None
+        self._finish_datetime = None
+
+    def get_file_id(self):
+        return self._file_id
+
+    def get_name(self):
+        return self._name
+
+    def get_file_ids(self):
+        """Return the ids of the put.io files this download provides"""
+        return [self._file_id]
+
+    def get_root_id(self):
+        """Return the id of the top-level put.io file or directory this download was queued from"""
+        return self._root_id if self._root_id is not None else self._file_id
+
+    def get_parent_ids(self):
+        """Return the ids of the put.io directories containing this download, outermost first (if known)"""
+        return self._parent_ids
+
+    def get_stats_ids(self):
+        """Return the ids of the put.io files and directories this download is counted under
+
+        These are the download itself and every directory containing it below
+        the synchronized folder, so that e.g. a transfer saved into a
+        subfolder finds its downloads by the transfer's ``file_id``.  Downloads
+        restored from the journal only know their root.
+
+        """
+        if self._parent_ids is not None:
+            return self._parent_ids + (self._file_id,)
+        root_id = self.get_root_id()
+        return (self._file_id,) if root_id == self._file_id else (root_id, self._file_id)
+
+    def get_crc32(self):
+        """Return the CRC32 put.io reported for the file, if known"""
+        return self._crc32
+
+    def get_profile(self):
+        """Return the :class:`Profile` this download belongs to (None if not set)"""
+        return self._profile
+
+    def get_profile_name(self):
+        return self._profile.name if self._profile is not None else None
+
+    def is_deduplicated(self):
+        """Return True if the file was linked from an existing local copy rather than downloaded"""
+        return self._deduplicated
+
+    def set_deduplicated(self, deduplicated):
+        self._deduplicated = deduplicated
 
     def get_putio_file(self):
-        return self._putio_file
+        """Create a putio file object for this download
+
+        The remote object is not kept with the download; a new one is created
+        for each call based on the information we do keep.
+
+        """
+        if self._file_class is None:
+            raise ValueError("Download was created without a putio file class")
+        return self._file_class({
+            "id": self._file_id,
+            "name": self._name,
+            "size": self._size,
+            "content_type": "application/octet-stream",
+        })
 
     def get_destination_directory(self):
         return self._destination_directory
 
     def get_filename(self):
-        return self.get_putio_file().name.encode('utf-8', 'ignore')
+        return self._name
 
     def get_destination_path(self):
         return os.path.join(os.path.abspath(self._destination_directory),
                             self.get_filename())
 
+    def get_delete_after_download(self):
+        return self._delete_after_download
+
+    def get_state(self):
+        return self._state
+
+    def get_attempts(self):
+        """Return the number of times this download has been attempted"""
+        return self._attempts
+
+    def get_max_attempts(self):
+        """Return the number of attempts after which this download is given up on, or None"""
+        return self._max_attempts
+
+    def set_max_attempts(self, max_attempts):
+        """Limit the attempts at this download regardless of the download manager's limit"""
+        self._max_attempts = max_attempts
+
     def get_downloaded(self):
         return self._downloaded
 
     def get_size(self):
-        return self._putio_file.size
+        return self._size
 
     def get_start_datetime(self):
         return self._start_datetime
@@ -58,26 +250,26 @@ class Download(object):
         return self._finish_datetime
 
     def add_start_callback(self, start_callback):
-        """Add a callback to be called when there is new progress to report on a download
+        """Add a callback to be called whenever a new download is started
 
         The callback will be called as follows::
 
-            progress_callback(download)
-
-        Information about the progress itself will be stored with the download.
+            start_callback(download)
 
         """
-        self._start_callbacks.add(start_callback)
+        self._add_callback("start", start_callback)
 
     def add_progress_callback(self, progress_callback):
-        """Add a callback to be called whenever a new download is started
+        """Add a callback to be called when there is new progress to report on a download
 
         The callback will be called as follows::
 
-            start_callback(download)
+            progress_callback(download)
+
+        Information about the progress itself will be stored with the download.
 
         """
-        self._progress_callbacks.add(progress_callback)
+        self._add_callback("progress", progress_callback)
 
     def add_completion_callback(self, completion_callback):
         """Add a callback to be called whenever a download completes
@@ -87,17 +279,75 @@ class Download(object):
             completion_callback(download)
 
         """
-        self._completion_callbacks.add(completion_callback)
+        self._add_callback("completion", completion_callback)
+
+    def add_state_callback(self, state_callback):
+        """Add a callback to be called whenever the state of a download changes
+
+        The callback will be called as follows::
+
+            state_callback(download)
+
+        The new state is available from ``download.get_state()``.
+
+        """
+        self._add_callback("state", state_callback)
+
+    def get_staged_path(self, staging_directory):
+        """Return where this download is kept in the staging directory once complete"""
+        # files are kept apart by id as names are only unique within a put.io directory
+        return os.path.join(staging_directory, str(self._file_id), self.get_filename())
+
+    def finish(self):
+        """Mark the download as complete once its file is at its destination"""
+        self._finish_datetime = datetime.datetime.now()
+        with tracing.span("completion", file_id=self._file_id):
+            self._fire_completion_callbacks()
+        self._set_state(DONE)
+
+    def fail(self):
+        """Mark the download as failed without attempting it (again)"""
+        self._set_state(FAILED)
+
+    def get_part_path(self, staging_directory=None):
+        """Return the path of the file this download is written to while in progress"""
+        if staging_directory is not None:
+            return "{}.part".format(self.get_staged_path(staging_directory))
+        return "{}.part".format(os.path.join(self.get_destination_directory(), self.get_filename()))
+
+    def perform_download(self, token, staging_directory=None, preallocate=False, extract_archives=False,
+                         engine=None, stop_event=None, connections=4, rate_limiter=None):
+        """Download the file, returning True on success
+
+        If a staging directory is provided, the file is downloaded there and
+        left in the MOVING state; whoever moves it to its destination must
+        then call :meth:`finish`.  Otherwise the download is finished here.
+        If ``preallocate`` is True, space for the whole file is allocated
+        before any data is written.  If ``extract_archives`` is True, zip
+        archives are extracted next to their destination as they download.
+        If an ``engine`` (e.g. a :class:`ProcessDownloadEngine`) is provided,
+        it is used instead of :mod:`multipart_downloader`, which otherwise
+        fetches up to ``connections`` segments at once, throttled by
+        ``rate_limiter`` (a :class:`TokenBucket`) if provided.
+
+        The ranges written are checkpointed next to the ``.part`` file and an
+        earlier attempt is resumed from its checkpoint.  If ``stop_event`` is
+        set, the download is stopped with its checkpoint saved and False is
+        returned; the download is left ACTIVE so that it is resumed in its
+        place in the queue after a restart.
 
-    def perform_download(self, token):
+        """
+        self._attempts += 1
         self._start_datetime = datetime.datetime.now()
+        self._set_state(ACTIVE)
         self._fire_start_callbacks()
-        putio_file = self.get_putio_file()
-        dest = self.get_destination_directory()
-        filename = self.get_filename()
-
-        final_path = os.path.join(dest, filename.decode('utf-8'))
-        download_path = "{}.part".format(final_path.encode('utf-8'))
+        download_path = self.get_part_path(staging_directory)
+        final_path = download_path[:-len(".part")]
+        if staging_directory is not None and os.path.exists(final_path) and os.path.getsize(final_path) == self._size:
+            # staged before a restart but never moved; no need to download it again
+            self._downloaded = self._size
+            self._set_state(MOVING)
+            return True
 
         # ensure the path into which the download is going to be donwloaded exists. We know
         # that the 'dest' directory exists but in some cases the filename on put.io may
@@ -107,65 +357,386 @@ class Download(object):
             os.makedirs(os.path.dirname(download_path))
 
         success = False
-        with open(download_path, 'wb') as f:
+        extraction = None
+        checkpoint = RangeCheckpoint(download_path, self._size)
+        resumed = checkpoint.load()
+        if resumed:
+            logger.info("Resuming %s with %d of %d bytes already downloaded", self._name, resumed, self._size)
+        self._downloaded = resumed
+        with tracing.span("transfer", file_id=self._file_id, size=self.get_size(), attempt=self._attempts,
+                          resumed=resumed) as span, open(download_path, 'r+b' if resumed else 'wb') as f:
+            if preallocate:
+                try:
+                    diskspace.preallocate(f, self._size)
+                except OSError as e:
+                    logger.error("Unable to allocate space for %s: %s", self._name, e)
+                    self._set_state(FAILED)
+                    return False
+
+            if extract_archives and extract.is_extractable(self._name):
+                written = extract.ContiguousRanges()
+                for offset, length in checkpoint.get_ranges():
+                    written.add(offset, length)
+                extraction = extract.StreamingExtraction(
+                    download_path, extract.get_extraction_directory(self.get_destination_path()))
+                extraction.start()
+
             def transfer_callback(offset, chunk):
                 self._downloaded += len(chunk)
                 f.seek(offset)
                 f.write(chunk)
                 f.flush()
+                checkpoint.add(offset, len(chunk))
+                checkpoint.maybe_save(f.fileno())
+                if extraction is not None:
+                    extraction.advance(written.add(offset, len(chunk)))
+                self._fire_progress_callbacks()
+
+            def engine_progress_callback(downloaded, watermark):
+                self._downloaded = resumed + downloaded
                 self._fire_progress_callbacks()
 
-            success = multipart_downloader.download(
-                putiopy.BASE_URL + '/files/{}/download'.format(putio_file.id),
-                self.get_size(),
-                transfer_callback,
-                params={'oauth_token': token})
+            def engine_range_callback(offset, length):
+                checkpoint.add(offset, length)
+                checkpoint.maybe_save(f.fileno())
+                if extraction is not None:
+                    extraction.advance(written.add(offset, length))
+
+            url = putiopy.BASE_URL + '/files/{}/download'.format(self._file_id)
+            if engine is not None:
+                # the engine writes to the file itself
+                success = engine.download(url, self.get_size(), download_path, engine_progress_callback,
+                                          ranges=checkpoint.get_missing(), stop_event=stop_event,
+                                          range_callback=engine_range_callback,
+                                          params={'oauth_token': token})
+            else:
+                success = multipart_downloader.download(
+                    url,
+                    self.get_size(),
+                    transfer_callback,
+                    num_workers=connections,
+                    ranges=checkpoint.get_missing(),
+                    stop_event=stop_event,
+                    rate_limiter=rate_limiter,
+                    params={'oauth_token': token})
+            span.set(success=success)
+            if not success:
+                try:
+                    checkpoint.save(f.fileno())
+                except (IOError, OSError) as e:
+                    logger.error("Unable to checkpoint %s: %s", self._name, e)
+
+        if extraction is not None:
+            if success:
+                with tracing.span("extract", file_id=self._file_id) as span:
+                    span.set(extracted=extraction.finish(self._size))
+            else:
+                extraction.cancel()
 
         # download to part file is complete.  Now move to its final destination
         if success:
-            if os.path.exists(final_path):
-                os.remove(final_path)
-            os.rename(download_path, download_path[:-5])  # same but without '.part'
-            self._finish_datetime = datetime.datetime.now()
-            self._fire_completion_callbacks()
+            self._set_state(VERIFYING)
+            with tracing.span("rename", file_id=self._file_id):
+                if os.path.exists(final_path):
+                    os.remove(final_path)
+                os.rename(download_path, final_path)
+                checkpoint.discard()
+            if staging_directory is not None:
+                self._set_state(MOVING)
+            else:
+                self.finish()
+        elif stop_event is not None and stop_event.is_set():
+            logger.info("Stopped %s with %d of %d bytes downloaded", self._name, self._downloaded, self._size)
+        else:
+            self._set_state(FAILED)
 
         return success
 
 
+class DownloadQueueJournal(threading.Thread):
+    """Persist the download queue so that it survives restarts
+
+    State transitions are buffered in memory and written to the database
+    in batches by a background thread.  Only the most recent state of each
+    download is written; completed downloads are removed from the journal
+    as they are already part of the download history.
+
+    """
+
+    def __init__(self, db_manager, flush_interval=1.0):
+        threading.Thread.__init__(self, name="DownloadQueueJournal")
+        self.setDaemon(True)
+        self._db_manager = db_manager
+        self._flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pending = {}  # file_id -> [row, needs_insert]
+        self._next_position = 0
+        self._has_exit = False
+
+    def load(self, profile_name=None):
+        """Return persisted downloads of the named profile that were not completed, in queue order"""
+        session = self._db_manager.get_db_session()
+        records = (session.query(QueuedDownloadRecord)
+                   .filter(QueuedDownloadRecord.state != DONE)
+                   .filter(QueuedDownloadRecord.profile == profile_name)
+                   .order_by(QueuedDownloadRecord.position)
+                   .all())
+        last_position = session.query(func.max(QueuedDownloadRecord.position)).scalar()
+        with self._lock:
+            if last_position is not None:
+                self._next_position = max(self._next_position, last_position + 1)
+        return records
+
+    def record(self, download):
+        """Record the current state of the provided download"""
+        if not download.journaled:
+            return
+        state = download.get_state()
+        file_id = download.get_file_id()
+        with self._lock:
+            pending = self._pending.get(file_id)
+            if state == QUEUED:
+                # (re-)queued downloads go to the back of the queue
+                row = {
+                    "file_id": file_id,
+                    "name": download.get_name(),
+                    "size": download.get_size(),
+                    "destination": download.get_destination_directory(),
+                    "delete_after_download": download.get_delete_after_download(),
+                    "root_id": download.get_root_id(),
+                    "profile": download.get_profile_name(),
+                    "state": state,
+                    "position": self._next_position,
+                    "updated": datetime.datetime.now(),
+                }
+                self._next_position += 1
+                self._pending[file_id] = [row, True]
+            elif pending is not None:
+                pending[0]["state"] = state
+                pending[0]["updated"] = datetime.datetime.now()
+            else:
+                self._pending[file_id] = [{"file_id": file_id, "state": state,
+                                           "updated": datetime.datetime.now()}, False]
+
+    def forget(self, file_ids):
+        """Remove the downloads with the provided put.io file ids from the journal"""
+        file_ids = list(file_ids)
+        if not file_ids:
+            return
+        with self._lock:
+            for file_id in file_ids:
+                self._pending.pop(file_id, None)
+        table = QueuedDownloadRecord.__table__
+        session = self._db_manager.get_db_session()
+        for i in range(0, len(file_ids), 500):  # stay well below sqlite's bound parameter limit
+            session.execute(table.delete().where(table.c.file_id.in_(file_ids[i:i + 500])))
+        session.commit()
+
+    def flush(self):
+        """Write all buffered state transitions to the database"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+
+        table = QueuedDownloadRecord.__table__
+        inserts = [row for row, needs_insert in pending.values() if needs_insert and row["state"] != DONE]
+        updates = [{"_file_id": row["file_id"], "_state": row["state"], "_updated": row["updated"]}
+                   for row, needs_insert in pending.values() if not needs_insert and row["state"] != DONE]
+        deletes = [row["file_id"] for row, _needs_insert in pending.values() if row["state"] == DONE]
+
+        session = self._db_manager.get_db_session()
+        if inserts:
+            session.execute(table.insert().prefix_with("OR REPLACE"), inserts)
+        if updates:
+            session.execute(table.update()
+                            .where(table.c.file_id == bindparam("_file_id"))
+                            .values(state=bindparam("_state"), updated=bindparam("_updated")),
+                            updates)
+        if deletes:
+            session.execute(table.delete().where(table.c.file_id.in_(deletes)))
+        session.commit()
+
+    def stop(self):
+        self._has_exit = True
+
+    def run(self):
+        """Main loop for the journal"""
+        while not self._has_exit:
+            time.sleep(self._flush_interval)
+            self.flush()
+
+
 class DownloadManager(threading.Thread):
-    """Component responsible for managing the queue of things to be downloaded"""
+    """Component responsible for managing the queue of things to be downloaded
+
+    Downloads may belong to different profiles (see :mod:`putiosync.profiles`),
+    each downloaded with its own token.  When several profiles have queued
+    downloads, they take turns so that a large backlog for one profile does
+    not hold up the others.  Up to ``max_downloads`` files are downloaded at
+    once, sharing ``connections`` (the segments fetched at once) between them;
+    together with ``rate_limiter`` (a :class:`TokenBucket`) this limits all
+    profiles together.
 
-    def __init__(self, token):
+    """
+
+    def __init__(self, token, journal=None, max_attempts=None, staging_directory=None, moves_per_device=1,
+                 disk_space=None, preallocate=False, extract_archives=False, engine=None, connections=4,
+                 rate_limiter=None, max_downloads=1):
         threading.Thread.__init__(self, name="DownloadManager")
         self.setDaemon(True)
         self._token = token
+        self._journal = journal
+        self._max_attempts = max_attempts
+        self._staging_directory = staging_directory
+        self._mover = FileMover(moves_per_device) if staging_directory is not None else None
+        self._moving = 0
+        self._moving_counts = {}  # profile -> number of downloads being moved
+        self._disk_space = disk_space  # DiskSpaceManager used for admission, if any
+        self._preallocate = preallocate
+        self._extract_archives = extract_archives
+        self._engine = engine  # e.g. a ProcessDownloadEngine; None for multipart_downloader
+        self._max_downloads = max(1, min(max_downloads, connections))
+        self._connections = max(1, connections // self._max_downloads)  # for each download
+        self._rate_limiter = rate_limiter
+        self._profile_counts = {}  # profile -> number of queued downloads
+        self._profile_order = []  # profiles in the order they take turns
+        self._last_profile = None
+        self._admission_lock = threading.Lock()  # picking the next download (and reserving space for it)
+        self._active_file_ids = set()  # downloads being performed
+        self._held_file_ids = set()  # downloads held back for lack of space (logged once)
+        self._stop_event = threading.Event()
         self._download_queue_lock = threading.RLock()  # also used for locking calllback lists
         self._download_queue = deque()
+        self._queued_file_ids = set()
+        self._stats = StatsRegistry()
         self._progress_callbacks = set()
         self._start_callbacks = set()
         self._completion_callbacks = set()
+        self._callbacks_by_kind = {
+            "start": self._start_callbacks,
+            "progress": self._progress_callbacks,
+            "completion": self._completion_callbacks,
+        }
+        self._download_listener = self._dispatch  # bound once; shared by every queued download
         self._has_exit = False
 
-    def _build_callback(self, callbacks):
-        def callback(*args, **kwargs):
+    def _dispatch(self, kind, download):
+        """Listener shared by all queued downloads for manager level callbacks"""
+        if kind == "progress":
+            self._stats.on_progress(download)
+        elif kind == "start":
+            self._stats.on_started(download)
+        elif kind == "state":
+            if self._journal is not None:
+                self._journal.record(download)
+            return
+
+        callbacks = self._callbacks_by_kind[kind]
+        if callbacks:
+            # callbacks (e.g. post-processing) may take a while; don't hold up the queue meanwhile
             with self._download_queue_lock:
-                for cb in callbacks:
-                    cb(*args, **kwargs)
-        return callback
+                callbacks = list(callbacks)
+            for cb in callbacks:
+                cb(download)
 
     def start(self):
         """Start this donwload manager"""
         threading.Thread.start(self)
 
+    def shutdown(self, timeout=30):
+        """Stop downloading, keeping all progress, within ``timeout`` seconds
+
+        No further downloads are started and active downloads are stopped
+        with their checkpoints saved; they remain in the journal so that it is
+        resumed on the next start.  Files being moved out of the staging
+        directory are given the rest of the time to finish.  Returns True if
+        everything stopped in time.
+
+        """
+        deadline = time.time() + timeout
+        self._has_exit = True
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+        while self._moving > 0 and time.time() < deadline:
+            time.sleep(0.1)
+        return not self.is_alive() and self._moving == 0
+
+    def get_persisted_downloads(self, profile_name=None):
+        """Get records for downloads of a profile that were queued before the last shutdown
+
+        These are returned in queue order.  If this manager has no journal,
+        an empty list is returned.
+
+        """
+        if self._journal is None:
+            return []
+        return self._journal.load(profile_name)
+
+    def forget_persisted_downloads(self, file_ids):
+        """Remove records of downloads that should not be restored on the next start"""
+        if self._journal is not None:
+            self._journal.forget(file_ids)
+
+    def cancel_download(self, file_id):
+        """Remove the queued download of the put.io file with the provided id
+
+        Downloads that are in progress are left to finish (or fail).  Returns
+        True if the download was removed.
+
+        """
+        with self._admission_lock, self._download_queue_lock:
+            if file_id in self._active_file_ids:
+                return False
+            for download in self._download_queue:
+                if download.get_file_id() == file_id:
+                    break
+            else:
+                return False
+            self._dequeue(download)
+            self._queued_file_ids.difference_update(download.get_file_ids())
+        self._stats.on_abandoned(download)
+        return True
+
+    def _enqueue(self, download):
+        # called with the queue lock held
+        self._download_queue.append(download)
+        profile = download.get_profile()
+        if profile not in self._profile_counts:
+            self._profile_counts[profile] = 0
+            self._profile_order.append(profile)
+        self._profile_counts[profile] += 1
+
+    def _dequeue(self, download):
+        # called with the queue lock held
+        self._download_queue.remove(download)
+        self._profile_counts[download.get_profile()] -= 1
+
+    def is_queued(self, file_id):
+        """Return True if the put.io file with the provided id is already queued"""
+        with self._download_queue_lock:
+            return file_id in self._queued_file_ids
+
     def add_download(self, download):
-        """Add a download to be performed by this download manager"""
+        """Add a download to be performed by this download manager
+
+        Returns False if a download for the same put.io file is already queued.
+
+        """
         if not isinstance(download, Download):
             raise TypeError("download must be of type QueuedDownload")
         with self._download_queue_lock:
-            download.add_start_callback(self._build_callback(self._start_callbacks))
-            download.add_progress_callback(self._build_callback(self._progress_callbacks))
-            download.add_completion_callback(self._build_callback(self._completion_callbacks))
-            self._download_queue.append(download)
+            file_ids = download.get_file_ids()
+            if not self._queued_file_ids.isdisjoint(file_ids):
+                return False
+            download.set_listener(self._download_listener)
+            self._queued_file_ids.update(file_ids)
+            self._enqueue(download)
+            self._stats.on_queued(download)
+        if self._journal is not None:
+            self._journal.record(download)
+        return True
 
     def add_download_start_progress(self, start_callback):
         """Add a callback to be called whenever a new download is started
@@ -207,23 +778,229 @@ class DownloadManager(threading.Thread):
         with self._download_queue_lock:
             return list(self._download_queue)
 
+    def get_stats(self):
+        """Get the :class:`StatsRegistry` tracking this download manager"""
+        return self._stats
+
+    def get_queue_positions(self, putio_ids):
+        """Return a mapping of the provided put.io ids to the queue position of the first download counted under each
+
+        See :meth:`Download.get_stats_ids`.  Ids with nothing queued are left
+        out.  The queue is scanned outside of the queue lock and only until
+        every id has been found, so ids should be limited to those known to
+        have downloads queued (see :meth:`StatsRegistry.get_remaining_by_id`).
+
+        """
+        wanted = set(putio_ids)
+        positions = {}
+        if not wanted:
+            return positions
+        with self._download_queue_lock:
+            queue = list(self._download_queue)
+        for position, download in enumerate(queue):
+            for stats_id in download.get_stats_ids():
+                if stats_id in wanted and stats_id not in positions:
+                    positions[stats_id] = position
+                    if len(positions) == len(wanted):
+                        return positions
+        return positions
+
+    def add_completed_download(self, download):
+        """Complete a download whose file was provided without downloading it
+
+        This is used for files linked from an existing local copy; completion
+        callbacks are fired as if the file had been downloaded.
+
+        """
+        download.set_listener(self._download_listener)
+        download.finish()
+
     def is_empty(self):
-        """Return True if there are no queued downloads"""
+        """Return True if there are no queued downloads and no downloads being moved"""
+        with self._download_queue_lock:
+            return len(self._download_queue) == 0 and self._moving == 0
+
+    def has_pending_downloads(self, profile):
+        """Return True if downloads of the provided profile are queued or being moved"""
+        with self._download_queue_lock:
+            return self._profile_counts.get(profile, 0) > 0 or self._moving_counts.get(profile, 0) > 0
+
+    def _move_to_destination(self, download):
+        # the download stays marked as queued until it has been moved so that
+        # it is not queued again in the meantime
+        with self._download_queue_lock:
+            self._moving += 1
+            self._moving_counts[download.get_profile()] = self._moving_counts.get(download.get_profile(), 0) + 1
+
+        def moved(error):
+            if error is None:
+                try:
+                    os.rmdir(os.path.dirname(download.get_staged_path(self._staging_directory)))
+                except OSError:
+                    pass  # not empty; leave it be
+                download.finish()
+            else:
+                logger.error("%s was downloaded but could not be moved; it was left at %s",
+                             download.get_name(), download.get_staged_path(self._staging_directory))
+                download.fail()
+            if self._disk_space is not None:
+                self._disk_space.release(download.get_file_id())
+            with self._download_queue_lock:
+                self._moving -= 1
+                self._moving_counts[download.get_profile()] -= 1
+                self._queued_file_ids.difference_update(download.get_file_ids())
+
+        self._mover.move(download.get_staged_path(self._staging_directory), download.get_destination_path(), moved)
+
+    def _reserve_space(self, download):
+        """Reserve space for the download on each filesystem it will be written to"""
+        part_path = download.get_part_path(self._staging_directory)
+        # an earlier attempt may have left space allocated that will be reused
+        requests = [(part_path, download.get_size() - diskspace.get_allocated_size(part_path))]
+        destination_path = download.get_destination_path()
+        if (self._staging_directory is not None and
+                diskspace.get_device(part_path) != diskspace.get_device(destination_path)):
+            requests.append((destination_path, download.get_size()))
+        return self._disk_space.try_reserve(download.get_file_id(), requests)
+
+    def _get_candidates(self):
+        """Return the downloads to consider starting next, in order of preference
+
+        With a single profile this is the front of the queue.  Otherwise the
+        downloads of the profile whose turn it is come first, followed by
+        those of the profiles after it.
+
+        """
         with self._download_queue_lock:
-            return len(self._download_queue) == 0
+            waiting = [profile for profile in self._profile_order if self._profile_counts[profile] > 0]
+            if len(waiting) <= 1:
+                return list(itertools.islice((download for download in self._download_queue
+                                              if download.get_file_id() not in self._active_file_ids),
+                                             ADMISSION_SCAN_LIMIT))
+            by_profile = dict((profile, []) for profile in waiting)
+            missing = len(waiting)
+            for scanned, download in enumerate(self._download_queue):
+                if download.get_file_id() in self._active_file_ids:
+                    continue
+                candidates = by_profile[download.get_profile()]
+                if len(candidates) < ADMISSION_SCAN_LIMIT:
+                    if not candidates:
+                        missing -= 1
+                    candidates.append(download)
+                # keep looking (beyond the usual limit) until every profile has a candidate
+                if scanned >= ADMISSION_SCAN_LIMIT and missing == 0:
+                    break
+        if self._last_profile in self._profile_order:
+            turn = self._profile_order.index(self._last_profile) + 1
+        else:
+            turn = 0
+        order = self._profile_order[turn:] + self._profile_order[:turn]
+        return [download for profile in order for download in by_profile.get(profile, ())]
+
+    def _next_download(self):
+        """Return the next download that there is space for, or None
+
+        Downloads that do not fit are held back (but kept in their place in
+        the queue) while later downloads that do fit proceed.  The download
+        returned is marked active so that no other worker picks it.
+
+        """
+        with self._admission_lock:
+            download = self._admit()
+            if download is not None:
+                with self._download_queue_lock:
+                    self._active_file_ids.add(download.get_file_id())
+            return download
+
+    def _admit(self):
+        # called with the admission lock held
+        candidates = self._get_candidates()
+        if candidates:
+            self._last_profile = candidates[0].get_profile()
+        if not candidates or self._disk_space is None:
+            return candidates[0] if candidates else None
+        for download in candidates:
+            if self._reserve_space(download):
+                self._held_file_ids.discard(download.get_file_id())
+                self._last_profile = download.get_profile()
+                return download
+            if download.get_file_id() not in self._held_file_ids:
+                self._held_file_ids.add(download.get_file_id())
+                logger.warning("Not enough free space to download %s (%d bytes); holding it back",
+                               download.get_name(), download.get_size())
+        if self._max_attempts is not None and self._moving == 0 and not self._active_file_ids:
+            # nothing is in progress that would free up space, so don't wait forever
+            download = candidates[0]
+            logger.error("Giving up on %s: not enough free space", download.get_name())
+            with self._download_queue_lock:
+                self._dequeue(download)
+                self._queued_file_ids.difference_update(download.get_file_ids())
+            download.fail()
+            self._stats.on_abandoned(download)
+        return None
 
     def run(self):
-        """Main loop for the download manager"""
+        """Main loop for the download manager, run by each of ``max_downloads`` workers"""
+        workers = []
+        for i in range(1, self._max_downloads):
+            worker = threading.Thread(target=self._run_worker, name="DownloadManager-{}".format(i))
+            worker.setDaemon(True)
+            worker.start()
+            workers.append(worker)
+        self._run_worker()
+        for worker in workers:
+            worker.join()
+
+    def _run_worker(self):
         while not self._has_exit:
+            download = self._next_download()  # kept in the queue until complete
+            if download is None:
+                # don't busily spin (or repeatedly check free space)
+                with self._download_queue_lock:
+                    idle = len(self._download_queue) <= len(self._active_file_ids)
+                self._stop_event.wait(0.5 if idle else ADMISSION_RETRY_SECONDS)
+                continue
             try:
-                download = self._download_queue[0]  # keep in queue until complete
-            except IndexError:
-                time.sleep(0.5)  # don't busily spin
+                if not self._perform(download):
+                    break
+            finally:
+                with self._download_queue_lock:
+                    self._active_file_ids.discard(download.get_file_id())
+
+    def _perform(self, download):
+        """Perform an admitted download; returns False if stopped by a shutdown"""
+        profile = download.get_profile()
+        token = profile.token if profile is not None else self._token
+        success = download.perform_download(token, self._staging_directory, self._preallocate,
+                                             self._extract_archives, self._engine, self._stop_event,
+                                             connections=self._connections,
+                                             rate_limiter=self._rate_limiter)
+        if not success and self._stop_event.is_set():
+            return False  # left queued (and journaled) to be resumed on the next start
+        if self._disk_space is not None:
+            # what was written is now accounted for by the filesystem itself
+            self._disk_space.release(download.get_file_id(), download.get_part_path(self._staging_directory))
+        self._stats.on_finished(download, success)
+        if success and download.get_state() == MOVING:
+            self._move_to_destination(download)
+        elif self._disk_space is not None:
+            self._disk_space.release(download.get_file_id())
+        max_attempts = download.get_max_attempts() or self._max_attempts
+        with self._download_queue_lock:
+            self._dequeue(download)
+            if success:
+                if download.get_state() == DONE:
+                    self._queued_file_ids.difference_update(download.get_file_ids())
+            elif max_attempts is not None and download.get_attempts() >= max_attempts:
+                # give up; it stays in the journal as failed and is retried on the next start
+                self._queued_file_ids.difference_update(download.get_file_ids())
+                self._stats.on_abandoned(download)
+                return True
             else:
-                success = download.perform_download(self._token)
-                self._download_queue.popleft()
-                if not success:
-                    # re-add to the end of the queue for retry but do not keep any state that may have been
-                    # associated with the failed download
-                    self.add_download(Download(download.get_putio_file(),
-                                               download.get_destination_path()))
+                # re-add to the end of the queue for retry but do not keep any progress that
+                # may have been associated with the failed download
+                download.reset()
+                self._enqueue(download)
+        if not success and self._journal is not None:
+            self._journal.record(download)
+        return True
@@ -0,0 +1,364 @@
+"""Extract zip archives while they are being downloaded
+
+Segments of a download complete out of order, so the contiguous prefix of
+the file that has been written (the watermark) is tracked and a background
+thread feeds it to a streaming zip parser as it grows.  By the time the
+last byte has been downloaded, almost all of the archive has already been
+extracted.
+
+Only stored and deflated entries are supported.  Archives that cannot be
+extracted this way (other compression methods, encryption, entries whose
+size is only known from the central directory) are left for
+post-processing; any partially extracted files are removed.
+
+"""
+import logging
+import os
+import struct
+import threading
+import zlib
+
+logger = logging.getLogger("putiosync")
+
+_LOCAL_FILE_HEADER = b"PK\x03\x04"
+_CENTRAL_DIRECTORY = b"PK\x01\x02"
+_END_OF_CENTRAL_DIRECTORY = b"PK\x05\x06"
+_DATA_DESCRIPTOR = b"PK\x07\x08"
+_LOCAL_FILE_HEADER_FORMAT = struct.Struct("<4sHHHHHIIIHH")
+
+_STORED = 0
+_DEFLATED = 8
+_FLAG_ENCRYPTED = 0x1
+_FLAG_DATA_DESCRIPTOR = 0x8
+_FLAG_UTF8 = 0x800
+_ZIP64_EXTRA = 0x0001
+
+# parser states
+_HEADER = "header"
+_DATA = "data"
+_DESCRIPTOR = "descriptor"
+_DONE = "done"
+
+
+def is_extractable(name):
+    return name.lower().endswith(".zip")
+
+
+def get_extraction_directory(archive_path):
+    """Return the directory the archive at ``archive_path`` is extracted into"""
+    return os.path.splitext(archive_path)[0]
+
+
+class ExtractionError(Exception):
+    """The archive could not be extracted while streaming"""
+
+
+class _Entry(object):
+    def __init__(self, name, method, flags, crc32, compressed_size, size, zip64):
+        self.name = name
+        self.method = method
+        self.flags = flags
+        self.crc32 = crc32
+        self.compressed_size = compressed_size
+        self.size = size
+        self.zip64 = zip64
+        self.compressed_read = 0
+        self.running_crc32 = 0
+        self.decompressor = zlib.decompressobj(-15) if method == _DEFLATED else None
+        self.output = None
+
+
+class StreamingZipExtractor(object):
+    """Extract a zip archive from its bytes, provided in order with :meth:`feed`"""
+
+    def __init__(self, destination_directory):
+        self._destination_directory = os.path.abspath(destination_directory)
+        self._buffer = bytearray()
+        self._state = _HEADER
+        self._entry = None
+        self._extracted_paths = []
+
+    def get_extracted_paths(self):
+        return list(self._extracted_paths)
+
+    def is_done(self):
+        return self._state == _DONE
+
+    def feed(self, data):
+        """Process more of the archive; raises :class:`ExtractionError` if it cannot be extracted"""
+        if self._state == _DONE:
+            return
+        self._buffer.extend(data)
+        progress = True
+        while progress and self._state != _DONE:
+            if self._state == _HEADER:
+                progress = self._parse_header()
+            elif self._state == _DATA:
+                progress = self._parse_data()
+            else:
+                progress = self._parse_descriptor()
+
+    def close(self):
+        """Check that the whole archive was extracted"""
+        if self._entry is not None and self._entry.output is not None:
+            self._entry.output.close()
+        if self._state != _DONE:
+            raise ExtractionError("archive ended unexpectedly")
+
+    def remove_extracted(self):
+        """Remove everything extracted so far"""
+        if self._entry is not None and self._entry.output is not None:
+            self._entry.output.close()
+        for path in reversed(self._extracted_paths):
+            try:
+                if os.path.isdir(path):
+                    os.rmdir(path)
+                else:
+                    os.remove(path)
+            except OSError:
+                pass
+        self._extracted_paths = []
+
+    def _target_path(self, name):
+        path = os.path.abspath(os.path.join(self._destination_directory, name))
+        if os.path.commonprefix([path + os.sep, self._destination_directory + os.sep]) != \
+                self._destination_directory + os.sep:
+            raise ExtractionError("entry {!r} would be extracted outside of the destination".format(name))
+        return path
+
+    def _makedirs(self, path):
+        missing = []
+        while not os.path.isdir(path):
+            missing.append(path)
+            path = os.path.dirname(path)
+        for directory in reversed(missing):
+            os.mkdir(directory)
+            self._extracted_paths.append(directory)
+
+    def _parse_header(self):
+        signature = bytes(self._buffer[:4])
+        if len(signature) < 4:
+            return False
+        if signature in (_CENTRAL_DIRECTORY, _END_OF_CENTRAL_DIRECTORY):
+            self._state = _DONE
+            return False
+        if signature != _LOCAL_FILE_HEADER:
+            raise ExtractionError("unexpected data in archive")
+        if len(self._buffer) < _LOCAL_FILE_HEADER_FORMAT.size:
+            return False
+        (_, _, flags, method, _, _, crc32, compressed_size, size,
+         name_length, extra_length) = _LOCAL_FILE_HEADER_FORMAT.unpack_from(self._buffer)
+        header_length = _LOCAL_FILE_HEADER_FORMAT.size + name_length + extra_length
+        if len(self._buffer) < header_length:
+            return False
+        name = bytes(self._buffer[_LOCAL_FILE_HEADER_FORMAT.size:_LOCAL_FILE_HEADER_FORMAT.size + name_length])
+        extra = bytes(self._buffer[_LOCAL_FILE_HEADER_FORMAT.size + name_length:header_length])
+        del self._buffer[:header_length]
+
+        name = name.decode("utf-8" if flags & _FLAG_UTF8 else "cp437")
+        if flags & _FLAG_ENCRYPTED:
+            raise ExtractionError("{} is encrypted".format(name))
+        if method not in (_STORED, _DEFLATED):
+            raise ExtractionError("{} uses unsupported compression method {}".format(name, method))
+        compressed_size, size, zip64 = self._parse_zip64_extra(extra, compressed_size, size)
+        if method == _STORED and flags & _FLAG_DATA_DESCRIPTOR:
+            raise ExtractionError("size of stored entry {} is not known up front".format(name))
+
+        entry = _Entry(name, method, flags, crc32, compressed_size, size, zip64)
+        path = self._target_path(name)
+        if name.endswith("/"):
+            self._makedirs(path)
+        else:
+            self._makedirs(os.path.dirname(path))
+            entry.output = open(path, "wb")
+            self._extracted_paths.append(path)
+        self._entry = entry
+        self._state = _DATA
+        return True
+
+    def _parse_zip64_extra(self, extra, compressed_size, size):
+        """Return (compressed_size, size, is_zip64) taking the zip64 extra field into account"""
+        offset = 0
+        while offset + 4 <= len(extra):
+            header_id, data_size = struct.unpack_from("<HH", extra, offset)
+            if header_id == _ZIP64_EXTRA:
+                # only the fields that did not fit in the header are present, in this order
+                field_offset = offset + 4
+                if size == 0xFFFFFFFF and field_offset + 8 <= len(extra):
+                    size = struct.unpack_from("<Q", extra, field_offset)[0]
+                    field_offset += 8
+                if compressed_size == 0xFFFFFFFF and field_offset + 8 <= len(extra):
+                    compressed_size = struct.unpack_from("<Q", extra, field_offset)[0]
+                return compressed_size, size, True
+            offset += 4 + data_size
+        return compressed_size, size, False
+
+    def _write(self, data):
+        entry = self._entry
+        entry.running_crc32 = zlib.crc32(data, entry.running_crc32)
+        if entry.output is not None:
+            entry.output.write(data)
+
+    def _parse_data(self):
+        entry = self._entry
+        if entry.decompressor is None:
+            # stored; the size is known
+            take = min(len(self._buffer), entry.compressed_size - entry.compressed_read)
+            if take:
+                self._write(bytes(self._buffer[:take]))
+                del self._buffer[:take]
+                entry.compressed_read += take
+            finished = entry.compressed_read == entry.compressed_size
+        else:
+            if not self._buffer:
+                return False
+            data = bytes(self._buffer)
+            del self._buffer[:]
+            self._write(entry.decompressor.decompress(data))
+            finished = entry.decompressor.eof
+            unused = entry.decompressor.unused_data
+            entry.compressed_read += len(data) - len(unused)
+            self._buffer.extend(unused)
+        if not finished:
+            return False
+        if entry.output is not None:
+            entry.output.close()
+            entry.output = None
+        if entry.flags & _FLAG_DATA_DESCRIPTOR:
+            self._state = _DESCRIPTOR
+        else:
+            self._finish_entry(entry.crc32)
+            self._state = _HEADER
+        return True
+
+    def _parse_descriptor(self):
+        # [signature] crc32 compressed_size size, with 4 or 8 byte sizes.  Wait for
+        # enough data to see the signature of the record following the longest form
+        offset = 4 if self._buffer[:4] == _DATA_DESCRIPTOR else 0
+        if len(self._buffer) < offset + 24:
+            return False
+        crc32 = struct.unpack_from("<I", self._buffer, offset)[0]
+        lengths = (offset + 20, offset + 12) if self._entry.zip64 else (offset + 12, offset + 20)
+        for length in lengths:
+            if bytes(self._buffer[length:length + 4]) in (_LOCAL_FILE_HEADER, _CENTRAL_DIRECTORY,
+                                                         _END_OF_CENTRAL_DIRECTORY):
+                break
+        else:
+            raise ExtractionError("malformed data descriptor for {}".format(self._entry.name))
+        del self._buffer[:length]
+        self._finish_entry(crc32)
+        self._state = _HEADER
+        return True
+
+    def _finish_entry(self, expected_crc32):
+        entry = self._entry
+        if entry.running_crc32 & 0xFFFFFFFF != expected_crc32:
+            raise ExtractionError("CRC mismatch for {}".format(entry.name))
+        self._entry = None
+
+
+class ContiguousRanges(object):
+    """Track which ranges of a file have been written and how far the contiguous prefix extends"""
+
+    def __init__(self):
+        self._watermark = 0
+        self._starts = {}  # start -> end of ranges written beyond the watermark
+        self._ends = {}  # end -> start of the same ranges
+
+    def get_watermark(self):
+        return self._watermark
+
+    def add(self, offset, length):
+        """Record that ``length`` bytes were written at ``offset``; returns the new watermark"""
+        start, end = offset, offset + length
+        if start <= self._watermark:
+            self._watermark = max(self._watermark, end)
+        else:
+            # extend a range this one follows (the usual case within a segment)
+            start = self._ends.pop(start, start)
+            self._starts[start] = end
+            self._ends[end] = start
+        while self._watermark in self._starts:
+            end = self._starts.pop(self._watermark)
+            del self._ends[end]
+            self._watermark = end
+        return self._watermark
+
+
+class StreamingExtraction(threading.Thread):
+    """Extract an archive from a file that is being written to, up to its watermark
+
+    The download calls :meth:`advance` as its contiguous prefix grows and
+    :meth:`finish` (or :meth:`cancel`) when it is done.
+
+    """
+
+    def __init__(self, archive_path, destination_directory, read_size=1024 * 1024):
+        threading.Thread.__init__(self, name="StreamingExtraction")
+        self.setDaemon(True)
+        self._archive_path = archive_path
+        self._extractor = StreamingZipExtractor(destination_directory)
+        self._read_size = read_size
+        self._condition = threading.Condition()
+        self._watermark = 0
+        self._complete = False
+        self._cancelled = False
+        self._error = None
+
+    def advance(self, watermark):
+        with self._condition:
+            if watermark > self._watermark:
+                self._watermark = watermark
+                self._condition.notify()
+
+    def cancel(self):
+        """Stop extracting and remove what was extracted"""
+        with self._condition:
+            self._cancelled = True
+            self._condition.notify()
+        self.join()
+
+    def finish(self, size):
+        """Extract the rest of the archive of ``size`` bytes; returns True if it was extracted"""
+        with self._condition:
+            self._watermark = size
+            self._complete = True
+            self._condition.notify()
+        self.join()
+        if self._error is not None:
+            logger.warning("Unable to extract %s while downloading: %s", self._archive_path, self._error)
+            return False
+        return True
+
+    def run(self):
+        position = 0
+        try:
+            # unbuffered: read-ahead past the watermark would see unwritten (e.g. preallocated) space
+            with open(self._archive_path, "rb", buffering=0) as f:
+                while True:
+                    with self._condition:
+                        while position >= self._watermark and not (self._complete or self._cancelled):
+                            self._condition.wait()
+                        if self._cancelled:
+                            break
+                        watermark, complete = self._watermark, self._complete
+                    while position < watermark and not self._extractor.is_done():
+                        f.seek(position)
+                        data = f.read(min(self._read_size, watermark - position))
+                        if not data:
+                            raise ExtractionError("archive is shorter than expected")
+                        self._extractor.feed(data)
+                        position += len(data)
+                    if complete or self._extractor.is_done():
+                        if complete:
+                            self._extractor.close()
+                        else:
+                            # wait for the download to finish; the rest is the central directory
+                            with self._condition:
+                                while not (self._complete or self._cancelled):
+                                    self._condition.wait()
+                        break
+        except (ExtractionError, IOError, OSError, zlib.error) as e:
+            self._error = e
+        if self._error is not None or self._cancelled:
+            self._extractor.remove_extracted()
@@ -0,0 +1,217 @@
+"""Include/exclude rules for selecting which remote files are synchronized
+
+Rules are matched against the full remote path of a file (e.g.
+``/TV/Some Show/episode.mkv``).  Two kinds of rules are supported:
+
+* glob rules, where ``*`` and ``?`` do not cross directory boundaries,
+  ``**`` matches any number of directories and ``[...]`` is a character
+  class.  Globs starting with ``/`` must match the whole path while
+  others may match at any depth (``*.mkv`` selects every ``.mkv`` file,
+  ``Sample`` every directory or file of that name).
+* regex rules, which behave like ``re.match`` (anchored at the start
+  of the path only).  This is how ``--filter`` has always behaved.
+
+A path is selected if it matches at least one include rule (or there are
+no include rules) and neither it nor any of its parent directories match
+an exclude rule.
+
+Beyond matching individual paths, a :class:`PathFilter` can tell whether
+anything below a directory could possibly be selected.  This lets the
+synchronizer skip listing remote directories that can never contain a
+match.
+
+"""
+import re
+
+GLOB = "glob"
+REGEX = "regex"
+
+_REGEX_SPECIAL = set(".^$*+?{}[]|()\\")
+
+
+def _glob_to_regex(pattern):
+    i, n = 0, len(pattern)
+    # paths always start with "/"; relative globs are anchored below any directory
+    out = [] if pattern.startswith("/") else ["(?:.*/)?"]
+    while i < n:
+        c = pattern[i]
+        if c == "*":
+            if pattern[i:i + 3] == "**/":
+                out.append("(?:.*/)?")
+                i += 3
+                continue
+            elif pattern[i:i + 2] == "**":
+                out.append(".*")
+                i += 2
+                continue
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[":
+            j = pattern.find("]", i + 2)
+            if j == -1:
+                out.append("\\[")
+            else:
+                body = pattern[i + 1:j]
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                out.append("[{}]".format(body.replace("\\", "\\\\")))
+                i = j
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return "".join(out) + r"\Z"
+
+
+def _glob_literal_prefix(pattern):
+    if not pattern.startswith("/"):
+        return ""  # matches at any depth
+    for i, c in enumerate(pattern):
+        if c in "*?[":
+            return pattern[:i]
+    return pattern
+
+
+def _regex_literal_prefix(pattern):
+    """Return the literal text every match of ``pattern`` must start with
+
+    This is deliberately conservative: anything we do not fully understand
+    ends the prefix, which at worst means that a directory is listed
+    when it did not need to be.
+
+    """
+    if "|" in pattern:
+        return ""
+    prefix = []
+    i = 1 if pattern.startswith("^") else 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\":
+            if i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+                c = pattern[i + 1]
+                i += 1
+            else:
+                break  # \d, \w, etc.
+        elif c in _REGEX_SPECIAL:
+            if c in "*?{" and prefix:
+                prefix.pop()  # previous character is optional or repeated
+            break
+        prefix.append(c)
+        i += 1
+    return "".join(prefix)
+
+
+class FilterRule(object):
+    """A single glob or regex rule"""
+
+    def __init__(self, pattern, kind=GLOB):
+        if kind not in (GLOB, REGEX):
+            raise ValueError("Unknown filter rule kind: {}".format(kind))
+        self.pattern = pattern
+        self.kind = kind
+        if kind == GLOB:
+            self.regex = _glob_to_regex(pattern)
+            self.literal_prefix = _glob_literal_prefix(pattern)
+        else:
+            self.regex = pattern
+            self.literal_prefix = _regex_literal_prefix(pattern)
+        re.compile(self.regex)  # raises re.error for invalid rules
+
+    @classmethod
+    def parse(cls, spec, default_kind=GLOB):
+        """Parse a rule from the command line
+
+        Rules may be prefixed with ``glob:`` or ``re:`` to select their kind,
+        otherwise ``default_kind`` is used.
+
+        """
+        if spec.startswith("re:"):
+            return cls(spec[3:], REGEX)
+        elif spec.startswith("glob:"):
+            return cls(spec[5:], GLOB)
+        return cls(spec, default_kind)
+
+    def could_match_below(self, directory):
+        """Return False if no path below ``directory`` can match this rule"""
+        directory = directory.rstrip("/") + "/"
+        prefix = self.literal_prefix
+        return directory.startswith(prefix) or prefix.startswith(directory)
+
+    def __repr__(self):
+        return "<FilterRule {}:{!r}>".format(self.kind, self.pattern)
+
+
+def _compile(rules):
+    if not rules:
+        return None
+    try:
+        return re.compile("|".join("(?:{})".format(rule.regex) for rule in rules))
+    except re.error:
+        # e.g. rules relying on group numbering; fall back to matching each rule
+        compiled = [re.compile(rule.regex) for rule in rules]
+
+        class _AnyOf(object):
+            def match(self, path):
+                for regex in compiled:
+                    m = regex.match(path)
+                    if m is not None:
+                        return m
+                return None
+
+        return _AnyOf()
+
+
+class PathFilter(object):
+    """Set of include and exclude rules compiled into a single matcher"""
+
+    def __init__(self, includes=(), excludes=()):
+        self.includes = list(includes)
+        self.excludes = list(excludes)
+        self._include_matcher = _compile(self.includes)
+        self._exclude_matcher = _compile(self.excludes)
+
+    def _is_excluded(self, path):
+        if self._exclude_matcher is None:
+            return False
+        # a rule excluding a directory also excludes everything below it
+        while path:
+            if self._exclude_matcher.match(path) is not None:
+                return True
+            path = path.rpartition("/")[0]
+        return False
+
+    def matches(self, path):
+        """Return True if the file at ``path`` should be synchronized"""
+        if self._is_excluded(path):
+            return False
+        if self._include_matcher is None:
+            return True
+        return self._include_matcher.match(path) is not None
+
+    def could_match_below(self, directory):
+        """Return False if nothing within ``directory`` can be synchronized
+
+        When this returns False there is no need to list the directory.
+
+        """
+        if self._is_excluded(directory.rstrip("/")):
+            return False
+        if not self.includes:
+            return True
+        return any(rule.could_match_below(directory) for rule in self.includes)
+
+
+def build_path_filter(regexes=None, includes=None, excludes=None):
+    """Build a :class:`PathFilter` from command line style rules, or None if there are none
+
+    ``regexes`` are plain regular expressions (as given to ``--filter``) while
+    ``includes`` and ``excludes`` are parsed with :meth:`FilterRule.parse`.
+    Raises ``re.error`` if a rule is invalid.
+
+    """
+    if not regexes and not includes and not excludes:
+        return None
+    include_rules = [FilterRule(f, REGEX) for f in regexes or []]
+    include_rules += [FilterRule.parse(f) for f in includes or []]
+    exclude_rules = [FilterRule.parse(f) for f in excludes or []]
+    return PathFilter(include_rules, exclude_rules)
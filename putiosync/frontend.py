@@ -1,16 +1,22 @@
 import argparse
 import shlex
+import signal
 import sys
 import threading
 import subprocess
-import putiopy
+import time
 import re
 import logging
-from pid import PidFile
+import os
+from putiosync import tracing
+from putiosync.api_client import get_client
 from putiosync.core import TokenManager, PutioSynchronizer, DatabaseManager
-from putiosync.download_manager import DownloadManager
-from putiosync.watcher import TorrentWatcher
-from putiosync.webif.webif import WebInterface
+from putiosync.deletion_queue import DeletionQueue
+from putiosync.diskspace import DiskSpaceManager
+from putiosync.download_manager import DownloadManager, DownloadQueueJournal
+from putiosync.bandwidth import TokenBucket
+from putiosync.filters import build_path_filter
+from putiosync.profiles import Profile, ProfileError, load_profiles
 
 __author__ = 'Paul Osborne'
 
@@ -43,12 +49,37 @@ def parse_arguments():
         default=False,
         help="Prevent browser from launching on start."
     )
+    parser.add_argument(
+        "--once",
+        action="store_true",
+        default=False,
+        help=(
+            "Check put.io once, download everything found and exit.  The web interface, "
+            "torrent watcher and transfer tracking are not started.  The exit status is "
+            "non-zero if the check or any download failed."
+        )
+    )
     parser.add_argument(
         "-p", "--poll-frequency",
         default=60 * 3,
         type=int,
         help="Polling frequency in seconds (default: 3 minutes)",
     )
+    parser.add_argument(
+        "--transfer-driven",
+        action="store_true",
+        default=False,
+        help=(
+            "Queue the output of put.io transfers as soon as they complete instead of relying "
+            "on polling.  A full scan is still performed every --reconcile-frequency seconds."
+        ),
+    )
+    parser.add_argument(
+        "--reconcile-frequency",
+        default=60 * 60,
+        type=int,
+        help="With --transfer-driven, seconds between full scans of put.io (default: 1 hour)",
+    )
     parser.add_argument(
         "--pid",
         default=None,
@@ -67,6 +98,28 @@ def parse_arguments():
         type=str,
         help="Path where the log file for the web interface should be stored (default: None)",
     )
+    parser.add_argument(
+        "--trace-file",
+        default=None,
+        type=str,
+        help=(
+            "Path of a file to which timing of each stage of syncing and downloading "
+            "(listing, history checks, transfer, rename, deletion, post-processing) is "
+            "written as JSON lines.  The file is rotated as it grows (default: None)"
+        ),
+    )
+    parser.add_argument(
+        "--profile-output",
+        default=None,
+        metavar="PATH",
+        type=str,
+        help=(
+            "Run a sampling profiler.  Flame graph compatible output is written to PATH "
+            "(e.g. ~/.putiosync/profile.folded) on SIGUSR1 and on exit, and is available "
+            "from the web interface at /admin/profile (POST to /admin/profile/reset to "
+            "start over)"
+        ),
+    )
     parser.add_argument(
         "--log-level",
         default="debug",
@@ -94,6 +147,142 @@ def parse_arguments():
             "automatically downloaded by the daemon when complete."
         )
     )
+    parser.add_argument(
+        "--watch-done-directory",
+        default=None,
+        type=str,
+        help=(
+            "Directory to which torrent and magnet files from the watch directory are moved "
+            "once they have been added to put.io (default: leave them in place)"
+        )
+    )
+    parser.add_argument(
+        "--staging-directory",
+        default=None,
+        type=str,
+        help=(
+            "Directory on fast local storage into which files are downloaded before being "
+            "moved to the download directory in the background.  Post-processing runs once "
+            "a file has been moved.  Useful when the download directory is on a slow array "
+            "or network share (default: download directly into the download directory)"
+        )
+    )
+    parser.add_argument(
+        "--moves-per-device",
+        default=1,
+        type=int,
+        help="Number of files moved out of the staging directory at once to each device. Default: 1"
+    )
+    parser.add_argument(
+        "--min-free-space",
+        default=0,
+        type=int,
+        help=(
+            "Megabytes to keep free on the filesystems downloads are written to.  Downloads "
+            "are only started once space for the whole file (in addition to this) is "
+            "available; ones that do not fit are held back while smaller ones proceed. "
+            "Default: 0 (downloads are started regardless of free space)"
+        )
+    )
+    parser.add_argument(
+        "--preallocate",
+        action="store_true",
+        default=False,
+        help=(
+            "Allocate space for the whole file before downloading it to reduce fragmentation. "
+            "Avoid this on network or FUSE filesystems (e.g. NFS, SMB) without native support, "
+            "where every block is written up front"
+        )
+    )
+    parser.add_argument(
+        "--dedupe",
+        default="off",
+        choices=["off", "reflink", "hardlink"],
+        help=(
+            "When a file with the same size and CRC32 as one downloaded before is found on "
+            "put.io under a new name or id, link the existing local copy into place instead "
+            "of downloading it again.  'reflink' makes an independent copy-on-write clone "
+            "(btrfs, XFS); 'hardlink' also falls back to a hard link, so changes "
+            "to one copy affect the other. Default: off"
+        )
+    )
+    parser.add_argument(
+        "--extract-archives",
+        action="store_true",
+        default=False,
+        help=(
+            "Extract zip archives while they are being downloaded, into a directory named "
+            "after the archive next to it.  Archives that cannot be extracted this way are "
+            "left for post-processing"
+        )
+    )
+    parser.add_argument(
+        "--bundle-small-files",
+        default=None,
+        type=int,
+        metavar="MIN_FILES",
+        help=(
+            "Download small files (see --small-file-size) as a single zip created by put.io "
+            "when a directory has at least this many of them, rather than one at a time "
+            "(default: off)"
+        )
+    )
+    parser.add_argument(
+        "--small-file-size",
+        default=1024,
+        type=int,
+        help="Largest file, in KB, that is bundled by --bundle-small-files. Default: 1024"
+    )
+    parser.add_argument(
+        "--engine",
+        default="threads",
+        choices=["threads", "processes", "asyncio"],
+        help=(
+            "How file segments are downloaded: 'threads' (default) or 'processes', where a "
+            "pool of processes fetches segments and writes them to disk.  'processes' can "
+            "make use of several cores on multi-gigabit links.  'asyncio' crawls put.io and "
+            "downloads on a single event loop (requires 'pip install aiohttp'); staging, "
+            "bundling, deduplication, archive extraction, the web interface and the torrent "
+            "watcher are not available with it"
+        )
+    )
+    parser.add_argument(
+        "--processes",
+        default=8,
+        type=int,
+        help="Number of download processes used by '--engine processes'. Default: 8"
+    )
+    parser.add_argument(
+        "--max-downloads",
+        default=None,
+        type=int,
+        help=(
+            "Number of files downloaded at once.  Default: 4 with '--engine asyncio', otherwise one "
+            "for each profile (profiles take turns starting downloads)"
+        )
+    )
+    parser.add_argument(
+        "--max-connections",
+        default=16,
+        type=int,
+        help="Number of data connections open at once with '--engine asyncio'. Default: 16"
+    )
+    parser.add_argument(
+        "--max-listings",
+        default=8,
+        type=int,
+        help="Number of put.io API requests in flight at once with '--engine asyncio'. Default: 8"
+    )
+    parser.add_argument(
+        "--shutdown-timeout",
+        default=8,
+        type=float,
+        help=(
+            "Seconds allowed for a graceful shutdown on SIGTERM or Ctrl-C: the active download "
+            "is stopped with its progress saved so that it resumes on the next start.  Keep "
+            "this below your container's stop timeout. Default: 8"
+        )
+    )
     parser.add_argument(
         "--host",
         default="0.0.0.0",
@@ -106,32 +295,260 @@ def parse_arguments():
         type=int,
         help="Port where the webserver should listen to. Default: 7001"
     )
+    parser.add_argument(
+        "--web-server",
+        default="flask",
+        choices=["flask", "waitress"],
+        help=(
+            "Server used for the web interface: 'flask' (the built-in development server) "
+            "or 'waitress' (requires 'pip install waitress'; recommended when several "
+            "dashboards or Transmission clients poll putio-sync). Default: flask"
+        )
+    )
+    parser.add_argument(
+        "--web-threads",
+        default=8,
+        type=int,
+        help="Number of threads serving web requests when using waitress. Default: 8"
+    )
     parser.add_argument(
         "-f", "--filter",
         default=None,
+        action="append",
         type=str,
         help=(
             "Filter for excluding or including specific files/folders from downloading. "
-            "The filter is a regular expression (regex). "
-            "Example: putio-sync -f '/some/folder/*.avi' /path/to/Downloads"
+            "The filter is a regular expression (regex) matched against the start of the path. "
+            "May be given multiple times; files matching any filter are downloaded. "
+            "Example: putio-sync -f '/some/folder/.*\\.avi' /path/to/Downloads"
+        )
+    )
+    parser.add_argument(
+        "--include",
+        default=None,
+        action="append",
+        type=str,
+        help=(
+            "Only download files matching this glob (may be given multiple times). "
+            "'*' does not cross directories, '**' does.  Globs starting with '/' match the "
+            "whole remote path, others match at any depth.  Prefix with 're:' to use a regex. "
+            "Remote directories that cannot contain a match are never listed. "
+            "Example: putio-sync --include '/TV/**/*.mkv' /path/to/Downloads"
+        )
+    )
+    parser.add_argument(
+        "--exclude",
+        default=None,
+        action="append",
+        type=str,
+        help=(
+            "Do not download files matching this glob, or anything within directories "
+            "matching it (may be given multiple times).  Prefix with 're:' to use a regex. "
+            "Example: putio-sync --exclude '**/Sample' /path/to/Downloads"
+        )
+    )
+    parser.add_argument(
+        "--profiles",
+        default=None,
+        type=str,
+        help=(
+            "JSON file describing several accounts and/or folders to synchronize, each to its "
+            "own directory with its own filters (see putiosync/profiles.py for the format).  "
+            "All profiles share one download queue, taking turns, and one web interface; by "
+            "default one file is downloaded at once for each profile (see --max-downloads).  "
+            "The download directory and filter options are then not used"
+        )
+    )
+    parser.add_argument(
+        "--connections",
+        default=4,
+        type=int,
+        help=(
+            "Number of connections used to download files with the default engine, in total: "
+            "they are shared between the files downloaded at once (see --max-downloads), "
+            "across all profiles.  Default: 4"
         )
     )
+    parser.add_argument(
+        "--max-bandwidth",
+        default=None,
+        type=int,
+        help="Limit the total download rate (across all downloads and profiles) to this many KB/s"
+    )
     parser.add_argument(
         "download_directory",
-        help="Directory into which files should be downloaded"
+        nargs="?",
+        help="Directory into which files should be downloaded (not used with --profiles)"
     )
     args = parser.parse_args()
+    if args.download_directory is None and args.profiles is None:
+        parser.error("a download directory (or --profiles) is required")
+    if args.engine == "asyncio":
+        unsupported = [
+            ("--profiles", args.profiles is not None),
+            ("--staging-directory", args.staging_directory is not None),
+            ("--bundle-small-files", args.bundle_small_files is not None),
+            ("--dedupe", args.dedupe != "off"),
+            ("--extract-archives", args.extract_archives),
+            ("--min-free-space", args.min_free_space != 0),
+            ("--watch-directory", args.watch_directory is not None),
+            ("--transfer-driven", args.transfer_driven),
+        ]
+        for option, given in unsupported:
+            if given:
+                parser.error("{} is not supported by '--engine asyncio'".format(option))
     return args
 
 
 def build_postprocess_download_completion_callback(postprocess_command):
     def download_completed(download):
-        cmd=postprocess_command.format(download.get_destination_path().encode('utf-8'))
+        cmd=postprocess_command.format(download.get_destination_path())
         logger.info("Postprocess: {0}".format(cmd))
-        subprocess.call(cmd, shell=True)
+        with tracing.span("postprocess", file_id=download.get_file_id()):
+            subprocess.call(cmd, shell=True)
 
     return download_completed
 
+def _pretty_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return "%0.2f %s" % (size, unit)
+        size /= 1024.
+    return "%0.2f TB" % size
+
+
+def build_engine(args):
+    """Return the download engine selected on the command line (None for the default)"""
+    if args.engine == "processes":
+        from putiosync.process_downloader import ProcessDownloadEngine
+        return ProcessDownloadEngine(num_processes=args.processes,
+                                     max_bytes_per_second=args.max_bandwidth * 1024 if args.max_bandwidth else None)
+    return None
+
+
+def build_profiles(args, token):
+    """Return the profiles to synchronize: those in --profiles or one from the other options"""
+    if args.profiles is not None:
+        try:
+            return load_profiles(args.profiles, token)
+        except ProfileError as e:
+            print(e)
+            exit(1)
+    try:
+        download_filter = build_path_filter(args.filter, args.include, args.exclude)
+    except re.error as e:
+        print("Invalid filter: {0}".format(e))
+        exit(1)
+    force_keep = None
+    if args.force_keep is not None:
+        try:
+            force_keep = re.compile(args.force_keep)
+        except re.error as e:
+            print("Invalid force_keep regex: {0}".format(e))
+            exit(1)
+    return [Profile(None, token, args.download_directory, download_filter=download_filter, force_keep=force_keep,
+                    keep_files=args.keep)]
+
+
+def _print_summary(stats, duration, check_succeeded):
+    print("Downloaded {} file(s), {} in {:.1f}s ({}/s); {} failed".format(
+        stats.session_files_completed,
+        _pretty_size(stats.session_downloaded_bytes),
+        duration,
+        _pretty_size(stats.session_downloaded_bytes / duration if duration > 0 else 0),
+        stats.session_files_failed))
+    if not check_succeeded:
+        print("Check of put.io failed; not everything may have been downloaded")
+    return 0 if check_succeeded and stats.session_files_failed == 0 else 1
+
+
+def install_signal_handlers(exit_status):
+    """Exit on SIGTERM or SIGINT by raising SystemExit on the main thread
+
+    This unwinds the main thread (running any ``finally`` blocks that shut
+    down cleanly) rather than killing the process.  A second signal exits
+    immediately.
+
+    """
+    def handle_signal(signum, frame):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        logger.warning("Received signal %d; shutting down", signum)
+        raise SystemExit(exit_status)
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+
+def shutdown(download_manager, journal, timeout):
+    """Stop downloading and persist progress and the queue"""
+    with tracing.span("shutdown"):
+        if not download_manager.shutdown(timeout):
+            logger.warning("Shutdown did not finish within %.0fs; some progress may be lost", timeout)
+        journal.flush()
+
+
+def _synchronizer_thread_name(synchronizer):
+    profile = synchronizer.get_profile()
+    if profile is None or profile.name is None:
+        return "PutioSynchronizer"
+    return "PutioSynchronizer-{}".format(profile.name)
+
+
+def run_once(synchronizers, download_manager, journal, db_manager):
+    """Synchronize every profile once, print a summary and return the exit status"""
+    start = time.time()
+    if len(synchronizers) == 1:
+        check_succeeded = synchronizers[0].sync_once()
+    else:
+        # check all profiles at once; each waits until its own downloads are complete
+        results = []
+
+        def sync_once(synchronizer):
+            try:
+                results.append(synchronizer.sync_once())
+            finally:
+                db_manager.remove_db_session()
+
+        threads = [threading.Thread(target=sync_once, args=(s,), name=_synchronizer_thread_name(s))
+                   for s in synchronizers]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        check_succeeded = len(results) == len(synchronizers) and all(results)
+    journal.flush()
+    return _print_summary(download_manager.get_stats(), time.time() - start, check_succeeded)
+
+
+def run_async_engine(args, token, db_manager, profile, rate_limiter):
+    """Synchronize using the asyncio engine; returns the exit status with --once"""
+    from putiosync.aio_engine import AsyncSyncEngine
+    # deletions are persisted so that they survive a restart, as with the threaded engine
+    deletion_queue = DeletionQueue(get_client(token), db_manager)
+    deletion_queue.start()
+    engine = AsyncSyncEngine(
+        token, profile.download_directory, db_manager,
+        keep_files=profile.keep_files,
+        poll_frequency=args.poll_frequency,
+        download_filter=profile.download_filter,
+        force_keep=profile.force_keep,
+        max_listings=args.max_listings,
+        max_downloads=args.max_downloads or 4,
+        max_connections=args.max_connections,
+        max_attempts=3 if args.once else 10,
+        post_process_command=args.post_process_command,
+        rate_limiter=rate_limiter,
+        deletion_queue=deletion_queue)
+    if not args.once:
+        print("Note: the web interface and Transmission RPC are not started with '--engine asyncio'")
+        engine.run_forever()
+        return 0
+    start = time.time()
+    check_succeeded = engine.sync_once()
+    return _print_summary(engine, time.time() - start, check_succeeded)
+
+
 def start_sync(args):
 
     formatter = logging.Formatter('%(asctime)s | %(name)-12s | %(levelname)-8s | %(message)s')
@@ -186,55 +603,132 @@ def start_sync(args):
         token = token_manager.obtain_token()
     token_manager.save_token(token)
 
+    if args.web_server == "waitress" and not args.once:
+        try:
+            import waitress  # noqa: F401
+        except ImportError:
+            print("--web-server waitress requires waitress to be installed (pip install waitress)")
+            return 1
+
+    if args.engine == "asyncio":
+        try:
+            import aiohttp  # noqa: F401
+        except ImportError:
+            print("--engine asyncio requires aiohttp to be installed (pip install aiohttp)")
+            return 1
+
+    if args.trace_file is not None:
+        tracing.configure(args.trace_file)
+
+    profiler = None
+    if args.profile_output is not None:
+        from putiosync.profiler import SamplingProfiler
+        profiler = SamplingProfiler()
+        profiler.install_signal_handler(args.profile_output)
+        profiler.start()
+
+    profiles = build_profiles(args, token)
+    rate_limiter = TokenBucket(args.max_bandwidth * 1024) if args.max_bandwidth else None
+
     # Let's start syncing!
-    putio_client = putiopy.Client(token)
+    install_signal_handlers(1 if args.once else 0)
     db_manager = DatabaseManager()
-    download_manager = DownloadManager(token=token)
+    if args.engine == "asyncio":
+        try:
+            return run_async_engine(args, token, db_manager, profiles[0], rate_limiter)
+        finally:
+            if profiler is not None:
+                profiler.dump(args.profile_output)
+
+    putio_client = get_client(token)
+    journal = DownloadQueueJournal(db_manager)
+    journal.start()
+    download_manager = DownloadManager(token=token, journal=journal, max_attempts=3 if args.once else None,
+                                       staging_directory=args.staging_directory,
+                                       moves_per_device=args.moves_per_device,
+                                       disk_space=(DiskSpaceManager(args.min_free_space * 1024 * 1024)
+                                                   if args.min_free_space else None),
+                                       preallocate=args.preallocate,
+                                       extract_archives=args.extract_archives,
+                                       engine=build_engine(args),
+                                       connections=args.connections,
+                                       rate_limiter=rate_limiter,
+                                       max_downloads=args.max_downloads or len(profiles))
     if args.post_process_command is not None:
         download_manager.add_download_completion_callback(
             build_postprocess_download_completion_callback(args.post_process_command))
 
-    if args.watch_directory is not None:
-        torrent_watcher = TorrentWatcher(args.watch_directory, putio_client)
-        torrent_watcher.start()
 
-    filter_compiled = None
-    if args.filter is not None:
-        try:
-            filter_compiled = re.compile(args.filter)
-        except re.error as e:
-            print("Invalid filter regex: {0}".format(e))
-            exit(1)
+    deletion_queue = DeletionQueue(putio_client, db_manager)
+    deletion_queue.start()
+    download_manager.start()
+    clients = {token: putio_client}
+    synchronizers = []
+    for profile in profiles:
+        if profile.token not in clients:
+            clients[profile.token] = get_client(profile.token)
+        deletion_queue.add_client(profile.name, clients[profile.token])
+        synchronizers.append(PutioSynchronizer(
+            download_directory=profile.download_directory,
+            putio_client=clients[profile.token],
+            db_manager=db_manager,
+            download_manager=download_manager,
+            keep_files=profile.keep_files,
+            poll_frequency=(profile.poll_frequency or
+                            (args.reconcile_frequency if args.transfer_driven else args.poll_frequency)),
+            download_filter=profile.download_filter,
+            force_keep=profile.force_keep,
+            disable_progress=args.log is not None or (args.max_downloads or len(profiles)) > 1,
+            deletion_queue=deletion_queue,
+            dedupe=None if args.dedupe == "off" else args.dedupe,
+            bundle_min_files=args.bundle_small_files,
+            bundle_max_file_size=args.small_file_size * 1024,
+            profile=profile if args.profiles is not None else None))
+    # the first profile's account is used for adding torrents and tracking transfers
+    synchronizer = synchronizers[0]
+    putio_client = clients[profiles[0].token]
+    try:
+        if args.once:
+            return run_once(synchronizers, download_manager, journal, db_manager)
 
-    force_keep_compiled = None
-    if args.force_keep is not None:
-        try:
-            force_keep_compiled = re.compile(args.force_keep)
-        except re.error as e:
-            print("Invalid force_keep regex: {0}".format(e))
-            exit(1)
+        # Start synchronizing (beginning with any persisted queue) before the
+        # optional subsystems below are imported and initialized
+        for s in synchronizers:
+            t = threading.Thread(target=s.run_forever, name=_synchronizer_thread_name(s))
+            t.setDaemon(True)
+            t.start()
 
-    download_manager.start()
-    synchronizer = PutioSynchronizer(
-        download_directory=args.download_directory,
-        putio_client=putio_client,
-        db_manager=db_manager,
-        download_manager=download_manager,
-        keep_files=args.keep,
-        poll_frequency=args.poll_frequency,
-        download_filter=filter_compiled,
-        force_keep=force_keep_compiled,
-        disable_progress=args.log is not None)
-    t = threading.Thread(target=synchronizer.run_forever)
-    t.setDaemon(True)
-    t.start()
-    web_interface = WebInterface(db_manager, download_manager, putio_client, synchronizer, launch_browser=(not args.quiet), host=args.host, port=args.port)
-    web_interface.run()
+        from putiosync.ingest import TorrentIngestQueue
+        ingest_queue = TorrentIngestQueue(putio_client)
+        ingest_queue.start()
+        if args.transfer_driven:
+            from putiosync.transfer_tracker import TransferTracker
+            transfer_tracker = TransferTracker(putio_client, synchronizer)
+            ingest_queue.add_added_callback(lambda transfer: transfer_tracker.track(transfer.id))
+            transfer_tracker.start()
+
+        if args.watch_directory is not None:
+            from putiosync.watcher import TorrentWatcher
+            torrent_watcher = TorrentWatcher(args.watch_directory, ingest_queue, db_manager,
+                                             done_directory=args.watch_done_directory)
+            torrent_watcher.start()
+
+        download_manager.get_stats().load_history_totals(db_manager.get_db_session())
+        from putiosync.webif.webif import WebInterface
+        web_interface = WebInterface(db_manager, download_manager, putio_client, synchronizer, launch_browser=(not args.quiet), host=args.host, port=args.port,
+                                     ingest_queue=ingest_queue, server=args.web_server, threads=args.web_threads,
+                                     profiler=profiler)
+        web_interface.run()
+    finally:
+        shutdown(download_manager, journal, args.shutdown_timeout)
+        if profiler is not None:
+            profiler.dump(args.profile_output)
 
 def main():
     args = parse_arguments()
 
     if args.pid is not None:
+        from pid import PidFile
         with PidFile(args.pid):
             return start_sync(args)
     else:
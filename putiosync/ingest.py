@@ -0,0 +1,213 @@
+"""Queue for adding torrents and magnet links to put.io
+
+Both the Transmission RPC interface and the torrent watcher used to upload
+torrents to put.io synchronously on the caller's thread.  Instead, they
+now submit them to a :class:`TorrentIngestQueue` which returns
+immediately.  Submissions are deduplicated by info-hash against recent
+submissions and uploaded by a small pool of worker threads that retry
+transient failures.
+
+"""
+import base64
+import binascii
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+import putiopy
+import requests
+from queue import Queue
+from urllib.parse import urlparse, parse_qs
+
+logger = logging.getLogger("putiosync")
+
+
+def _bencode_end(data, i):
+    """Return the index just past the bencoded value starting at ``data[i]``"""
+    c = data[i:i + 1]
+    if c == b"i":
+        return data.index(b"e", i) + 1
+    elif c in (b"l", b"d"):
+        i += 1
+        while data[i:i + 1] != b"e":
+            i = _bencode_end(data, i)
+        return i + 1
+    elif c.isdigit():
+        colon = data.index(b":", i)
+        return colon + 1 + int(data[i:colon])
+    raise ValueError("Invalid bencoded data at offset {}".format(i))
+
+
+def torrent_info_hash(data):
+    """Return the hex info-hash of the provided .torrent file contents"""
+    if data[:1] != b"d":
+        raise ValueError("Torrent data is not a bencoded dictionary")
+    i = 1
+    while data[i:i + 1] != b"e":
+        key_end = _bencode_end(data, i)
+        key = data[data.index(b":", i) + 1:key_end]
+        value_end = _bencode_end(data, key_end)
+        if key == b"info":
+            return hashlib.sha1(data[key_end:value_end]).hexdigest()
+        i = value_end
+    raise ValueError("Torrent has no info dictionary")
+
+
+def magnet_info_hash(uri):
+    """Return the hex info-hash of the provided magnet URI or None"""
+    if not uri.startswith("magnet:"):
+        return None
+    for xt in parse_qs(urlparse(uri).query).get("xt", []):
+        if xt.lower().startswith("urn:btih:"):
+            value = xt[9:]
+            if len(value) == 32:  # base32 encoded
+                return binascii.hexlify(base64.b32decode(value.upper())).decode("ascii")
+            return value.lower()
+    return None
+
+
+class _Submission(object):
+    __slots__ = ("kind", "payload", "key", "attempts", "done_callback")
+
+    def __init__(self, kind, payload, key, done_callback=None):
+        self.kind = kind  # "data" or "url"
+        self.payload = payload
+        self.key = key
+        self.attempts = 0
+        self.done_callback = done_callback
+
+
+class TorrentIngestQueue(object):
+    """Deduplicating, retrying queue of torrents to be added to put.io"""
+
+    def __init__(self, putio_client, num_workers=4, dedupe_seconds=60 * 60, max_attempts=5, retry_backoff=5):
+        self._putio_client = putio_client
+        self._num_workers = num_workers
+        self._dedupe_seconds = dedupe_seconds
+        self._max_attempts = max_attempts
+        self._retry_backoff = retry_backoff
+        self._queue = Queue()
+        self._recent_lock = threading.Lock()
+        self._recent = {}  # info-hash (or url) -> time submitted
+        self._added_callbacks = set()
+        self._workers = []
+
+    def start(self):
+        """Start the upload workers"""
+        for i in range(self._num_workers):
+            worker = threading.Thread(target=self._run_worker, name="TorrentIngest #{}".format(i + 1))
+            worker.setDaemon(True)
+            worker.start()
+            self._workers.append(worker)
+
+    def add_added_callback(self, added_callback):
+        """Add a callback to be called whenever a transfer has been added to put.io
+
+        The callback will be called as follows::
+
+            added_callback(transfer)
+
+        """
+        self._added_callbacks.add(added_callback)
+
+    def _submit(self, kind, payload, key, done_callback=None):
+        """Queue a submission; returns False if it duplicates a recent one"""
+        now = time.time()
+        with self._recent_lock:
+            for recent_key, submitted in list(self._recent.items()):
+                if now - submitted > self._dedupe_seconds:
+                    del self._recent[recent_key]
+            if key in self._recent:
+                logger.info("Skipping duplicate torrent submission %s", key)
+                return False
+            self._recent[key] = now
+        self._queue.put(_Submission(kind, payload, key, done_callback))
+        return True
+
+    def submit_torrent_file(self, path, done_callback=None):
+        """Queue the torrent (or magnet) file at ``path``
+
+        The file is read immediately, so it may be moved or removed as soon
+        as this returns.  Returns a tuple of ``(info_hash, accepted)``;
+        accepted is False if the same torrent was submitted recently, in
+        which case ``done_callback`` is not called.  Otherwise it is called
+        once the submission has been dealt with, as follows::
+
+            done_callback(transfer)
+
+        where ``transfer`` is None if the torrent could not be added.
+
+        """
+        with open(path, "rb") as f:
+            data = f.read()
+        if path.endswith(".magnet"):
+            return self.submit_url(data.decode("utf-8").strip(), done_callback)
+        try:
+            info_hash = torrent_info_hash(data)
+        except ValueError:
+            logger.warn("Unable to determine info-hash of '%s'", path)
+            info_hash = None
+        return info_hash, self._submit("data", data, info_hash or os.path.abspath(path), done_callback)
+
+    def submit_torrent_data(self, data, done_callback=None):
+        """Queue the provided .torrent file contents"""
+        info_hash = torrent_info_hash(data)
+        return info_hash, self._submit("data", data, info_hash, done_callback)
+
+    def submit_url(self, url, done_callback=None):
+        """Queue the provided magnet link or URL of a torrent"""
+        info_hash = magnet_info_hash(url)
+        return info_hash, self._submit("url", url, info_hash or url, done_callback)
+
+    def _forget(self, submission):
+        # allow a submission that could not be added to be submitted again
+        with self._recent_lock:
+            self._recent.pop(submission.key, None)
+
+    def _add(self, submission):
+        if submission.kind == "url":
+            return self._putio_client.Transfer.add_url(submission.payload)
+        fd, path = tempfile.mkstemp(suffix=".torrent")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(submission.payload)
+            return self._putio_client.Transfer.add_torrent(path)
+        finally:
+            os.remove(path)
+
+    def _finish(self, submission, transfer):
+        if transfer is not None:
+            logger.info("Added transfer '%s'", transfer.name)
+            for cb in list(self._added_callbacks):
+                cb(transfer)
+        else:
+            self._forget(submission)
+        if submission.done_callback is not None:
+            try:
+                submission.done_callback(transfer)
+            except Exception as ex:
+                logger.error("Error completing torrent submission %s: %s", submission.key, ex)
+
+    def _run_worker(self):
+        while True:
+            submission = self._queue.get()
+            transfer = None
+            while True:
+                submission.attempts += 1
+                try:
+                    transfer = self._add(submission)
+                except (putiopy.ServerError, requests.RequestException) as ex:
+                    if submission.attempts >= self._max_attempts:
+                        logger.error("Giving up adding torrent %s: %s", submission.key, ex)
+                        break
+                    logger.warn("Error adding torrent %s, will retry: %s", submission.key, ex)
+                    time.sleep(self._retry_backoff * 2 ** (submission.attempts - 1))
+                except Exception as ex:
+                    logger.error("Error adding torrent %s: %s", submission.key, ex)
+                    break
+                else:
+                    break
+            self._finish(submission, transfer)
+            self._queue.task_done()
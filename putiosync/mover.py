@@ -0,0 +1,89 @@
+"""Move completed downloads from a staging directory to their destination
+
+Downloads may be written to a staging directory on fast local storage
+(random writes from several segments at once) and moved to a slower
+destination such as a RAID array or network share afterwards.  Moves are
+performed in the background so that the next download can start right
+away.
+
+"""
+from queue import Queue
+import logging
+import os
+import shutil
+import threading
+from putiosync import tracing
+from putiosync.diskspace import get_device
+
+logger = logging.getLogger("putiosync")
+
+
+class FileMover(object):
+    """Pool of threads moving files, bounded per destination device
+
+    Each destination device gets its own queue served by
+    ``moves_per_device`` threads, so a slow device does not hold up moves to
+    other devices and is not thrashed by several large copies at once.
+    Moves within a filesystem are a rename; other moves copy the file
+    sequentially to a temporary name next to the destination, sync it and
+    then rename it into place before the source is removed.
+
+    """
+
+    def __init__(self, moves_per_device=1):
+        self._moves_per_device = moves_per_device
+        self._lock = threading.Lock()
+        self._queues = {}  # destination device -> Queue
+
+    def _get_queue(self, device):
+        with self._lock:
+            try:
+                return self._queues[device]
+            except KeyError:
+                queue = self._queues[device] = Queue()
+                for i in range(self._moves_per_device):
+                    worker = threading.Thread(target=self._run_worker, args=(queue,),
+                                              name="FileMover {} #{}".format(device, i + 1))
+                    worker.setDaemon(True)
+                    worker.start()
+                return queue
+
+    def move(self, source, destination, callback):
+        """Move the file at ``source`` to ``destination`` in the background
+
+        The callback will be called as follows once the move has finished::
+
+            callback(error)
+
+        Where error is None if the file was moved successfully.
+
+        """
+        self._get_queue(get_device(os.path.dirname(destination))).put((source, destination, callback))
+
+    def _move(self, source, destination):
+        if not os.path.exists(os.path.dirname(destination)):
+            os.makedirs(os.path.dirname(destination))
+        if get_device(source) == get_device(os.path.dirname(destination)):
+            os.replace(source, destination)
+            return
+        temporary_path = destination + ".moving"
+        shutil.copyfile(source, temporary_path)  # uses sendfile() where available
+        with open(temporary_path, "ab") as f:
+            os.fsync(f.fileno())
+        os.replace(temporary_path, destination)
+        os.remove(source)
+
+    def _run_worker(self, queue):
+        while True:
+            source, destination, callback = queue.get()
+            error = None
+            try:
+                with tracing.span("move", source=source, destination=destination):
+                    self._move(source, destination)
+            except (IOError, OSError) as e:
+                logger.error("Unable to move %s to %s: %s", source, destination, e)
+                error = e
+            try:
+                callback(error)
+            except Exception:
+                logger.exception("Error in callback for move of %s", source)
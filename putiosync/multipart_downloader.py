@@ -9,17 +9,26 @@ Also, it should be noted that this has been tested with downloads provided
 by put.io, but your mileage may vary for other servers.
 
 """
-from queue import Queue
+from queue import Queue, Empty
+import logging
 import threading
 import requests
 
 __author__ = "Paul Osborne"
 
+logger = logging.getLogger("putiosync")
+
+# placed on the completion queue by a worker that failed to download a segment
+_SEGMENT_FAILED = object()
+
+STOP_POLL_SECONDS = 0.5  # how often the stop event is checked while waiting for data
+STOP_JOIN_SECONDS = 5  # how long stopped workers are given to notice
+
 
 class _MultiSegmentDownloadWorker(threading.Thread):
     """Worker thread responsible for carrying out smaller chunks of work"""
 
-    def __init__(self, url, worker_num, work_queue, completion_queue, request_kwargs):
+    def __init__(self, url, worker_num, work_queue, completion_queue, request_kwargs, rate_limiter=None):
         threading.Thread.__init__(self, name="Worker on {} #{}".format(url, worker_num))
         self.setDaemon(True)
         self._url = url
@@ -28,6 +37,7 @@ class _MultiSegmentDownloadWorker(threading.Thread):
         self._work_queue = work_queue
         self._completion_queue = completion_queue
         self._request_kwargs = request_kwargs
+        self._rate_limiter = rate_limiter
 
     def stop(self):
         self._told_to_stop = True
@@ -42,12 +52,22 @@ class _MultiSegmentDownloadWorker(threading.Thread):
             },
             stream=True,
             **self._request_kwargs)
+        response.raise_for_status()
+        if segment.offset > 0 and response.status_code != 206:
+            raise IOError("Server ignored range request for {}".format(segment.build_range_header()))
 
         offset = segment.offset
         for chunk in response.iter_content(chunk_size=2 * 1024):
+            if self._told_to_stop:
+                break
             if chunk:
+                if self._rate_limiter is not None:
+                    self._rate_limiter.consume(len(chunk))
                 self._completion_queue.put((offset, chunk))
                 offset += len(chunk)
+        response.close()
+        if not self._told_to_stop and offset - segment.offset < segment.size:
+            raise IOError("Connection closed after {} of {} bytes".format(offset - segment.offset, segment.size))
 
     def run(self):
         while not self._told_to_stop:
@@ -55,7 +75,12 @@ class _MultiSegmentDownloadWorker(threading.Thread):
             if segment is None:
                 break
             else:
-                self._download_segment(segment)
+                try:
+                    self._download_segment(segment)
+                except Exception as ex:
+                    logger.error("Error downloading segment %s: %s", segment.build_range_header(), ex)
+                    self._completion_queue.put(_SEGMENT_FAILED)
+                    break
         self._completion_queue.put(None)
 
 
@@ -75,7 +100,8 @@ class _Segment(object):
             return "bytes={}-{}".format(self.offset, self.offset + self.size - 1)
 
 
-def download(url, size, transfer_callback, num_workers=4, segment_size_bytes=200 * 1024 * 1024, **kwargs):
+def download(url, size, transfer_callback, num_workers=4, segment_size_bytes=200 * 1024 * 1024, ranges=None,
+             stop_event=None, rate_limiter=None, **kwargs):
     """Start the download with this downloads settings
 
     As multi-segment downloads are really only useful for very large
@@ -88,56 +114,93 @@ def download(url, size, transfer_callback, num_workers=4, segment_size_bytes=200
     Where offset is the byte offset into the file being downloaded
     and data is the data for that chunk.
 
+    Only the ``(offset, length)`` tuples in ``ranges`` are downloaded if
+    provided (e.g. those missing after an interrupted attempt).  If
+    ``stop_event`` is set, the download is stopped early: data that has
+    already been received is still passed to the callback and False is
+    returned.  Workers are throttled by ``rate_limiter`` (a
+    :class:`TokenBucket`) if provided.
+
     """
     work_queue = Queue()
     completion_queue = Queue()
 
-    num_workers = min(num_workers, int(size / segment_size_bytes) + 1)
+    if ranges is None:
+        ranges = [(0, size)]
+
+    # create each segment and put it in the queue
+    segments = []
+    for offset, length in ranges:
+        pos, end = offset, offset + length
+        while pos + segment_size_bytes < end:
+            # Note that math on pos is exclusive, on segment in inclusive.  That means that downloading
+            # a segment of size 1000 is range 0-999.  This detail is accounted for in the _Segment
+            # implementation itself (build_range_header).
+            segments.append(_Segment(offset=pos, size=segment_size_bytes, is_last_segment=False))
+            pos += segment_size_bytes
+        if pos < end:
+            segments.append(_Segment(offset=pos, size=end - pos, is_last_segment=(end == size)))
+    if not segments:
+        return True
+    for seg in segments:
+        work_queue.put(seg)
 
     # create workers and start them
-    workers = [_MultiSegmentDownloadWorker(url, i + 1, work_queue, completion_queue, kwargs)
+    num_workers = min(num_workers, len(segments))
+    workers = [_MultiSegmentDownloadWorker(url, i + 1, work_queue, completion_queue, kwargs, rate_limiter)
                for i in range(num_workers)]
     for worker in workers:
         worker.start()
 
-    # create each segment and put it in the queue
-    pos = 0
-    while pos + segment_size_bytes < size:
-        # Note that math on pos is exclusive, on segment in inclusive.  That means that downloading
-        # a segment of size 1000 is range 0-999.  This detail is accounted for in the _Segment
-        # implementation itself (build_range_header).
-        seg = _Segment(offset=pos, size=segment_size_bytes, is_last_segment=False)
-        work_queue.put(seg)
-        pos += segment_size_bytes
-    if pos < size:
-        seg = _Segment(offset=pos, size=size - pos, is_last_segment=True)
-        work_queue.put(seg)
-
     # queue up one None for each worker to let it know that things are complete
     for _ in range(num_workers):
         work_queue.put(None)
 
     error_occurred = False
+    callback_failed = False
     workers_completed = 0
     while not error_occurred:
-        msg = completion_queue.get()
+        if stop_event is not None and stop_event.is_set():
+            error_occurred = True
+            break
+        try:
+            msg = completion_queue.get(timeout=STOP_POLL_SECONDS)
+        except Empty:
+            continue
         if msg is None:  # a worker just finished
             workers_completed += 1
             if workers_completed == num_workers:
                 break
+        elif msg is _SEGMENT_FAILED:
+            error_occurred = True
         else:
             offset, chunk = msg
             try:
                 transfer_callback(offset, chunk)
-            except:
-                error_occurred = True
+            except Exception:
+                logger.exception("Error handling downloaded data at offset %d", offset)
+                error_occurred = callback_failed = True
 
     if error_occurred:
         for worker in workers:
             worker.stop()  # halt now
 
     for worker in workers:
-        worker.join()
+        worker.join(STOP_JOIN_SECONDS if error_occurred else None)
+
+    if error_occurred and not callback_failed:
+        # hand over what was received before stopping so that it can be kept
+        while True:
+            try:
+                msg = completion_queue.get_nowait()
+            except Empty:
+                break
+            if msg is not None and msg is not _SEGMENT_FAILED:
+                try:
+                    transfer_callback(*msg)
+                except Exception:
+                    logger.exception("Error handling downloaded data at offset %d", msg[0])
+                    break
 
     success = not error_occurred
     return success
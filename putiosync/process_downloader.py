@@ -0,0 +1,208 @@
+"""Multi-process segmented downloader
+
+The threaded :mod:`multipart_downloader` hands every chunk to a callback
+in the main process, which is limited to roughly one core by the GIL.  For
+very fast links, segments are instead fetched by a pool of processes that
+write straight to the file.  Only progress crosses the process boundary:
+each segment has a byte counter in shared memory which the parent polls.
+
+"""
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_EXCEPTION
+from concurrent.futures.process import BrokenProcessPool
+import logging
+import multiprocessing
+import os
+import threading
+from multiprocessing import shared_memory
+from putiosync.bandwidth import TokenBucket
+
+logger = logging.getLogger("putiosync")
+
+CHUNK_SIZE = 1024 * 1024
+REQUEST_TIMEOUT = 30
+_COUNTER_SIZE = 8  # one signed 64-bit counter per segment, after the cancel flag
+
+_session = None  # per worker process
+
+
+def _attach(name):
+    """Attach to shared memory created by the parent"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # Python 3.13+
+    except TypeError:
+        # spawned workers share the parent's resource tracker, which already
+        # tracks this segment; registering it again is harmless
+        return shared_memory.SharedMemory(name=name)
+
+
+def _pwrite(fd, data, offset):
+    if hasattr(os, "pwrite"):
+        return os.pwrite(fd, data, offset)
+    os.lseek(fd, offset, os.SEEK_SET)  # Windows; the descriptor is private to this call
+    return os.write(fd, data)
+
+
+def _fetch_segment(url, path, offset, length, is_last_segment, shm_name, slot, request_kwargs,
+                   max_bytes_per_second=None):
+    """Download one segment into the file at ``path`` (runs in a worker process)"""
+    global _session
+    import requests
+    if _session is None:
+        _session = requests.Session()
+    rate_limiter = TokenBucket(max_bytes_per_second) if max_bytes_per_second else None
+    shm = _attach(shm_name)
+    counters = shm.buf.cast("q")
+    fd = os.open(path, os.O_WRONLY | getattr(os, "O_BINARY", 0))
+    try:
+        end = "" if is_last_segment else str(offset + length - 1)
+        headers = {"Range": "bytes={}-{}".format(offset, end)}
+        with _session.get(url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT,
+                          **request_kwargs) as response:
+            response.raise_for_status()
+            if offset > 0 and response.status_code != 206:
+                raise IOError("server ignored the range request")
+            written = 0
+            for chunk in response.iter_content(CHUNK_SIZE):
+                if counters[0]:
+                    return written  # cancelled
+                if rate_limiter is not None:
+                    rate_limiter.consume(len(chunk))
+                view = memoryview(chunk)
+                while view:
+                    n = _pwrite(fd, view, offset + written)
+                    view = view[n:]
+                    written += n
+                counters[slot] = written
+        if written < length:
+            raise IOError("segment ended after {} of {} bytes".format(written, length))
+        return written
+    finally:
+        os.close(fd)
+        counters.release()
+        shm.close()
+
+
+class ProcessDownloadEngine(object):
+    """Download files with segments fetched by a pool of worker processes
+
+    The pool is started on first use and reused for later downloads.  If
+    ``max_bytes_per_second`` is provided, each process is limited to its
+    share of it so that together they do not exceed it.
+
+    """
+
+    def __init__(self, num_processes=8, segment_size_bytes=64 * 1024 * 1024, progress_interval=0.25,
+                 max_bytes_per_second=None):
+        self._num_processes = num_processes
+        self._max_bytes_per_second = max_bytes_per_second
+        self._segment_size_bytes = segment_size_bytes
+        self._progress_interval = progress_interval
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # spawn rather than fork: the parent has many threads
+                self._executor = ProcessPoolExecutor(self._num_processes,
+                                                     mp_context=multiprocessing.get_context("spawn"))
+            return self._executor
+
+    def shutdown(self, wait=False):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
+
+    def download(self, url, size, path, progress_callback=None, ranges=None, stop_event=None,
+                 range_callback=None, **kwargs):
+        """Download ``size`` bytes from ``url`` into the existing file at ``path``
+
+        Returns True on success.  The progress callback will be called
+        periodically from the calling thread as follows::
+
+            progress_callback(downloaded, watermark)
+
+        Where downloaded is the number of bytes written so far and watermark
+        is the length of the prefix of the file that has been written in full
+        (only meaningful when the whole file is downloaded).
+
+        Only the ``(offset, length)`` tuples in ``ranges`` are downloaded if
+        provided.  The range callback, if provided, is called from the
+        calling thread for data as it has been written::
+
+            range_callback(offset, length)
+
+        If ``stop_event`` is set, running segments are stopped and False is
+        returned once they have reported what they wrote.
+
+        """
+        if ranges is None:
+            ranges = [(0, size)]
+        segments = []
+        for offset, length in ranges:
+            end = offset + length
+            while offset < end:
+                segments.append((offset, min(self._segment_size_bytes, end - offset)))
+                offset += segments[-1][1]
+        if not segments:
+            return True
+        shm = shared_memory.SharedMemory(create=True, size=_COUNTER_SIZE * (len(segments) + 1))
+        counters = shm.buf.cast("q")
+        reported = [0] * len(segments)
+
+        def report():
+            if range_callback is not None:
+                for i, (offset, _length) in enumerate(segments):
+                    written = counters[i + 1]
+                    if written > reported[i]:
+                        range_callback(offset + reported[i], written - reported[i])
+                        reported[i] = written
+            if progress_callback is not None:
+                progress_callback(*self._progress(counters, segments))
+
+        try:
+            for i in range(len(counters)):
+                counters[i] = 0
+            executor = self._get_executor()
+            per_process_rate = (self._max_bytes_per_second / float(self._num_processes)
+                                if self._max_bytes_per_second else None)
+            futures = [executor.submit(_fetch_segment, url, path, offset, length, offset + length == size,
+                                       shm.name, i + 1, kwargs, per_process_rate)
+                       for i, (offset, length) in enumerate(segments)]
+            success = True
+            pending = futures
+            while pending:
+                done, pending = wait(pending, timeout=self._progress_interval, return_when=FIRST_EXCEPTION)
+                stopped = stop_event is not None and stop_event.is_set()
+                if stopped or any(future.exception() is not None for future in done):
+                    for future in done:
+                        if future.exception() is not None:
+                            logger.error("Error downloading segment of %s: %s", url, future.exception())
+                            if isinstance(future.exception(), BrokenProcessPool):
+                                self.shutdown()  # a worker died; start a new pool next time
+                    success = False
+                    counters[0] = 1  # ask running segments to stop
+                    for future in pending:
+                        future.cancel()
+                    wait(pending)
+                    break
+                report()
+            report()
+            return success
+        finally:
+            counters.release()
+            shm.close()
+            shm.unlink()
+
+    def _progress(self, counters, segments):
+        downloaded = 0
+        watermark = 0
+        contiguous = True
+        for i, (offset, length) in enumerate(segments):
+            written = counters[i + 1]
+            downloaded += written
+            if contiguous:
+                watermark = offset + written
+                contiguous = written >= length
+        return downloaded, watermark
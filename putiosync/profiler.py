@@ -0,0 +1,119 @@
+"""Sampling profiler producing flame graph compatible output
+
+The stacks of running threads are sampled periodically and aggregated into
+the "folded" format understood by ``flamegraph.pl`` and speedscope::
+
+    DownloadManager;run (download_manager.py);perform_download (download_manager.py) 42
+
+Sampling from a separate thread means the profiled code is not
+instrumented, so the overhead is limited to the sampling itself.
+
+"""
+import collections
+import logging
+import os
+import re
+import signal
+import sys
+import threading
+import time
+
+logger = logging.getLogger("putiosync")
+
+# thread names include urls and worker numbers; strip them so that
+# samples from equivalent threads are grouped together
+_THREAD_NAME_NOISE = re.compile(r" on \S+| #\d+")
+
+
+def _thread_label(name):
+    return _THREAD_NAME_NOISE.sub("", name)
+
+
+class SamplingProfiler(threading.Thread):
+    """Periodically sample the stacks of all other threads
+
+    ``thread_names`` may be provided to only sample threads whose (cleaned
+    up) name is in the collection.
+
+    """
+
+    def __init__(self, interval=0.005, thread_names=None):
+        threading.Thread.__init__(self, name="SamplingProfiler")
+        self.setDaemon(True)
+        self._interval = interval
+        self._thread_names = set(thread_names) if thread_names is not None else None
+        self._lock = threading.Lock()
+        self._counts = collections.Counter()
+        self._samples = 0
+        self._has_exit = False
+
+    def stop(self):
+        self._has_exit = True
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+            self._samples = 0
+
+    def get_sample_count(self):
+        return self._samples
+
+    def _sample(self):
+        labels = dict((t.ident, _thread_label(t.name)) for t in threading.enumerate())
+        own_ident = threading.current_thread().ident
+        stacks = []
+        for ident, frame in sys._current_frames().items():
+            label = labels.get(ident)
+            if ident == own_ident or label is None:
+                continue
+            if self._thread_names is not None and label not in self._thread_names:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{} ({})".format(code.co_name, os.path.basename(code.co_filename)))
+                frame = frame.f_back
+            stack.append(label)
+            stack.reverse()
+            stacks.append(";".join(stack))
+        with self._lock:
+            self._counts.update(stacks)
+            self._samples += 1
+
+    def folded(self):
+        """Return the samples collected so far in folded stack format"""
+        with self._lock:
+            items = sorted(self._counts.items())
+        return "".join("{} {}\n".format(stack, count) for stack, count in items)
+
+    def dump(self, path):
+        """Write the samples collected so far to ``path`` in folded stack format"""
+        with open(path, "w") as f:
+            f.write(self.folded())
+        logger.info("Wrote %d profile samples to %s", self._samples, path)
+
+    def install_signal_handler(self, path, signum=None):
+        """Dump the profile to ``path`` whenever the process receives ``signum``
+
+        The default is SIGUSR1 (``kill -USR1 <pid>``); this is not available
+        on Windows, where the profile can be fetched from the web interface.
+
+        """
+        if signum is None:
+            signum = getattr(signal, "SIGUSR1", None)
+            if signum is None:
+                return False
+
+        def handler(received_signum, frame):
+            try:
+                self.dump(path)
+            except (IOError, OSError) as e:
+                logger.error("Unable to write profile to %s: %s", path, e)
+
+        signal.signal(signum, handler)
+        return True
+
+    def run(self):
+        while not self._has_exit:
+            self._sample()
+            time.sleep(self._interval)
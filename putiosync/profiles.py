@@ -0,0 +1,106 @@
+"""Synchronization profiles
+
+A profile is one put.io account (or a folder within it) synchronized to
+one local directory with its own filters.  Several profiles can share a
+single download manager, so that one process serves several accounts and
+libraries with fair scheduling and global limits.  Profiles are read from
+a JSON file::
+
+    {
+        "profiles": [
+            {
+                "name": "movies",
+                "download_directory": "/data/movies",
+                "remote_root": 123456,
+                "include": ["**/*.mkv"]
+            },
+            {
+                "name": "bob",
+                "token": "BOBS_TOKEN",
+                "download_directory": "/data/bob",
+                "keep": true
+            }
+        ]
+    }
+
+``name`` and ``download_directory`` are required.  ``token`` defaults to the
+token putio-sync was authorized with and ``remote_root`` (the id of the
+put.io folder to synchronize) to the root folder.  ``filter``, ``include``,
+``exclude``, ``keep``, ``force_keep`` and ``poll_frequency`` behave like the
+command line options of the same name.
+
+"""
+import json
+import re
+from putiosync.filters import build_path_filter
+
+PROFILE_KEYS = ("name", "token", "download_directory", "remote_root", "filter", "include", "exclude", "keep",
+                "force_keep", "poll_frequency")
+
+
+class ProfileError(Exception):
+    """Raised when the profiles file is invalid"""
+
+
+class Profile(object):
+    """Settings for synchronizing a put.io folder to a local directory
+
+    ``name`` is None for the single profile configured on the command line.
+
+    """
+
+    def __init__(self, name, token, download_directory, remote_root=0, download_filter=None, force_keep=None,
+                 keep_files=False, poll_frequency=None):
+        self.name = name
+        self.token = token
+        self.download_directory = download_directory
+        self.remote_root = remote_root
+        self.download_filter = download_filter
+        self.force_keep = force_keep
+        self.keep_files = keep_files
+        self.poll_frequency = poll_frequency
+
+    def __repr__(self):
+        return "Profile({!r})".format(self.name)
+
+
+def parse_profile(config, default_token):
+    """Create a :class:`Profile` from its entry in the profiles file"""
+    unknown = set(config) - set(PROFILE_KEYS)
+    if unknown:
+        raise ProfileError("Unknown profile setting(s): {}".format(", ".join(sorted(unknown))))
+    for key in ("name", "download_directory"):
+        if not config.get(key):
+            raise ProfileError("Every profile needs a '{}'".format(key))
+    for key in ("filter", "include", "exclude"):
+        rules = config.get(key)
+        if rules is not None and (not isinstance(rules, list) or not all(isinstance(r, str) for r in rules)):
+            raise ProfileError("'{}' in profile '{}' must be a list of strings, e.g. [\"**/*.mkv\"]"
+                               .format(key, config["name"]))
+    try:
+        download_filter = build_path_filter(config.get("filter"), config.get("include"), config.get("exclude"))
+        force_keep = re.compile(config["force_keep"]) if config.get("force_keep") else None
+    except re.error as e:
+        raise ProfileError("Invalid filter in profile '{}': {}".format(config["name"], e))
+    return Profile(config["name"], config.get("token") or default_token, config["download_directory"],
+                   remote_root=int(config.get("remote_root", 0)),
+                   download_filter=download_filter,
+                   force_keep=force_keep,
+                   keep_files=bool(config.get("keep", False)),
+                   poll_frequency=config.get("poll_frequency"))
+
+
+def load_profiles(path, default_token):
+    """Load the profiles from the JSON file at ``path``"""
+    try:
+        with open(path) as f:
+            config = json.load(f)
+    except (IOError, ValueError) as e:
+        raise ProfileError("Unable to read profiles from {}: {}".format(path, e))
+    profiles = [parse_profile(entry, default_token) for entry in config.get("profiles", [])]
+    if not profiles:
+        raise ProfileError("No profiles found in {}".format(path))
+    names = [profile.name for profile in profiles]
+    if len(set(names)) != len(names):
+        raise ProfileError("Profile names must be unique")
+    return profiles
@@ -0,0 +1,155 @@
+"""Low overhead counters describing the state of the download engine
+
+The download manager updates a :class:`StatsRegistry` as downloads are
+queued, make progress and complete.  Updates on the hot path (progress)
+are simple integer arithmetic; anything more expensive is only done when
+the queue itself changes.  Consumers such as the Transmission RPC
+interface read the counters rather than recomputing anything per request.
+
+Pending downloads are counted under the id of each put.io file and
+directory they are in (see :meth:`Download.get_stats_ids`).  For a transfer
+this includes the transfer's ``file_id`` wherever it was saved, which lets
+us report how much of a transfer is still to be downloaded locally.
+
+"""
+import threading
+import time
+from sqlalchemy import func
+from putiosync.dbmodel import DownloadRecord
+
+RATE_SAMPLE_SECONDS = 1.0
+RATE_SMOOTHING = 0.3
+RATE_STALE_SECONDS = 3.0
+
+
+class PendingStats(object):
+    """Local download state of everything queued from a single put.io file or directory"""
+    __slots__ = ("pending_bytes", "pending_files")
+
+    def __init__(self):
+        self.pending_bytes = 0
+        self.pending_files = 0
+
+
+class StatsRegistry(object):
+    """Counters for the download engine"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}  # put.io id -> PendingStats
+        self._pending_files = 0
+        self._active = {}  # file id -> [stats ids, bytes downloaded]
+        self._session_start = time.time()
+        self._transferred_bytes = 0  # including attempts that failed; for the rate
+        self.session_downloaded_bytes = 0  # of completed downloads
+        self.session_files_added = 0
+        self.session_files_completed = 0
+        self.session_files_failed = 0
+        self.history_downloaded_bytes = 0
+        self.history_files = 0
+        self._rate = 0.0
+        self._rate_sample_time = time.time()
+        self._rate_sample_bytes = 0
+
+    def load_history_totals(self, session):
+        """Initialize cumulative totals from the download history"""
+        total_bytes, total_files = session.query(func.sum(DownloadRecord.size), func.count(DownloadRecord.id)).one()
+        self.history_downloaded_bytes = total_bytes or 0
+        self.history_files = total_files or 0
+
+    def on_queued(self, download):
+        with self._lock:
+            for stats_id in download.get_stats_ids():
+                pending = self._pending.get(stats_id)
+                if pending is None:
+                    pending = self._pending[stats_id] = PendingStats()
+                pending.pending_bytes += download.get_size()
+                pending.pending_files += 1
+            self._pending_files += 1
+            self.session_files_added += 1
+
+    def _remove_pending(self, download):
+        self._pending_files -= 1
+        for stats_id in download.get_stats_ids():
+            pending = self._pending.get(stats_id)
+            if pending is not None:
+                pending.pending_bytes -= download.get_size()
+                pending.pending_files -= 1
+                if pending.pending_files <= 0:
+                    del self._pending[stats_id]
+
+    def on_started(self, download):
+        with self._lock:
+            self._active[download.get_file_id()] = [download.get_stats_ids(), 0]
+
+    def on_progress(self, download):
+        with self._lock:
+            active = self._active.get(download.get_file_id())
+            if active is None:
+                return
+            downloaded = download.get_downloaded()
+            self._transferred_bytes += downloaded - active[1]
+            active[1] = downloaded
+
+            now = time.time()
+            elapsed = now - self._rate_sample_time
+            if elapsed >= RATE_SAMPLE_SECONDS:
+                sample = (self._transferred_bytes - self._rate_sample_bytes) / elapsed
+                self._rate = RATE_SMOOTHING * sample + (1 - RATE_SMOOTHING) * self._rate
+                self._rate_sample_time = now
+                self._rate_sample_bytes = self._transferred_bytes
+
+    def on_finished(self, download, success):
+        """Record the end of an attempt at a download"""
+        with self._lock:
+            self._active.pop(download.get_file_id(), None)
+            if not success:
+                return  # it stays queued for retry
+            self._remove_pending(download)
+            self.session_files_completed += 1
+            self.session_downloaded_bytes += download.get_size()
+
+    def on_abandoned(self, download):
+        """Record that a download will not be retried"""
+        with self._lock:
+            self._remove_pending(download)
+            self.session_files_failed += 1
+
+    def get_rate(self):
+        """Return the current local download rate in bytes per second"""
+        if time.time() - self._rate_sample_time > RATE_STALE_SECONDS:
+            return 0
+        return int(self._rate)
+
+    def get_active_count(self):
+        return len(self._active)
+
+    def get_pending_files(self):
+        with self._lock:
+            return self._pending_files
+
+    def get_session_seconds(self):
+        return int(time.time() - self._session_start)
+
+    def get_remaining_by_id(self, putio_ids):
+        """Return a mapping of the provided put.io ids to bytes still to be downloaded locally from within each
+
+        Ids with nothing left to download are left out.
+
+        """
+        remaining = {}
+        with self._lock:
+            for putio_id in putio_ids:
+                pending = self._pending.get(putio_id)
+                if pending is not None:
+                    remaining[putio_id] = pending.pending_bytes
+            active = list(self._active.values())
+        for stats_ids, downloaded in active:
+            for stats_id in stats_ids:
+                if stats_id in remaining:
+                    remaining[stats_id] -= downloaded
+        return remaining
+
+    def is_active(self, putio_id):
+        """Return True if a download in (or of) the put.io file or directory is in progress"""
+        return any(putio_id in stats_ids for stats_ids, _downloaded in list(self._active.values()))
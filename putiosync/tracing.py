@@ -0,0 +1,96 @@
+"""Structured per-stage trace spans
+
+When tracing is enabled with :func:`configure`, each span is written to a
+rotating trace file as one JSON object per line::
+
+    {"stage": "transfer", "ms": 5123.4, "ok": true, "thread": "DownloadManager",
+     "ts": 1700000000.0, "file_id": 1234, "size": 734003200}
+
+When tracing is not enabled, :func:`span` returns a shared object that
+does nothing, so spans may be left in hot paths.
+
+"""
+import json
+import logging
+import logging.handlers
+import threading
+import time
+
+_trace_logger = logging.getLogger("putiosync.trace")
+_trace_logger.propagate = False  # traces only go to the trace file
+_enabled = False
+
+
+def configure(path, max_bytes=50 * 1024 * 1024, backup_count=5):
+    """Start writing spans to the file at ``path``, rotating it as it grows"""
+    global _enabled
+    handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    _trace_logger.addHandler(handler)
+    _trace_logger.setLevel(logging.INFO)
+    _enabled = True
+
+
+def is_enabled():
+    return _enabled
+
+
+class _Span(object):
+    __slots__ = ("_stage", "_fields", "_start")
+
+    def __init__(self, stage, fields):
+        self._stage = stage
+        self._fields = fields
+        self._start = None
+
+    def set(self, **fields):
+        """Add fields to the span, e.g. results known only at the end of the stage"""
+        self._fields.update(fields)
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        record = {
+            "stage": self._stage,
+            "ts": round(self._start, 6),
+            "ms": round((time.time() - self._start) * 1000, 3),
+            "ok": exc_type is None,
+            "thread": threading.current_thread().name,
+        }
+        if exc_type is not None:
+            record["error"] = repr(exc_value)
+        record.update(self._fields)
+        _trace_logger.info(json.dumps(record, default=str))
+        return False
+
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def set(self, **fields):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(stage, **fields):
+    """Return a context manager timing one stage of work on one item
+
+    ``fields`` (e.g. ``file_id``) are written with the span::
+
+        with tracing.span("rename", file_id=file_id):
+            os.rename(src, dst)
+
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(stage, fields)
@@ -0,0 +1,128 @@
+"""Queue downloads as soon as put.io transfers complete
+
+Rather than discovering new content by walking the whole remote tree on
+every poll, the tracker watches transfers (those we started ourselves are
+registered explicitly, others are picked up from the transfer list) and
+put.io's event feed.  When a transfer completes, the file or directory it
+produced is queued for download straight away.  A full scan is still
+useful to reconcile anything we missed, but it can run much less often.
+
+"""
+import logging
+import threading
+import time
+import putiopy
+
+logger = logging.getLogger("putiosync")
+
+COMPLETED_STATUSES = ("COMPLETED", "SEEDING")
+FAILED_STATUSES = ("ERROR", "CANCELLED")
+TRACK_TTL_SECONDS = 7 * 24 * 60 * 60  # tracked transfers not seen to finish within this are dropped
+
+
+class TransferTracker(threading.Thread):
+    """Component responsible for noticing completed transfers"""
+
+    def __init__(self, putio_client, synchronizer, poll_interval=10, idle_poll_interval=60, use_events=True):
+        threading.Thread.__init__(self, name="TransferTracker")
+        self.setDaemon(True)
+        self._putio_client = putio_client
+        self._synchronizer = synchronizer
+        self._poll_interval = poll_interval
+        self._idle_poll_interval = idle_poll_interval
+        self._use_events = use_events
+        self._last_event_id = None
+        self._tracked_lock = threading.Lock()
+        self._tracked = {}  # transfer id -> time first tracked
+        self._wakeup = threading.Event()
+        self._has_exit = False
+
+    def track(self, transfer_id):
+        """Track the transfer with the provided id until it completes"""
+        with self._tracked_lock:
+            self._tracked.setdefault(transfer_id, time.time())
+        self._wakeup.set()
+
+    def stop(self):
+        self._has_exit = True
+        self._wakeup.set()
+
+    def _queue_file(self, file_id, description):
+        logger.info("Transfer completed, queueing '%s' (file id %r)", description, file_id)
+        try:
+            self._synchronizer.queue_remote_file(file_id)
+        except Exception as ex:
+            logger.error("Error queueing completed transfer '%s': %s", description, ex)
+
+    def _prune_tracked(self):
+        # the event feed does not always tell us which transfer completed, so
+        # transfers tracked in events mode are eventually forgotten
+        expired = time.time() - TRACK_TTL_SECONDS
+        with self._tracked_lock:
+            for transfer_id, tracked in list(self._tracked.items()):
+                if tracked < expired:
+                    del self._tracked[transfer_id]
+
+    def _check_events(self):
+        """Queue files for transfer_completed events; returns False if the feed is unavailable"""
+        try:
+            events = self._putio_client.request("/events/list").get("events", [])
+        except putiopy.ClientError as ex:
+            logger.warn("put.io event feed unavailable, falling back to the transfer list: %s", ex)
+            self._use_events = False
+            return False
+
+        newest = max([e["id"] for e in events] or [self._last_event_id or 0])
+        if self._last_event_id is not None:
+            for event in sorted(events, key=lambda e: e["id"]):
+                if event["id"] > self._last_event_id and event.get("type") == "transfer_completed":
+                    with self._tracked_lock:
+                        self._tracked.pop(event.get("transfer_id"), None)
+                    if event.get("file_id"):
+                        self._queue_file(event["file_id"], event.get("transfer_name"))
+        self._prune_tracked()
+        # on the first check we only establish where the feed is at; older
+        # events are covered by the reconciliation scan
+        self._last_event_id = newest
+        return True
+
+    def _check_transfers(self):
+        """Queue files for tracked transfers that have completed"""
+        transfers = self._putio_client.Transfer.list()
+        completed = []
+        now = time.time()
+        with self._tracked_lock:
+            seen = set()
+            for transfer in transfers:
+                seen.add(transfer.id)
+                if transfer.status in COMPLETED_STATUSES:
+                    if self._tracked.pop(transfer.id, None) is not None and transfer.file_id:
+                        completed.append(transfer)
+                elif transfer.status in FAILED_STATUSES:
+                    self._tracked.pop(transfer.id, None)
+                else:
+                    self._tracked.setdefault(transfer.id, now)  # pick up transfers we did not start
+            for transfer_id in list(self._tracked):
+                if transfer_id not in seen and now - self._tracked[transfer_id] > self._idle_poll_interval:
+                    del self._tracked[transfer_id]  # removed from put.io (after it had time to appear)
+            tracking = len(self._tracked) > 0
+        # queueing lists put.io, so it is done without holding up track()
+        for transfer in completed:
+            self._queue_file(transfer.file_id, transfer.name)
+        return tracking
+
+    def run(self):
+        """Main loop for the transfer tracker"""
+        while not self._has_exit:
+            timeout = self._poll_interval
+            try:
+                # the event feed covers every transfer in a single call; the
+                # transfer list is only needed when the feed is unavailable
+                if not (self._use_events and self._check_events()):
+                    if not self._check_transfers():
+                        timeout = self._idle_poll_interval
+            except Exception as ex:
+                logger.error("Unexpected error while checking transfers: %s", ex)
+
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
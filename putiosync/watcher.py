@@ -1,8 +1,13 @@
+import datetime
 import logging
 import os
+import shutil
+import threading
+import time
 
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
+from putiosync.dbmodel import ProcessedTorrentFile
 
 logger = logging.getLogger(__name__)
 
@@ -11,6 +16,11 @@ def is_torrent(ext):
     return ext in (".torrent", ".magnet")
 
 
+def _is_torrent_path(path):
+    _name, ext = os.path.splitext(os.path.basename(path))
+    return is_torrent(ext)
+
+
 class TorrentWatcherFilesystemEventHandler(FileSystemEventHandler):
     """This class handles filesystem changes to monitored directories
 
@@ -19,36 +29,178 @@ class TorrentWatcherFilesystemEventHandler(FileSystemEventHandler):
 
     """
 
-    def __init__(self, putio_client):
+    def __init__(self, watcher):
         FileSystemEventHandler.__init__(self)
-        self._putio_client = putio_client
+        self._watcher = watcher
 
     def on_created(self, event):
-        if not event.is_directory:
-            basename = os.path.basename(event.src_path)
-            _name, ext = os.path.splitext(basename)
-            if is_torrent(ext):
-                logger.info("Adding torrent from path '%s'", event.src_path)
-                self._putio_client.Transfer.add_torrent(event.src_path)
+        if not event.is_directory and _is_torrent_path(event.src_path):
+            self._watcher.schedule(event.src_path)
+
+    def on_modified(self, event):
+        self.on_created(event)
+
+    def on_moved(self, event):
+        # e.g. a client writing 'foo.torrent.tmp' and renaming it when complete
+        if not event.is_directory and _is_torrent_path(event.dest_path):
+            self._watcher.schedule(event.dest_path)
 
 
 class TorrentWatcher(object):
+    """Watch a directory tree for torrent and magnet files
 
-    def __init__(self, watch_directory, putio_client):
-        self._watch_directory = watch_directory
-        self._putio_client = putio_client
+    New files are only submitted once their size has stopped changing for
+    ``settle_seconds`` so that half-written files are not uploaded.  Files
+    already present when the watcher starts are picked up by a catch-up
+    scan.  Once added to put.io, files are recorded in a ledger in the
+    database (or moved to ``done_directory``) so that they are not
+    submitted again after a restart; files that could not be added are
+    left for the next catch-up scan.
+
+    """
+
+    def __init__(self, watch_directory, ingest_queue, db_manager, done_directory=None, settle_seconds=2.0):
+        self._watch_directory = os.path.abspath(watch_directory)
+        self._ingest_queue = ingest_queue
+        self._db_manager = db_manager
+        self._done_directory = os.path.abspath(done_directory) if done_directory else None
+        self._settle_seconds = settle_seconds
         self._observer = Observer()
-        self._event_handler = TorrentWatcherFilesystemEventHandler(self._putio_client)
+        self._event_handler = TorrentWatcherFilesystemEventHandler(self)
+        self._pending_lock = threading.Lock()
+        self._pending = {}  # path -> (size, mtime, time first seen with that size and mtime)
+        self._processed = {}  # path -> (size, mtime) as recorded in the ledger
+        self._submitted = set()  # paths queued for ingest but not yet added to put.io
+        self._has_exit = False
+        self._debouncer = threading.Thread(target=self._run_debouncer, name="TorrentWatcher")
+        self._debouncer.setDaemon(True)
 
     def stop(self):
+        self._has_exit = True
         self._observer.stop()
 
     def join(self, *args, **kwargs):
         self._observer.join(*args, **kwargs)
 
+    def schedule(self, path):
+        """Submit the file at ``path`` once it has finished being written"""
+        path = os.path.abspath(path)
+        if self._done_directory is not None and path.startswith(self._done_directory + os.sep):
+            return
+        with self._pending_lock:
+            self._pending.setdefault(path, (None, None, None))
+
+    def _load_ledger(self):
+        session = self._db_manager.get_db_session()
+        for record in session.query(ProcessedTorrentFile):
+            self._processed[record.path] = (record.size, record.mtime)
+
+    def _catch_up(self, directory):
+        """Schedule torrents that were added while we were not running"""
+        try:
+            entries = list(os.scandir(directory))
+        except OSError as ex:
+            logger.error("Unable to scan '%s': %s", directory, ex)
+            return
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if os.path.abspath(entry.path) != self._done_directory:
+                    self._catch_up(entry.path)
+            elif _is_torrent_path(entry.name):
+                path = os.path.abspath(entry.path)
+                stat = entry.stat()
+                if self._processed.get(path) != (stat.st_size, int(stat.st_mtime)):
+                    self.schedule(path)
+
+    def _process(self, path, size, mtime):
+        if self._processed.get(path) == (size, mtime):
+            return
+        with self._pending_lock:
+            if path in self._submitted:
+                return  # still waiting to be added to put.io
+            self._submitted.add(path)
+        logger.info("Adding torrent from path '%s'", path)
+
+        def done_callback(transfer):
+            self._on_submission_done(path, size, mtime, transfer)
+
+        try:
+            _info_hash, accepted = self._ingest_queue.submit_torrent_file(path, done_callback)
+        except (OSError, IOError, ValueError) as ex:
+            logger.error("Unable to read torrent '%s': %s", path, ex)
+            with self._pending_lock:
+                self._submitted.discard(path)
+            return
+        if not accepted:
+            self._mark_processed(path, size, mtime)  # the same torrent was added recently
+
+    def _on_submission_done(self, path, size, mtime, transfer):
+        # called on an ingest worker once the torrent has been added (or could not be)
+        if transfer is None:
+            # left in place (and out of the ledger) so that the next catch-up scan tries again
+            with self._pending_lock:
+                self._submitted.discard(path)
+            return
+        try:
+            self._mark_processed(path, size, mtime)
+        finally:
+            self._db_manager.remove_db_session()
+
+    def _mark_processed(self, path, size, mtime):
+        try:
+            if self._done_directory is not None:
+                done_path = os.path.join(self._done_directory, os.path.relpath(path, self._watch_directory))
+                try:
+                    if not os.path.exists(os.path.dirname(done_path)):
+                        os.makedirs(os.path.dirname(done_path))
+                    shutil.move(path, done_path)
+                except (OSError, IOError) as ex:
+                    logger.error("Unable to move '%s' to '%s': %s", path, done_path, ex)
+                else:
+                    return  # nothing left in the watch directory to remember
+
+            self._processed[path] = (size, mtime)
+            session = self._db_manager.get_db_session()
+            session.merge(ProcessedTorrentFile(path=path, size=size, mtime=mtime,
+                                               timestamp=datetime.datetime.now()))
+            session.commit()
+        finally:
+            with self._pending_lock:
+                self._submitted.discard(path)
+
+    def _check_pending(self):
+        now = time.time()
+        with self._pending_lock:
+            pending = list(self._pending.items())
+        for path, (size, mtime, since) in pending:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                with self._pending_lock:
+                    self._pending.pop(path, None)  # removed before it settled
+                continue
+            current = (stat.st_size, int(stat.st_mtime))
+            if current != (size, mtime):
+                with self._pending_lock:
+                    self._pending[path] = current + (now,)
+            elif now - since >= self._settle_seconds:
+                with self._pending_lock:
+                    self._pending.pop(path, None)
+                self._process(path, size, mtime)
+
+    def _run_debouncer(self):
+        self._load_ledger()
+        self._catch_up(self._watch_directory)
+        while not self._has_exit:
+            try:
+                self._check_pending()
+            except Exception as ex:
+                logger.error("Unexpected error while processing watched torrents: %s", ex)
+            time.sleep(0.5)
+
     def start(self):
-        # TODO: add recursive option in future
         self._observer.schedule(self._event_handler,
                                 self._watch_directory,
-                                recursive=False)
+                                recursive=True)
         self._observer.start()
+        self._debouncer.start()
@@ -1,8 +1,13 @@
+import base64
+import datetime
 import json
 import logging
+import threading
+import time
 import uuid
 import flask
 import os
+from putiosync.ingest import TorrentIngestQueue
 
 
 logger = logging.getLogger(__name__)
@@ -24,8 +29,165 @@ def geteta(eta):
         else:
             return eta
 
-class TransmissionTransferProxy(object):
-    """Wrap a put.io transfer and map to Transmission torrent iface
+class TransferCache(object):
+    """Short lived, shared cache of the put.io transfer list
+
+    Transmission clients poll ``torrent-get`` every few seconds.  Rather than
+    hitting the put.io API for every one of those requests, the transfer list
+    is kept for ``ttl`` seconds.  Concurrent requests that find the cache
+    expired share a single fetch rather than each making their own.
+
+    """
+
+    def __init__(self, putio_client, ttl=5.0):
+        self._putio_client = putio_client
+        self._ttl = ttl
+        self._cond = threading.Condition()
+        self._transfers = None
+        self._expires = 0
+        self._generation = 0
+        self._fetching = False
+
+    def invalidate(self):
+        """Force the next call to get() to fetch a fresh transfer list"""
+        with self._cond:
+            self._expires = 0
+            self._generation += 1
+
+    def get(self):
+        """Get the list of put.io transfers"""
+        with self._cond:
+            while True:
+                if self._transfers is not None and time.time() < self._expires:
+                    return self._transfers
+                if not self._fetching:
+                    break
+                self._cond.wait()
+                if not self._fetching and self._transfers is not None:
+                    # whoever fetched has shared their result with us
+                    return self._transfers
+            self._fetching = True
+            generation = self._generation
+
+        try:
+            transfers = self._putio_client.Transfer.list()
+        except Exception:
+            with self._cond:
+                self._fetching = False
+                self._cond.notify_all()
+            raise
+
+        with self._cond:
+            self._transfers = transfers
+            if generation == self._generation:
+                self._expires = time.time() + self._ttl
+            self._fetching = False
+            self._cond.notify_all()
+        return transfers
+
+
+RECENTLY_ACTIVE_SECONDS = 60
+
+
+ETA_NOT_AVAILABLE = -1
+STATUS_DOWNLOADING = 4
+
+
+def _hash_string(transfer):
+    # use the info-hash when put.io provides it so that it matches what we
+    # report from torrent-add (and what clients compute themselves)
+    info_hash = getattr(transfer, "hash", None)
+    return info_hash.lower() if info_hash else "%s" % transfer.id
+
+
+def _local_remaining(transfer, context):
+    return context.local_remaining.get(transfer.file_id, 0)
+
+
+def _left_until_done(transfer, context):
+    # remaining on put.io plus what we still have to download locally
+    return (transfer.size or 0) - (transfer.downloaded or 0) + _local_remaining(transfer, context)
+
+
+def _status(transfer, context):
+    if _local_remaining(transfer, context) > 0:
+        return STATUS_DOWNLOADING
+    return map_status(transfer.status)
+
+
+def _eta(transfer, context):
+    remote_eta = geteta(transfer.estimated_time)
+    local_remaining = _local_remaining(transfer, context)
+    if local_remaining == 0:
+        return remote_eta
+    if context.stats.is_active(transfer.file_id) and context.local_rate > 0:
+        return remote_eta + int(local_remaining / context.local_rate)
+    return ETA_NOT_AVAILABLE
+
+
+def _rate_download(transfer, context):
+    if context.stats.is_active(transfer.file_id):
+        return context.local_rate
+    return transfer.down_speed or 0
+
+
+def _percent_done(transfer, context):
+    if not transfer.size:
+        return 0.0
+    return min(1.0, max(0.0, 1.0 - float(_left_until_done(transfer, context)) / transfer.size))
+
+
+def _is_finished(transfer, context):
+    if _local_remaining(transfer, context) > 0:
+        return False
+    return context.synchronizer.is_already_downloaded(transfer, context.downloaded_file_ids)
+
+
+# Mapping from Transmission torrent fields to functions providing them for a
+# put.io transfer.  Sonarr requests the following: id, hashString, name,
+# downloadDir, status, totalSize, leftUntilDone, eta and errorString.
+FIELD_GETTERS = {
+    "id": lambda transfer, context: transfer.id,
+    "hashString": lambda transfer, context: _hash_string(transfer),
+    "name": lambda transfer, context: transfer.name,
+    "downloadDir": lambda transfer, context: context.download_directory,
+    "status": _status,
+    "totalSize": lambda transfer, context: transfer.size,
+    "leftUntilDone": _left_until_done,
+    "errorString": lambda transfer, context: '' if transfer.error_message is None else transfer.error_message,
+    "isFinished": _is_finished,
+    "eta": _eta,
+    "rateDownload": _rate_download,
+    "rateUpload": lambda transfer, context: 0,
+    "percentDone": _percent_done,
+    "queuePosition": lambda transfer, context: context.queue_positions.get(transfer.file_id, 0),
+}
+
+
+def _unknown_field(transfer, context):
+    return None
+
+
+class RenderContext(object):
+    """Information shared by every transfer rendered for a single request"""
+
+    def __init__(self, synchronizer, transfers, downloaded_file_ids=None):
+        download_manager = synchronizer.get_download_manager()
+        self.synchronizer = synchronizer
+        self.download_directory = synchronizer.get_download_directory()
+        self.downloaded_file_ids = downloaded_file_ids
+        self.stats = download_manager.get_stats()
+        # only the requested transfers are looked up; the queue may be much longer
+        self.local_remaining = self.stats.get_remaining_by_id([transfer.file_id for transfer in transfers])
+        self.local_rate = self.stats.get_rate()
+        self.queue_positions = download_manager.get_queue_positions(self.local_remaining)
+
+
+class TransmissionTorrentRenderer(object):
+    """Render put.io transfers as Transmission torrents for a set of fields
+
+    The field getters are looked up once when the renderer is created so
+    that it can be reused across transfers and requests.
 
     Here's an example of the information we get from Put.io for a transfer:
 
@@ -69,34 +231,50 @@ class TransmissionTransferProxy(object):
 
     """
 
-    def __init__(self, putio_transfer, synchronizer):
-        self.synchronizer = synchronizer
-        self.transfer = putio_transfer
-        # sonar requests the following:
-        # - id
-        # - hashString
-        # - name
-        # - downloadDir
-        # - status
-        # - totalSize
-        # - leftUntilDone
-        # - eta
-        # - errorString
-        self._field_providers = {
-            "id": lambda: self.transfer.id,
-            "hashString": lambda: "%s" % self.transfer.id,
-            "name": lambda: self.transfer.name,
-            "downloadDir": lambda: self.synchronizer.get_download_directory(),
-            "status": lambda: map_status(self.transfer.status),
-            "totalSize": lambda: self.transfer.size,
-            "leftUntilDone": lambda: self.transfer.size - self.transfer.downloaded,
-            "errorString": lambda : '' if self.transfer.error_message is None else self.transfer.error_message,
-            "isFinished": lambda : self.synchronizer.is_already_downloaded(self.transfer),
-            "eta": lambda : geteta(self.transfer.estimated_time)
-        }
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+        self._getters = [(f, FIELD_GETTERS.get(f, _unknown_field)) for f in self.fields]
+        self.needs_finished = "isFinished" in self.fields
+
+    def render(self, transfer, context):
+        return {f: getter(transfer, context) for f, getter in self._getters}
 
-    def render_json(self, fields):
-        return {f: self._field_providers.get(f, lambda: None)() for f in fields}
+
+def _parse_putio_datetime(value):
+    try:
+        return datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S")
+    except (TypeError, ValueError):
+        return None
+
+
+def _is_recently_active(transfer, now):
+    if transfer.status not in ("COMPLETED", "SEEDING", "ERROR"):
+        return True
+    finished_at = _parse_putio_datetime(getattr(transfer, "finished_at", None))
+    return finished_at is not None and (now - finished_at).total_seconds() < RECENTLY_ACTIVE_SECONDS
+
+
+def filter_transfers(transfers, ids):
+    """Select the transfers requested by the ``ids`` argument of torrent-get
+
+    ``ids`` may be omitted (all transfers), a single id, a list of ids and/or
+    hash strings or the string "recently-active".
+
+    """
+    if ids is None:
+        return transfers
+    if ids == "recently-active":
+        now = datetime.datetime.utcnow()
+        return [t for t in transfers if _is_recently_active(t, now)]
+    if not isinstance(ids, list):
+        ids = [ids]
+    wanted = set()
+    for transfer_id in ids:
+        try:
+            wanted.add(int(transfer_id))
+        except (TypeError, ValueError):
+            wanted.add(("%s" % transfer_id).lower())
+    return [t for t in transfers if t.id in wanted or _hash_string(t) in wanted]
 
 
 class TransmissionRPCServer(object):
@@ -112,9 +290,16 @@ class TransmissionRPCServer(object):
     to have implemented.
     """
 
-    def __init__(self, putio_client, synchronizer):
+    def __init__(self, putio_client, synchronizer, ingest_queue=None):
         self._synchronizer = synchronizer
         self._putio_client = putio_client
+        self._transfer_cache = TransferCache(putio_client)
+        if ingest_queue is None:
+            ingest_queue = TorrentIngestQueue(putio_client)
+            ingest_queue.start()
+        self._ingest_queue = ingest_queue
+        self._ingest_queue.add_added_callback(lambda transfer: self._transfer_cache.invalidate())
+        self._renderers = {}
         self._session_id = str(uuid.uuid1())
         self.methods = {
             "session-get": self._session_get,
@@ -134,28 +319,80 @@ class TransmissionRPCServer(object):
         }
 
     def _session_stats(self, **arguments):
-        return {}
+        stats = self._synchronizer.get_download_manager().get_stats()
+        transfers = self._transfer_cache.get()
+        local_remaining = stats.get_remaining_by_id([t.file_id for t in transfers])
+        active = sum(1 for t in transfers if t.status not in ("COMPLETED", "SEEDING", "ERROR") or
+                     local_remaining.get(t.file_id, 0) > 0)
+        current = {
+            "uploadedBytes": 0,
+            "downloadedBytes": stats.session_downloaded_bytes,
+            "filesAdded": stats.session_files_added,
+            "sessionCount": 1,
+            "secondsActive": stats.get_session_seconds(),
+        }
+        cumulative = dict(current)
+        cumulative["downloadedBytes"] += stats.history_downloaded_bytes
+        cumulative["filesAdded"] += stats.history_files
+        return {
+            "activeTorrentCount": active,
+            "downloadSpeed": stats.get_rate(),
+            "pausedTorrentCount": 0,
+            "torrentCount": len(transfers),
+            "uploadSpeed": 0,
+            "cumulative-stats": cumulative,
+            "current-stats": current,
+        }
 
-    def _torrent_add(self, filename, **arguments):
-        if os.path.isfile(filename):
-            self._putio_client.Transfer.add_torrent(filename)
+    def _torrent_add(self, filename=None, metainfo=None, **arguments):
+        # The torrent is uploaded to put.io in the background; we only
+        # report whether it was accepted or is a duplicate.
+        if metainfo is not None:
+            info_hash, accepted = self._ingest_queue.submit_torrent_data(base64.b64decode(metainfo))
+        elif os.path.isfile(filename):
+            info_hash, accepted = self._ingest_queue.submit_torrent_file(filename)
         else:
-            self._putio_client.Transfer.add_url(filename)
-        return {}
+            info_hash, accepted = self._ingest_queue.submit_url(filename)
+        torrent = {"hashString": info_hash or "", "name": filename or ""}
+        return {"torrent-added" if accepted else "torrent-duplicate": torrent}
 
-    def _torrent_remove(self, ids, **arguments):
-        for id in ids:
-            file = self._putio_client.File.get(id)
-            file.delete()
+    def _torrent_remove(self, ids=None, **arguments):
+        # clients remove torrents by the id or hash string they were given by
+        # torrent-get; omitting ids would mean every torrent, which is never wanted
+        if ids is None:
+            return {}
+        transfers = filter_transfers(self._transfer_cache.get(), ids)
+        if not transfers:
+            return {}
+        file_ids = [transfer.file_id for transfer in transfers if getattr(transfer, "file_id", None)]
+        if file_ids:
+            self._putio_client.File.delete_multi(file_ids, skip_nonexistents=True)
+        self._putio_client.Transfer.cancel_multi([transfer.id for transfer in transfers])
+        self._transfer_cache.invalidate()
         return {}
 
     def _torrent_set(self, **arguments):
         return {}
 
-    def _torrent_get(self, fields, **arguments):
-        transfers = self._putio_client.Transfer.list()
-        transmission_transfers = [TransmissionTransferProxy(t, self._synchronizer) for t in transfers]
-        return {"torrents": [t.render_json(fields) for t in transmission_transfers]}
+    def _get_renderer(self, fields):
+        key = tuple(fields)
+        try:
+            return self._renderers[key]
+        except KeyError:
+            if len(self._renderers) > 64:
+                self._renderers.clear()  # clients only ever use a handful of field sets
+            renderer = self._renderers[key] = TransmissionTorrentRenderer(key)
+            return renderer
+
+    def _torrent_get(self, fields, ids=None, **arguments):
+        transfers = filter_transfers(self._transfer_cache.get(), ids)
+        renderer = self._get_renderer(fields)
+        context = RenderContext(self._synchronizer, transfers)
+        if renderer.needs_finished:
+            # resolve for all transfers in one query rather than one per transfer
+            context.downloaded_file_ids = self._synchronizer.get_downloaded_file_ids(t.file_id for t in transfers)
+        render = renderer.render
+        return {"torrents": [render(t, context) for t in transfers]}
 
     def handle_request(self):
         # If GET, just provide X-Transmission-Session-Id with HTTP 409
@@ -1,25 +1,35 @@
 import logging
 from math import ceil
 import datetime
+import threading
+import time
 
 import flask
 from flask_restless import APIManager
+from putiosync.api_client import get_call_counts
 from putiosync.dbmodel import DownloadRecord
 from flask import render_template
 from putiosync.webif.transmissionrpc import TransmissionRPCServer
 from sqlalchemy import desc, func
 
+logger = logging.getLogger("putiosync")
+
+# Counting and summing the whole history is a full table scan, so the
+# totals shown on the history pages are refreshed at most this often
+HISTORY_TOTALS_TTL = 30.0
+
+
 class Pagination(object):
     # NOTE: pagination is a feature that is included with flask-sqlalchemy, but after
     #   working with it initially, it was far too hacky to use this in combination
     #   with a model that wasn't declared with the flask-sqlalchemy meta base.  Since
     #   I did not and do not want to do that, this exists.
 
-    def __init__(self, query, page, per_page):
+    def __init__(self, query, page, per_page, total_count=None):
         self.query = query
         self.page = page
         self.per_page = per_page
-        self.total_count = query.count()
+        self.total_count = query.count() if total_count is None else total_count
 
     @property
     def items(self):
@@ -50,58 +60,26 @@ class Pagination(object):
                 last = num
 
 
-class DownloadRateTracker(object):
-    def __init__(self):
-        self._current_download = None
-        self._current_download_last_downloaded = 0
-        self._last_sample_datetime = None
-        self._bps_this_sample = 0
-
-    def get_bps(self):
-        return self._bps_this_sample
-
-    def update_progress(self, download):
-        current_sample_datetime = datetime.datetime.now()
-        bytes_this_sample = 0
-        if download is None:
-            self._current_download = None
-            self._bps_this_sample = 0
-            self._last_sample_datetime = current_sample_datetime
-            return
-
-        if self._current_download != download:
-            if self._current_download is not None:
-                # record remaininng progress from the previous download
-                bytes_this_sample += self._current_download.get_size() - self._current_download_last_downloaded
-            self._current_download = download
-            self._current_download_last_downloaded = 0
-            self._last_sample_datetime = current_sample_datetime
-
-        bytes_this_sample += download.get_downloaded() - self._current_download_last_downloaded
-        time_delta = current_sample_datetime - self._last_sample_datetime
-        if bytes_this_sample == 0 or time_delta <= datetime.timedelta(seconds=0):
-            self._bps_this_sample = 0
-        else:
-            self._bps_this_sample = float(bytes_this_sample) / time_delta.total_seconds()
-        self._current_download = download
-        self._current_download_last_downloaded = download.get_downloaded()
-        self._last_sample_datetime = current_sample_datetime
-
-
 class WebInterface(object):
     def __init__(self, db_manager, download_manager, putio_client, synchronizer, launch_browser=False, host="0.0.0.0",
-                 port=7001):
+                 port=7001, ingest_queue=None, server="flask", threads=8,
+                 profiler=None):
         self.app = flask.Flask(__name__)
         self.synchronizer = synchronizer
         self.db_manager = db_manager
-        self.api_manager = APIManager(self.app, session=self.db_manager.get_db_session())
+        self.api_manager = APIManager(self.app, session=self.db_manager.get_scoped_session())
         self.download_manager = download_manager
         self.putio_client = putio_client
-        self.transmission_rpc_server = TransmissionRPCServer(putio_client, self.synchronizer)
+        self.transmission_rpc_server = TransmissionRPCServer(putio_client, self.synchronizer, ingest_queue)
         self.launch_browser = launch_browser
         self._host = host
         self._port = port
-        self._rate_tracker = DownloadRateTracker()
+        self._profiler = profiler
+        self._server = server
+        self._threads = threads
+        self._history_totals = None
+        self._history_totals_time = 0
+        self._history_totals_lock = threading.Lock()
 
         self.app.logger.setLevel(logging.WARNING)
 
@@ -115,6 +93,9 @@ class WebInterface(object):
                 "GET_MANY": [include_datetime]
             })
 
+        # requests are served from a pool of threads, each with its own session
+        self.app.teardown_appcontext(self._remove_db_session)
+
         # filters
         self.app.jinja_env.filters["prettysize"] = self._pretty_size
 
@@ -126,6 +107,10 @@ class WebInterface(object):
         self.app.add_url_rule("/history/page/<int:page>", view_func=self._view_history)
         self.app.add_url_rule("/transmission/rpc", methods=['POST', 'GET', ],
                               view_func=self.transmission_rpc_server.handle_request)
+        self.app.add_url_rule("/admin/api_calls", view_func=self._view_api_calls)
+        if self._profiler is not None:
+            self.app.add_url_rule("/admin/profile", view_func=self._view_profile)
+            self.app.add_url_rule("/admin/profile/reset", methods=["POST"], view_func=self._reset_profile)
 
     def _pretty_size(self, size):
         if size > 1024 * 1024 * 1024:
@@ -137,22 +122,30 @@ class WebInterface(object):
         else:
             return "%s B" % size
 
+    def _remove_db_session(self, exception=None):
+        self.db_manager.remove_db_session()
+
+    def _get_history_totals(self):
+        """Return ``(count, total_size)`` of the download history, cached briefly"""
+        with self._history_totals_lock:
+            if self._history_totals is None or time.time() - self._history_totals_time > HISTORY_TOTALS_TTL:
+                session = self.db_manager.get_db_session()
+                self._history_totals = session.query(func.count(DownloadRecord.id),
+                                                     func.sum(DownloadRecord.size)).one()
+                self._history_totals_time = time.time()
+            return self._history_totals
+
     def _view_active(self):
         return render_template("active.html")
 
     def _view_download_queue(self):
         downloads = self.download_manager.get_downloads()
-        try:
-            if downloads[0].get_downloaded() > 0:
-                self._rate_tracker.update_progress(downloads[0])
-        except IndexError:
-            self._rate_tracker.update_progress(None)
-
         queued_downloads = []
         for download in downloads:
             queued_downloads.append(
                 {
-                    "name": download.get_putio_file().name,
+                    "name": download.get_name(),
+                    "profile": download.get_profile_name(),
                     "size": download.get_size(),
                     "downloaded": download.get_downloaded(),
                     "start_datetime": download.get_start_datetime(),
@@ -173,22 +166,40 @@ class WebInterface(object):
 
         download_queue = {
             "current_datetime": datetime.datetime.now(),  # use as basis for other calculations
-            "bps": self._rate_tracker.get_bps(),
+            "bps": self.download_manager.get_stats().get_rate(),
             "downloads": queued_downloads,
             "recent": recent_completed
         }
         return flask.jsonify(download_queue)
 
+    def _view_api_calls(self):
+        # requests sent to put.io (including retries) by endpoint since startup
+        return flask.jsonify(get_call_counts())
+
+    def _view_profile(self):
+        # folded stacks, e.g. for flamegraph.pl or https://www.speedscope.app/
+        return flask.Response(self._profiler.folded(), mimetype="text/plain")
+
+    def _reset_profile(self):
+        self._profiler.reset()
+        return flask.Response("", mimetype="text/plain")
+
     def _view_history(self, page=1):
         session = self.db_manager.get_db_session()
         downloads = session.query(DownloadRecord).order_by(desc(DownloadRecord.id))
-        total_downloaded = session.query(func.sum(DownloadRecord.size)).scalar()
+        total_count, total_downloaded = self._get_history_totals()
         return render_template("history.html",
                                total_downloaded=total_downloaded,
-                               history=Pagination(downloads, page, per_page=100))
+                               history=Pagination(downloads, page, per_page=100, total_count=total_count))
 
     def run(self):
         if self.launch_browser:
             import webbrowser
             webbrowser.open("http://localhost:{}/".format(self._port))
-        self.app.run(self._host, self._port)
+        if self._server == "waitress":
+            # waitress is optional; frontend checks that it can be imported
+            import waitress
+            logger.info("Serving web interface with waitress (%d threads)", self._threads)
+            waitress.serve(self.app, host=self._host, port=self._port, threads=self._threads)
+        else:
+            self.app.run(self._host, self._port, threaded=True)
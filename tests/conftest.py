@@ -0,0 +1,13 @@
+import pytest
+
+from putiosync import core
+
+
+@pytest.fixture
+def db_manager(tmp_path, monkeypatch):
+    """A :class:`DatabaseManager` for a database of its own in a temporary settings directory"""
+    monkeypatch.setattr(core, "SETTINGS_DIR", str(tmp_path / "settings"))
+    monkeypatch.setattr(core, "DATABASE_FILE", str(tmp_path / "settings" / "putiosync.db"))
+    manager = core.DatabaseManager()
+    yield manager
+    manager.remove_db_session()
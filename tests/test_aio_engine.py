@@ -0,0 +1,34 @@
+"""Tests for the asyncio engine's use of the database"""
+import concurrent.futures
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from putiosync.aio_engine import AsyncSyncEngine
+from putiosync.dbmodel import DownloadRecord
+
+
+class _RecordingDeletionQueue(object):
+    def __init__(self):
+        self.added = []
+
+    def add(self, file_id, name=None, profile=None):
+        self.added.append((file_id, name))
+
+
+def test_download_is_recorded_once(db_manager, tmp_path):
+    engine = AsyncSyncEngine("token", str(tmp_path), db_manager)
+    engine._record_downloaded(1, "file.bin", 1000, None, str(tmp_path / "file.bin"))
+    engine._record_downloaded(1, "file.bin", 1000, None, str(tmp_path / "file.bin"))
+    assert db_manager.get_db_session().query(DownloadRecord).count() == 1
+
+
+def test_deletions_go_through_the_deletion_queue(db_manager, tmp_path):
+    deletion_queue = _RecordingDeletionQueue()
+    engine = AsyncSyncEngine("token", str(tmp_path), db_manager, deletion_queue=deletion_queue)
+    engine._db_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    engine._delete_remote(1, "file.bin")
+    engine._db_executor.shutdown(wait=True)
+    assert deletion_queue.added == [(1, "file.bin")]
+    assert engine._pending_deletions == []
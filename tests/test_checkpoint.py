@@ -0,0 +1,71 @@
+"""Tests for :class:`putiosync.checkpoint.RangeCheckpoint`"""
+import os
+
+from putiosync.checkpoint import RangeCheckpoint
+
+
+def make_checkpoint(tmp_path, size=100):
+    return RangeCheckpoint(str(tmp_path / "file.bin.part"), size)
+
+
+def test_add_in_order(tmp_path):
+    checkpoint = make_checkpoint(tmp_path)
+    checkpoint.add(0, 10)
+    checkpoint.add(10, 10)
+    assert checkpoint.get_ranges() == [(0, 20)]
+    assert checkpoint.get_completed() == 20
+
+
+def test_add_out_of_order(tmp_path):
+    checkpoint = make_checkpoint(tmp_path)
+    checkpoint.add(50, 10)
+    checkpoint.add(10, 10)
+    checkpoint.add(80, 20)
+    assert checkpoint.get_ranges() == [(10, 10), (50, 10), (80, 20)]
+    checkpoint.add(20, 30)  # touches the ranges on both sides
+    assert checkpoint.get_ranges() == [(10, 50), (80, 20)]
+    checkpoint.add(0, 10)
+    assert checkpoint.get_ranges() == [(0, 60), (80, 20)]
+    assert checkpoint.get_missing() == [(60, 20)]
+
+
+def test_add_overlapping(tmp_path):
+    checkpoint = make_checkpoint(tmp_path)
+    checkpoint.add(10, 10)
+    checkpoint.add(30, 10)
+    checkpoint.add(50, 10)
+    checkpoint.add(15, 40)  # overlaps all three
+    assert checkpoint.get_ranges() == [(10, 50)]
+    checkpoint.add(20, 5)  # already written
+    assert checkpoint.get_ranges() == [(10, 50)]
+    assert checkpoint.get_completed() == 50
+
+
+def test_add_empty(tmp_path):
+    checkpoint = make_checkpoint(tmp_path)
+    checkpoint.add(10, 0)
+    assert checkpoint.get_ranges() == []
+    assert checkpoint.get_missing() == [(0, 100)]
+
+
+def test_save_and_load(tmp_path):
+    checkpoint = make_checkpoint(tmp_path)
+    with open(str(tmp_path / "file.bin.part"), "wb") as f:
+        f.truncate(100)
+        checkpoint.add(60, 20)
+        checkpoint.add(0, 30)
+        checkpoint.save(f.fileno())
+    loaded = make_checkpoint(tmp_path)
+    assert loaded.load() == 50
+    assert loaded.get_missing() == [(30, 30), (80, 20)]
+
+
+def test_load_ignores_checkpoint_for_other_size(tmp_path):
+    checkpoint = make_checkpoint(tmp_path)
+    with open(str(tmp_path / "file.bin.part"), "wb") as f:
+        f.truncate(100)
+        checkpoint.add(0, 30)
+        checkpoint.save(f.fileno())
+    loaded = make_checkpoint(tmp_path, size=200)
+    assert loaded.load() == 0
+    assert not os.path.exists(loaded.get_path())
@@ -0,0 +1,94 @@
+"""Tests for batching and retrying remote deletions"""
+import datetime
+
+from putiosync.dbmodel import PendingDeletion
+from putiosync.deletion_queue import DeletionQueue
+
+
+class _FakeFiles(object):
+    def __init__(self, error=None):
+        self.error = error
+        self.deleted = []
+
+    def delete_multi(self, file_ids, skip_nonexistents=False):
+        if self.error is not None:
+            raise self.error
+        self.deleted.append(list(file_ids))
+
+
+class _FakeClient(object):
+    def __init__(self, error=None):
+        self.File = _FakeFiles(error)
+
+
+def _pending(db_manager):
+    session = db_manager.get_db_session()
+    session.expire_all()
+    return dict((pending.file_id, pending) for pending in session.query(PendingDeletion))
+
+
+def _process_due(deletion_queue, db_manager):
+    session = db_manager.get_db_session()
+    batch = deletion_queue._next_batch(session)
+    return deletion_queue._process_batch(session, batch) if batch else None
+
+
+def test_add_is_persisted_once(db_manager):
+    deletion_queue = DeletionQueue(_FakeClient(), db_manager)
+    deletion_queue.add(1, "a.mkv")
+    deletion_queue.add(1, "a.mkv")
+    deletion_queue.add(2, "b.mkv")
+    assert sorted(_pending(db_manager)) == [1, 2]
+    assert deletion_queue.pending_count() == 2
+
+
+def test_due_deletions_are_sent_in_one_batch(db_manager):
+    client = _FakeClient()
+    deletion_queue = DeletionQueue(client, db_manager)
+    for file_id in (1, 2, 3):
+        deletion_queue.add(file_id)
+    assert _process_due(deletion_queue, db_manager)
+    assert [sorted(batch) for batch in client.File.deleted] == [[1, 2, 3]]
+    assert deletion_queue.is_empty()
+
+
+def test_batches_are_per_profile(db_manager):
+    default_client, other_client = _FakeClient(), _FakeClient()
+    deletion_queue = DeletionQueue(default_client, db_manager)
+    deletion_queue.add_client("other", other_client)
+    deletion_queue.add(1)
+    deletion_queue.add(2, profile="other")
+    while _process_due(deletion_queue, db_manager):
+        pass
+    assert default_client.File.deleted == [[1]]
+    assert other_client.File.deleted == [[2]]
+
+
+def test_failed_deletions_back_off(db_manager):
+    deletion_queue = DeletionQueue(_FakeClient(IOError("put.io is down")), db_manager,
+                                   retry_backoff=30, max_retry_backoff=45)
+    deletion_queue.add(1)
+    start = datetime.datetime.now()
+    assert _process_due(deletion_queue, db_manager) is False
+    pending = _pending(db_manager)[1]
+    assert pending.attempts == 1
+    assert pending.next_attempt >= start + datetime.timedelta(seconds=30)
+    assert _process_due(deletion_queue, db_manager) is None  # nothing due yet
+
+    pending.next_attempt = datetime.datetime.now()
+    db_manager.get_db_session().commit()
+    assert _process_due(deletion_queue, db_manager) is False
+    pending = _pending(db_manager)[1]
+    assert pending.attempts == 2
+    assert pending.next_attempt <= datetime.datetime.now() + datetime.timedelta(seconds=45)
+
+
+def test_adding_again_keeps_the_backoff(db_manager):
+    deletion_queue = DeletionQueue(_FakeClient(IOError("put.io is down")), db_manager)
+    deletion_queue.add(1)
+    _process_due(deletion_queue, db_manager)
+    next_attempt = _pending(db_manager)[1].next_attempt
+    deletion_queue.add(1)  # e.g. found again by the next check
+    pending = _pending(db_manager)[1]
+    assert pending.attempts == 1
+    assert pending.next_attempt == next_attempt
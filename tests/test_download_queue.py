@@ -0,0 +1,122 @@
+"""Tests for the download queue journal and restoring the queue on startup"""
+import datetime
+import time
+
+import putiopy
+
+from putiosync.core import RESTORED_MAX_ATTEMPTS, PutioSynchronizer
+from putiosync.dbmodel import DownloadRecord
+from putiosync.download_manager import DONE, Download, DownloadManager, DownloadQueueJournal
+from putiosync.profiles import Profile
+
+
+class _FailingDownload(Download):
+    __slots__ = ()
+
+    def perform_download(self, *args, **kwargs):
+        self._attempts += 1
+        return False
+
+
+def make_download(file_id, tmp_path):
+    return Download(file_id, "file-{}.bin".format(file_id), 1000, str(tmp_path / "downloads"))
+
+
+def test_journal_keeps_queue_order(db_manager, tmp_path):
+    journal = DownloadQueueJournal(db_manager)
+    for file_id in (3, 1, 2):
+        journal.record(make_download(file_id, tmp_path))
+    journal.flush()
+    assert [record.file_id for record in journal.load()] == [3, 1, 2]
+
+
+def test_journal_drops_completed_downloads(db_manager, tmp_path):
+    journal = DownloadQueueJournal(db_manager)
+    downloads = [make_download(file_id, tmp_path) for file_id in (1, 2)]
+    for download in downloads:
+        journal.record(download)
+    journal.flush()
+    downloads[0]._state = DONE
+    journal.record(downloads[0])
+    journal.flush()
+    assert [record.file_id for record in journal.load()] == [2]
+
+
+def test_journal_forget(db_manager, tmp_path):
+    journal = DownloadQueueJournal(db_manager)
+    for file_id in (1, 2, 3):
+        journal.record(make_download(file_id, tmp_path))
+    journal.flush()
+    journal.record(make_download(4, tmp_path))  # not flushed yet
+    journal.forget([2, 4])
+    journal.flush()
+    assert [record.file_id for record in journal.load()] == [1, 3]
+
+
+def test_journal_is_per_profile(db_manager, tmp_path):
+    journal = DownloadQueueJournal(db_manager)
+    journal.record(make_download(1, tmp_path))
+    journal.flush()
+    assert journal.load("other") == []
+    assert len(journal.load()) == 1
+
+
+def _make_synchronizer(db_manager, tmp_path, remote_file_ids):
+    client = putiopy.Client("token")
+    remote_files = [client.File({"id": file_id, "name": "file-{}.bin".format(file_id), "size": 1000,
+                                 "content_type": "video/mp4"}) for file_id in remote_file_ids]
+    client.File.list = staticmethod(lambda parent_id=0: remote_files)
+    journal = DownloadQueueJournal(db_manager)
+    manager = DownloadManager(token="token", journal=journal)  # not started
+    synchronizer = PutioSynchronizer(str(tmp_path / "downloads"), client, db_manager, manager,
+                                     keep_files=True, disable_progress=True)
+    return synchronizer, manager, journal
+
+
+def test_restore_queue(db_manager, tmp_path):
+    journal = DownloadQueueJournal(db_manager)
+    for file_id in (1, 2, 3):
+        journal.record(make_download(file_id, tmp_path))
+    journal.flush()
+    session = db_manager.get_db_session()
+    session.add(DownloadRecord(file_id=1, size=1000, timestamp=datetime.datetime.now(), name="file-1.bin"))
+    session.commit()
+
+    synchronizer, manager, journal = _make_synchronizer(db_manager, tmp_path, remote_file_ids=[2])
+    synchronizer.restore_queue()
+    # 1 was downloaded before the last shutdown
+    assert [download.get_file_id() for download in manager.get_downloads()] == [2, 3]
+    assert all(download.get_max_attempts() == RESTORED_MAX_ATTEMPTS for download in manager.get_downloads())
+    journal.flush()
+    assert [record.file_id for record in journal.load()] == [2, 3]
+
+    # 3 was deleted from put.io in the meantime
+    assert synchronizer._perform_single_check()
+    assert [download.get_file_id() for download in manager.get_downloads()] == [2]
+    assert not manager.is_queued(3)
+    journal.flush()
+    assert [record.file_id for record in journal.load()] == [2]
+
+
+def test_retries_are_capped_per_download(tmp_path):
+    manager = DownloadManager(token="token")
+    download = _FailingDownload(1, "file-1.bin", 1000, str(tmp_path))
+    download.set_max_attempts(3)
+    manager.add_download(download)
+    manager.start()
+    deadline = time.time() + 10
+    while not manager.is_empty() and time.time() < deadline:
+        time.sleep(0.01)
+    manager.shutdown()
+    assert manager.is_empty()
+    assert download.get_attempts() == 3
+    assert not manager.is_queued(1)
+
+
+def test_pending_downloads_are_per_profile(tmp_path):
+    first, second = Profile("first", "token", str(tmp_path)), Profile("second", "token", str(tmp_path))
+    manager = DownloadManager(token="token")  # not started
+    manager.add_download(Download(1, "file-1.bin", 1000, str(tmp_path), profile=first))
+    assert manager.has_pending_downloads(first)
+    assert not manager.has_pending_downloads(second)
+    assert not manager.has_pending_downloads(None)
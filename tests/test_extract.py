@@ -0,0 +1,148 @@
+"""Tests for the streaming zip extraction in :mod:`putiosync.extract`"""
+import io
+import os
+import zipfile
+
+import pytest
+
+from putiosync.extract import ContiguousRanges, ExtractionError, StreamingZipExtractor
+
+CONTENTS = {
+    "readme.txt": b"hello world\n",
+    "data/random.bin": os.urandom(100000),
+    "data/repeated.txt": b"putio-sync " * 5000,
+}
+
+
+class _Unseekable(object):
+    """Output stream without ``tell``/``seek`` so that zipfile writes data descriptors"""
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+    def flush(self):
+        pass
+
+
+def build_zip(contents=CONTENTS, compression=zipfile.ZIP_DEFLATED, seekable=True, force_zip64=False):
+    output = io.BytesIO() if seekable else _Unseekable()
+    with zipfile.ZipFile(output, "w", compression=compression) as archive:
+        for name, data in contents.items():
+            with archive.open(name, "w", force_zip64=force_zip64) as f:
+                f.write(data)
+    return output.getvalue() if seekable else output.buffer.getvalue()
+
+
+def extract(archive, destination, chunk_size=997):
+    extractor = StreamingZipExtractor(str(destination))
+    for offset in range(0, len(archive), chunk_size):
+        extractor.feed(archive[offset:offset + chunk_size])
+    extractor.close()
+    return extractor
+
+
+def assert_extracted(destination, contents=CONTENTS):
+    for name, data in contents.items():
+        with open(os.path.join(str(destination), name), "rb") as f:
+            assert f.read() == data
+
+
+@pytest.mark.parametrize("compression", [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+def test_extract(tmp_path, compression):
+    extractor = extract(build_zip(compression=compression), tmp_path)
+    assert extractor.is_done()
+    assert_extracted(tmp_path)
+    assert os.path.join(str(tmp_path), "data") in extractor.get_extracted_paths()
+
+
+def test_extract_whole_archive_at_once(tmp_path):
+    archive = build_zip()
+    extract(archive, tmp_path, chunk_size=len(archive))
+    assert_extracted(tmp_path)
+
+
+def test_extract_byte_by_byte(tmp_path):
+    contents = {"a.txt": b"abc" * 100, "b.txt": b"def" * 100}
+    extract(build_zip(contents), tmp_path, chunk_size=1)
+    assert_extracted(tmp_path, contents)
+
+
+def test_extract_data_descriptor(tmp_path):
+    archive = build_zip(seekable=False)
+    flags = zipfile.ZipFile(io.BytesIO(archive)).infolist()[0].flag_bits
+    assert flags & 0x8
+    extract(archive, tmp_path)
+    assert_extracted(tmp_path)
+
+
+def test_stored_entry_with_data_descriptor_is_rejected(tmp_path):
+    archive = build_zip(compression=zipfile.ZIP_STORED, seekable=False)
+    with pytest.raises(ExtractionError):
+        extract(archive, tmp_path)
+
+
+@pytest.mark.parametrize("compression", [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+def test_extract_zip64(tmp_path, compression):
+    extract(build_zip(compression=compression, force_zip64=True), tmp_path)
+    assert_extracted(tmp_path)
+
+
+def test_extract_zip64_data_descriptor(tmp_path):
+    extract(build_zip(seekable=False, force_zip64=True), tmp_path)
+    assert_extracted(tmp_path)
+
+
+@pytest.mark.parametrize("name", ["../escaped.txt", "data/../../escaped.txt"])
+def test_entry_outside_destination_is_rejected(tmp_path, name):
+    destination = tmp_path / "destination"
+    destination.mkdir()
+    with pytest.raises(ExtractionError):
+        extract(build_zip({name: b"nope"}), destination)
+    assert not (tmp_path / "escaped.txt").exists()
+
+
+def test_crc_mismatch(tmp_path):
+    archive = bytearray(build_zip({"a.txt": b"abcdef"}, compression=zipfile.ZIP_STORED))
+    archive[archive.index(b"abcdef")] ^= 0xFF
+    with pytest.raises(ExtractionError):
+        extract(bytes(archive), tmp_path)
+
+
+def test_truncated_archive(tmp_path):
+    archive = build_zip()
+    with pytest.raises(ExtractionError):
+        extract(archive[:len(archive) // 2], tmp_path)
+
+
+def test_remove_extracted(tmp_path):
+    archive = build_zip()
+    extractor = StreamingZipExtractor(str(tmp_path))
+    extractor.feed(archive[:len(archive) // 2])
+    assert extractor.get_extracted_paths()
+    extractor.remove_extracted()
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_contiguous_ranges_in_order():
+    ranges = ContiguousRanges()
+    assert ranges.add(0, 10) == 10
+    assert ranges.add(10, 5) == 15
+    assert ranges.get_watermark() == 15
+
+
+def test_contiguous_ranges_out_of_order():
+    ranges = ContiguousRanges()
+    assert ranges.add(20, 10) == 0
+    assert ranges.add(10, 5) == 0
+    assert ranges.add(15, 5) == 0  # joins [10, 15) and [20, 30)
+    assert ranges.add(0, 10) == 30
+
+
+def test_contiguous_ranges_overlapping_watermark():
+    ranges = ContiguousRanges()
+    ranges.add(0, 10)
+    assert ranges.add(5, 10) == 15
+    assert ranges.add(0, 5) == 15
@@ -0,0 +1,62 @@
+"""Tests for include/exclude rules"""
+import pytest
+
+from putiosync.filters import REGEX, FilterRule, PathFilter, build_path_filter
+
+
+@pytest.mark.parametrize("pattern, path, expected", [
+    ("/TV/**/*.mkv", "/TV/Show/Season 1/episode.mkv", True),
+    ("/TV/**/*.mkv", "/TV/episode.mkv", True),
+    ("/TV/**/*.mkv", "/Movies/movie.mkv", False),
+    ("/TV/*.mkv", "/TV/Show/episode.mkv", False),
+    ("/TV/episode.mk?", "/TV/episode.mkv", True),
+    ("/TV/[a-c]*.mkv", "/TV/b.mkv", True),
+    ("/TV/[!a-c]*.mkv", "/TV/b.mkv", False),
+    # relative globs match at any depth
+    ("*.mkv", "/movie.mkv", True),
+    ("*.mkv", "/Movies/Some Movie/movie.mkv", True),
+    ("*.mkv", "/Movies/movie.mkv.part", False),
+    ("Movies/*.mkv", "/Archive/Movies/movie.mkv", True),
+    ("Movies/*.mkv", "/MyMovies/movie.mkv", False),
+    ("**/*.mkv", "/movie.mkv", True),
+])
+def test_glob(pattern, path, expected):
+    assert PathFilter([FilterRule(pattern)]).matches(path) == expected
+
+
+def test_regex_is_anchored_at_the_start_only():
+    path_filter = PathFilter([FilterRule("/TV/.*mkv", REGEX)])
+    assert path_filter.matches("/TV/Show/episode.mkv.part")
+    assert not path_filter.matches("/Archive/TV/episode.mkv")
+
+
+def test_exclude_directory():
+    path_filter = build_path_filter(includes=["*.mkv"], excludes=["Sample"])
+    assert path_filter.matches("/Movies/Movie/movie.mkv")
+    assert not path_filter.matches("/Movies/Movie/Sample/sample.mkv")
+    assert not path_filter.could_match_below("/Movies/Movie/Sample")
+
+
+def test_could_match_below():
+    path_filter = build_path_filter(includes=["/TV/**/*.mkv", "re:/Movies/HD/"])
+    assert path_filter.could_match_below("/")
+    assert path_filter.could_match_below("/TV/Show")
+    assert path_filter.could_match_below("/Movies")
+    assert path_filter.could_match_below("/Movies/HD/Movie")
+    assert not path_filter.could_match_below("/Movies/SD")
+    assert not path_filter.could_match_below("/Music")
+
+
+def test_relative_globs_could_match_below_anything():
+    path_filter = build_path_filter(includes=["Movies/*.mkv"])
+    assert path_filter.could_match_below("/Archive")
+
+
+def test_no_rules():
+    assert build_path_filter() is None
+    assert PathFilter().matches("/anything")
+
+
+def test_rule_kind_prefixes():
+    assert FilterRule.parse("re:^/a").kind == REGEX
+    assert FilterRule.parse("glob:re:x").pattern == "re:x"
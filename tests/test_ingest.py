@@ -0,0 +1,116 @@
+"""Tests for adding torrents to put.io through the ingestion queue"""
+import base64
+import binascii
+import hashlib
+import threading
+
+import pytest
+import requests
+
+from putiosync.ingest import TorrentIngestQueue, magnet_info_hash, torrent_info_hash
+
+INFO = b"d6:lengthi1024e4:name8:file.bin12:piece lengthi16384e6:pieces20:" + b"\x01" * 20 + b"e"
+TORRENT = b"d8:announce19:http://tracker/a/b/13:announce-listll19:http://tracker/a/b/ee4:info" + INFO + b"e"
+INFO_HASH = hashlib.sha1(INFO).hexdigest()
+
+
+def test_torrent_info_hash():
+    assert torrent_info_hash(TORRENT) == INFO_HASH
+
+
+def test_torrent_info_hash_after_info():
+    assert torrent_info_hash(b"d4:info" + INFO + b"7:comment3:abce") == INFO_HASH
+
+
+@pytest.mark.parametrize("data", [b"", b"l4:spame", b"d7:comment3:abce", b"d4:info"])
+def test_torrent_info_hash_invalid(data):
+    with pytest.raises((ValueError, IndexError)):
+        torrent_info_hash(data)
+
+
+def test_magnet_info_hash():
+    assert magnet_info_hash("magnet:?xt=urn:btih:{}&dn=file".format(INFO_HASH.upper())) == INFO_HASH
+    base32 = base64.b32encode(binascii.unhexlify(INFO_HASH)).decode("ascii")
+    assert magnet_info_hash("magnet:?dn=file&xt=urn:btih:{}".format(base32)) == INFO_HASH
+    assert magnet_info_hash("magnet:?dn=file") is None
+    assert magnet_info_hash("http://example.com/file.torrent") is None
+
+
+class _FakeTransfer(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class _FakeTransfers(object):
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.added = []
+
+    def _add(self, payload):
+        if self.failures > 0:
+            self.failures -= 1
+            raise requests.ConnectionError("put.io is down")
+        self.added.append(payload)
+        return _FakeTransfer("transfer #{}".format(len(self.added)))
+
+    def add_url(self, url):
+        return self._add(url)
+
+    def add_torrent(self, path):
+        with open(path, "rb") as f:
+            return self._add(f.read())
+
+
+class _FakeClient(object):
+    def __init__(self, failures=0):
+        self.Transfer = _FakeTransfers(failures)
+
+
+def _submit_and_wait(queue, submit, *args):
+    done = threading.Event()
+    transfers = []
+
+    def done_callback(transfer):
+        transfers.append(transfer)
+        done.set()
+
+    result = submit(*args, done_callback=done_callback)
+    if result[1]:
+        assert done.wait(5)
+    return result, transfers
+
+
+def test_submissions_are_deduplicated_by_info_hash(tmp_path):
+    client = _FakeClient()
+    queue = TorrentIngestQueue(client, num_workers=1)
+    queue.start()
+    path = tmp_path / "file.torrent"
+    path.write_bytes(TORRENT)
+    (info_hash, accepted), transfers = _submit_and_wait(queue, queue.submit_torrent_file, str(path))
+    assert (info_hash, accepted) == (INFO_HASH, True)
+    assert transfers[0].name == "transfer #1"
+    (info_hash, accepted), _ = _submit_and_wait(queue, queue.submit_url,
+                                                "magnet:?xt=urn:btih:{}".format(INFO_HASH))
+    assert (info_hash, accepted) == (INFO_HASH, False)
+    assert client.Transfer.added == [TORRENT]
+
+
+def test_transient_errors_are_retried():
+    client = _FakeClient(failures=2)
+    queue = TorrentIngestQueue(client, num_workers=1, retry_backoff=0.01)
+    added = []
+    queue.add_added_callback(added.append)
+    queue.start()
+    _, transfers = _submit_and_wait(queue, queue.submit_url, "http://example.com/file.torrent")
+    assert transfers[0] is added[0]
+    assert client.Transfer.added == ["http://example.com/file.torrent"]
+
+
+def test_failed_submissions_may_be_submitted_again():
+    client = _FakeClient(failures=2)
+    queue = TorrentIngestQueue(client, num_workers=1, max_attempts=2, retry_backoff=0.01)
+    queue.start()
+    (_, accepted), transfers = _submit_and_wait(queue, queue.submit_torrent_data, TORRENT)
+    assert accepted and transfers == [None]
+    (_, accepted), transfers = _submit_and_wait(queue, queue.submit_torrent_data, TORRENT)
+    assert accepted and transfers[0].name == "transfer #1"
@@ -0,0 +1,35 @@
+"""Tests for reading synchronization profiles"""
+import json
+
+import pytest
+
+from putiosync.profiles import ProfileError, load_profiles, parse_profile
+
+
+def test_parse_profile():
+    profile = parse_profile({"name": "movies", "download_directory": "/data/movies", "remote_root": "12",
+                             "include": ["/**/*.mkv"], "exclude": ["/**/Sample/**"]}, "default")
+    assert profile.token == "default"
+    assert profile.remote_root == 12
+    assert profile.download_filter.matches("/Movie/movie.mkv")
+    assert not profile.download_filter.matches("/Movie/Sample/sample.mkv")
+
+
+@pytest.mark.parametrize("key", ["filter", "include", "exclude"])
+@pytest.mark.parametrize("rules", ["*.mkv", ["*.mkv", 1], {"*.mkv": True}])
+def test_rules_must_be_lists_of_strings(key, rules):
+    with pytest.raises(ProfileError, match="must be a list of strings"):
+        parse_profile({"name": "movies", "download_directory": "/data/movies", key: rules}, "default")
+
+
+def test_unknown_setting():
+    with pytest.raises(ProfileError, match="includes"):
+        parse_profile({"name": "movies", "download_directory": "/data/movies", "includes": []}, "default")
+
+
+def test_names_must_be_unique(tmp_path):
+    path = tmp_path / "profiles.json"
+    path.write_text(json.dumps({"profiles": [{"name": "a", "download_directory": "/a"},
+                                             {"name": "a", "download_directory": "/b"}]}))
+    with pytest.raises(ProfileError, match="unique"):
+        load_profiles(str(path), "default")
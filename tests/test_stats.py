@@ -0,0 +1,35 @@
+"""Tests for local download progress looked up by put.io id"""
+from putiosync.download_manager import Download, DownloadManager
+
+
+def make_download(file_id, parent_ids, tmp_path, size=100):
+    return Download(file_id, "file-{}.bin".format(file_id), size, str(tmp_path), parent_ids=parent_ids)
+
+
+def test_remaining_by_id(tmp_path):
+    manager = DownloadManager(token="token")  # not started
+    manager.add_download(make_download(11, (1, 2), tmp_path))
+    manager.add_download(make_download(12, (1, 2), tmp_path))
+    manager.add_download(make_download(13, (1, 3), tmp_path))
+    stats = manager.get_stats()
+    assert stats.get_remaining_by_id([1, 2, 3, 13, 99]) == {1: 300, 2: 200, 3: 100, 13: 100}
+
+    download = manager.get_downloads()[0]
+    stats.on_started(download)
+    download._downloaded = 40
+    stats.on_progress(download)
+    assert stats.get_remaining_by_id([1, 2, 3]) == {1: 260, 2: 160, 3: 100}
+    assert stats.is_active(2)
+    assert not stats.is_active(3)
+
+    stats.on_finished(download, True)
+    assert stats.get_remaining_by_id([1, 2, 11]) == {1: 200, 2: 100}
+
+
+def test_queue_positions(tmp_path):
+    manager = DownloadManager(token="token")  # not started
+    manager.add_download(make_download(11, (1, 2), tmp_path))
+    manager.add_download(make_download(12, (1, 3), tmp_path))
+    manager.add_download(make_download(13, (4,), tmp_path))
+    assert manager.get_queue_positions([1, 3, 4, 12, 99]) == {1: 0, 3: 1, 4: 2, 12: 1}
+    assert manager.get_queue_positions([]) == {}
@@ -0,0 +1,68 @@
+"""Tests for the cached put.io transfer list used by the Transmission RPC interface"""
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("flask")
+
+from putiosync.webif.transmissionrpc import TransferCache
+
+
+class _FakeTransfers(object):
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.calls = 0
+        self.error = None
+
+    def list(self):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return ["transfers #{}".format(self.calls)]
+
+
+class _FakeClient(object):
+    def __init__(self, delay=0.0):
+        self.Transfer = _FakeTransfers(delay)
+
+
+def test_list_is_cached_for_ttl():
+    client = _FakeClient()
+    cache = TransferCache(client, ttl=0.2)
+    assert cache.get() == ["transfers #1"]
+    assert cache.get() == ["transfers #1"]
+    time.sleep(0.25)
+    assert cache.get() == ["transfers #2"]
+
+
+def test_invalidate():
+    client = _FakeClient()
+    cache = TransferCache(client, ttl=60)
+    cache.get()
+    cache.invalidate()
+    assert cache.get() == ["transfers #2"]
+
+
+def test_concurrent_requests_share_a_fetch():
+    client = _FakeClient(delay=0.2)
+    cache = TransferCache(client, ttl=60)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get())) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert client.Transfer.calls == 1
+    assert results == [["transfers #1"]] * 8
+
+
+def test_errors_are_not_cached():
+    client = _FakeClient()
+    cache = TransferCache(client, ttl=60)
+    client.Transfer.error = IOError("put.io is down")
+    with pytest.raises(IOError):
+        cache.get()
+    client.Transfer.error = None
+    assert cache.get() == ["transfers #2"]